@@ -4,8 +4,10 @@ import asyncio
 import signal
 
 from shop_bot.webhook_server.app import create_webhook_app
-from shop_bot.data_manager.scheduler import periodic_subscription_check
-from shop_bot.data_manager import database
+from shop_bot.data_manager.scheduler import periodic_subscription_check, expiry_reminder_loop
+from shop_bot.data_manager.leader import run_as_leader
+from shop_bot.data_manager import database, async_database
+from shop_bot.modules import xui_client
 from shop_bot.bot_controller import BotController
 
 def main():
@@ -30,6 +32,7 @@ def main():
         if tasks:
             [task.cancel() for task in tasks]
             await asyncio.gather(*tasks, return_exceptions=True)
+        await xui_client.close_http_session()
         loop.stop()
 
     async def start_services():
@@ -48,13 +51,20 @@ def main():
         logger.info("Flask server started in a background thread on http://0.0.0.0:1488")
         logger.info("Application is running. Bot can be started from the web panel.")
         
-        asyncio.create_task(periodic_subscription_check())
+        # Несколько реплик могут работать с одной базой: фоновые задачи
+        # выполняет только ведущая
+        asyncio.create_task(run_as_leader([
+            periodic_subscription_check,
+            lambda: expiry_reminder_loop(bot_controller),
+        ]))
 
         await asyncio.Future()
 
     try:
         asyncio.run(start_services())
     finally:
+        async_database.shutdown_executor()
+        database.close_all_connections()
         logger.info("Application is shutting down.")
 
 if __name__ == "__main__":
@@ -25,13 +25,14 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ChatMemberStatus
 
 from shop_bot.bot import keyboards
-from shop_bot.modules import xui_api
-from shop_bot.data_manager.database import (
-    get_user, add_new_key, get_user_keys, update_user_stats,
+from shop_bot.modules import xui_api, host_placement
+from shop_bot.data_manager import database
+from shop_bot.data_manager.async_database import (
+    get_user_context, add_new_key, get_user_keys, update_user_stats,
     register_user_if_not_exists, get_next_key_number, get_key_by_id,
     update_key_info, set_trial_used, set_terms_agreed, get_setting, get_all_hosts,
     get_plans_for_host, get_plan_by_id, log_transaction, get_referral_count,
-    add_to_referral_balance, create_pending_transaction, 
+    add_to_referral_balance, create_pending_transaction, get_key_traffic_summary,
 )
 from shop_bot.config import (
     get_profile_text, get_vpn_active_text, VPN_INACTIVE_TEXT, VPN_NO_DATA_TEXT,
@@ -41,7 +42,7 @@ from shop_bot.config import (
 TELEGRAM_BOT_USERNAME = None
 PAYMENT_METHODS = None
 ADMIN_ID = None
-CRYPTO_BOT_TOKEN = get_setting("cryptobot_token")
+CRYPTO_BOT_TOKEN = database.get_setting("cryptobot_token")
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
@@ -64,13 +65,13 @@ def is_valid_email(email: str) -> bool:
 
 async def show_main_menu(message: types.Message, edit_message: bool = False):
     user_id = message.chat.id
-    user_db_data = get_user(user_id)
-    user_keys = get_user_keys(user_id)
+    user_db_data = await get_user_context(user_id)
     
     trial_available = not (user_db_data and user_db_data.get('trial_used'))
+    keys_count = user_db_data.get('keys_count', 0) if user_db_data else 0
 
     text = "🏠 <b>Главное меню</b>\n\nВыберите действие:"
-    keyboard = keyboards.create_main_menu_keyboard(user_keys, trial_available)
+    keyboard = keyboards.create_main_menu_keyboard(keys_count, trial_available)
     
     if edit_message:
         try:
@@ -80,11 +81,18 @@ async def show_main_menu(message: types.Message, edit_message: bool = False):
     else:
         await message.answer(text, reply_markup=keyboard)
 
+async def get_auto_placement_host(hosts: list[dict]) -> str | None:
+    """Хост для нового ключа в режиме автоматического размещения; None — режим
+    выключен или таблица загрузки еще не готова, и хост выбирает пользователь"""
+    if await get_setting("auto_host_placement") != "true":
+        return None
+    return host_placement.pick_host([host['host_name'] for host in hosts])
+
 def registration_required(f):
     @wraps(f)
     async def decorated_function(event: types.Update, *args, **kwargs):
         user_id = event.from_user.id
-        user_data = get_user(user_id)
+        user_data = await get_user_context(user_id)
         if user_data:
             return await f(event, *args, **kwargs)
         else:
@@ -113,10 +121,10 @@ def get_user_router() -> Router:
             except (IndexError, ValueError):
                 logger.warning(f"Invalid referral code received: {command.args}")
                 
-        register_user_if_not_exists(user_id, username, referrer_id)
+        await register_user_if_not_exists(user_id, username, referrer_id)
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.full_name
-        user_data = get_user(user_id)
+        user_data = await get_user_context(user_id)
 
         if user_data and user_data.get('agreed_to_terms'):
             await message.answer(
@@ -126,21 +134,21 @@ def get_user_router() -> Router:
             await show_main_menu(message)
             return
 
-        terms_url = get_setting("terms_url")
-        privacy_url = get_setting("privacy_url")
-        channel_url = get_setting("channel_url")
+        terms_url = await get_setting("terms_url")
+        privacy_url = await get_setting("privacy_url")
+        channel_url = await get_setting("channel_url")
 
         if not channel_url and (not terms_url or not privacy_url):
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
-        is_subscription_forced = get_setting("force_subscription") == "true"
+        is_subscription_forced = await get_setting("force_subscription") == "true"
         
         show_welcome_screen = (is_subscription_forced and channel_url) or (terms_url and privacy_url)
 
         if not show_welcome_screen:
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
@@ -169,7 +177,7 @@ def get_user_router() -> Router:
     @user_router.callback_query(Onboarding.waiting_for_subscription_and_agreement, F.data == "check_subscription_and_agree")
     async def check_subscription_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
         user_id = callback.from_user.id
-        channel_url = get_setting("channel_url")
+        channel_url = await get_setting("channel_url")
 
         if not channel_url:
             await process_successful_onboarding(callback, state)
@@ -213,21 +221,19 @@ def get_user_router() -> Router:
     async def profile_handler_callback(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = await get_user_context(user_id)
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
             return
         username = html.bold(user_db_data.get('username', 'Пользователь'))
         total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
         now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
-        if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
+        latest_expiry_ms = user_db_data.get('latest_expiry_ms')
+        latest_expiry_date = datetime.fromtimestamp(latest_expiry_ms / 1000) if latest_expiry_ms else None
+        if latest_expiry_date and latest_expiry_date > now:
             time_left = latest_expiry_date - now
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
-        elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
+        elif user_db_data.get('keys_count'): vpn_status_text = VPN_INACTIVE_TEXT
         else: vpn_status_text = VPN_NO_DATA_TEXT
         final_text = get_profile_text(username, total_spent, total_months, vpn_status_text)
         await callback.message.edit_text(final_text, reply_markup=keyboards.create_back_to_menu_keyboard())
@@ -237,12 +243,12 @@ def get_user_router() -> Router:
     async def referral_program_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_data = get_user(user_id)
+        user_data = await get_user_context(user_id)
         bot_username = (await callback.bot.get_me()).username
-        support_user = get_setting("support_user")
+        support_user = await get_setting("support_user")
         
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await get_referral_count(user_id)
         balance = user_data.get('referral_balance', 0)
         
         withdrawal_info = ""
@@ -274,10 +280,10 @@ def get_user_router() -> Router:
     async def about_handler(callback: types.CallbackQuery):
         await callback.answer()
         
-        about_text = get_setting("about_text")
-        terms_url = get_setting("terms_url")
-        privacy_url = get_setting("privacy_url")
-        channel_url = get_setting("channel_url")
+        about_text = await get_setting("about_text")
+        terms_url = await get_setting("terms_url")
+        privacy_url = await get_setting("privacy_url")
+        channel_url = await get_setting("channel_url")
 
         final_text = about_text if about_text else "Информация о проекте не добавлена."
 
@@ -294,8 +300,8 @@ def get_user_router() -> Router:
     async def about_handler(callback: types.CallbackQuery):
         await callback.answer()
 
-        support_user = get_setting("support_user")
-        support_text = get_setting("support_text")
+        support_user = await get_setting("support_user")
+        support_text = await get_setting("support_text")
 
         if support_user == None and support_text == None:
             await callback.message.edit_text(
@@ -318,7 +324,7 @@ def get_user_router() -> Router:
     async def manage_keys_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_keys = get_user_keys(user_id)
+        user_keys = await get_user_keys(user_id)
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -328,19 +334,20 @@ def get_user_router() -> Router:
     @registration_required
     async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
+        user_db_data = await get_user_context(user_id)
         if user_db_data and user_db_data.get('trial_used'):
             await callback.answer("Вы уже использовали бесплатный пробный период.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для создания пробного ключа.")
             return
             
-        if len(hosts) == 1:
+        auto_host_name = await get_auto_placement_host(hosts)
+        if len(hosts) == 1 or auto_host_name:
             await callback.answer()
-            await process_trial_key_creation(callback.message, hosts[0]['host_name'])
+            await process_trial_key_creation(callback.message, auto_host_name or hosts[0]['host_name'])
         else:
             await callback.answer()
             await callback.message.edit_text(
@@ -360,28 +367,31 @@ def get_user_router() -> Router:
         await message.edit_text(f"Отлично! Создаю для вас бесплатный ключ на 3 дня на сервере \"{host_name}\"...")
         
         try:
+            key_number = await get_next_key_number(user_id)
             result = await xui_api.create_or_update_key_on_host(
                 host_name=host_name,
-                email=f"user{user_id}-key{get_next_key_number(user_id)}-trial@telegram.bot",
+                email=f"user{user_id}-key{key_number}-trial@telegram.bot",
                 days_to_add=3
             )
             if not result:
                 await message.edit_text("❌ Не удалось создать пробный ключ. Ошибка на сервере.")
                 return
 
-            set_trial_used(user_id)
+            await set_trial_used(user_id)
             
-            new_key_id = add_new_key(
+            new_key_id = await add_new_key(
                 user_id=user_id,
                 host_name=host_name,
                 xui_client_uuid=result['client_uuid'],
                 key_email=result['email'],
-                expiry_timestamp_ms=result['expiry_timestamp_ms']
+                expiry_timestamp_ms=result['expiry_timestamp_ms'],
+                inbound_id=result['inbound_id']
             )
+            host_placement.note_placement(host_name)
             
             await message.delete()
             new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
-            final_text = get_purchase_success_text("готов", get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
+            final_text = get_purchase_success_text("готов", await get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
             await message.answer(text=final_text, reply_markup=keyboards.create_key_info_keyboard(new_key_id))
 
         except Exception as e:
@@ -394,7 +404,7 @@ def get_user_router() -> Router:
         key_id_to_show = int(callback.data.split("_")[2])
         await callback.message.edit_text("Загружаю информацию о ключе...")
         user_id = callback.from_user.id
-        key_data = get_key_by_id(key_id_to_show)
+        key_data = await get_key_by_id(key_id_to_show)
 
         if not key_data or key_data['user_id'] != user_id:
             await callback.message.edit_text("❌ Ошибка: ключ не найден.")
@@ -407,13 +417,18 @@ def get_user_router() -> Router:
                 return
 
             connection_string = details['connection_string']
-            expiry_date = datetime.fromisoformat(key_data['expiry_date'])
+            expiry_date = datetime.fromtimestamp((key_data['expiry_ms'] or 0) / 1000)
             created_date = datetime.fromisoformat(key_data['created_date'])
             
-            all_user_keys = get_user_keys(user_id)
+            all_user_keys = await get_user_keys(user_id)
             key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
             
-            final_text = get_key_info_text(key_number, expiry_date, created_date, connection_string)
+            # Трафик и статус — из локального ряда, который пополняет планировщик
+            traffic = await get_key_traffic_summary(key_id_to_show)
+            final_text = get_key_info_text(
+                key_number, expiry_date, created_date, connection_string,
+                traffic=traffic, now_ms=int(datetime.now().timestamp() * 1000)
+            )
             
             await callback.message.edit_text(
                 text=final_text,
@@ -429,7 +444,7 @@ def get_user_router() -> Router:
     async def show_qr_handler(callback: types.CallbackQuery):
         await callback.answer("Генерирую QR-код...")
         key_id = int(callback.data.split("_")[2])
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
         if not key_data or key_data['user_id'] != callback.from_user.id: return
         
         try:
@@ -472,10 +487,19 @@ def get_user_router() -> Router:
     @registration_required
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для покупки.")
             return
+
+        auto_host_name = await get_auto_placement_host(hosts)
+        plans = await get_plans_for_host(auto_host_name) if auto_host_name else None
+        if plans:
+            await callback.message.edit_text(
+                "Выберите тариф для нового ключа:",
+                reply_markup=keyboards.create_plans_keyboard(plans, action="new", host_name=auto_host_name, back_callback="manage_keys")
+            )
+            return
         
         await callback.message.edit_text(
             "Выберите сервер, на котором хотите приобрести ключ:",
@@ -487,7 +511,7 @@ def get_user_router() -> Router:
     async def select_host_for_purchase_handler(callback: types.CallbackQuery):
         await callback.answer()
         host_name = callback.data[len("select_host_new_"):]
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
         if not plans:
             await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
             return
@@ -507,7 +531,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Произошла ошибка. Неверный формат ключа.")
             return
 
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != callback.from_user.id:
             await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
@@ -518,7 +542,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
             return
 
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
 
         if not plans:
             await callback.message.edit_text(
@@ -611,8 +635,8 @@ def get_user_router() -> Router:
 
     async def show_payment_options(message: types.Message, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(message.chat.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await get_user_context(message.chat.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await message.edit_text("❌ Ошибка: Тариф не найден.")
@@ -625,7 +649,7 @@ def get_user_router() -> Router:
         message_text = CHOOSE_PAYMENT_METHOD_MESSAGE
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             
             if discount_percentage > 0:
@@ -665,10 +689,10 @@ def get_user_router() -> Router:
         await callback.answer("Создаю ссылку на оплату...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await get_user_context(callback.from_user.id)
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -679,7 +703,7 @@ def get_user_router() -> Router:
         price_rub = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -692,9 +716,9 @@ def get_user_router() -> Router:
         key_id = data.get('key_id')
         
         if not customer_email:
-            customer_email = get_setting("receipt_email")
+            customer_email = await get_setting("receipt_email")
 
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
             await state.clear()
@@ -751,7 +775,7 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет в Crypto Pay...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await get_user_context(callback.from_user.id)
         
         plan_id = data.get('plan_id')
         user_id = data.get('user_id', callback.from_user.id)
@@ -760,14 +784,14 @@ def get_user_router() -> Router:
         action = data.get('action')
         key_id = data.get('key_id')
 
-        cryptobot_token = get_setting('cryptobot_token')
+        cryptobot_token = await get_setting('cryptobot_token')
         if not cryptobot_token:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: cryptobot_token is not set.")
             await callback.message.edit_text("❌ Оплата криптовалютой временно недоступна. (Администратор не указал токен).")
             await state.clear()
             return
 
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
         if not plan:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: Plan with id {plan_id} not found.")
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -775,7 +799,7 @@ def get_user_router() -> Router:
             return
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -786,7 +810,7 @@ def get_user_router() -> Router:
         price_rub = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -840,8 +864,8 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет Heleket...")
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
+        user_data = await get_user_context(callback.from_user.id)
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -849,7 +873,7 @@ def get_user_router() -> Router:
             return
 
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -860,7 +884,7 @@ def get_user_router() -> Router:
         price_rub_decimal = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -892,8 +916,8 @@ def get_user_router() -> Router:
             
             data = await state.get_data()
             user_id = callback.from_user.id
-            wallet_address = get_setting("ton_wallet_address")
-            plan = get_plan_by_id(data.get('plan_id'))
+            wallet_address = await get_setting("ton_wallet_address")
+            plan = await get_plan_by_id(data.get('plan_id'))
             
             if not wallet_address or not plan:
                 await callback.message.edit_text("❌ Оплата через TON временно недоступна.")
@@ -917,9 +941,10 @@ def get_user_router() -> Router:
                 "user_id": user_id, "months": plan['months'], "price": float(price_rub),
                 "action": data.get('action'), "key_id": data.get('key_id'),
                 "host_name": data.get('host_name'), "plan_id": data.get('plan_id'),
-                "customer_email": data.get('customer_email'), "payment_method": "TON"
+                "customer_email": data.get('customer_email'), "payment_method": "TON",
+                "payment_id": payment_id
             }
-            create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
+            await create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
 
             amount_nanoton = int(price_ton * 1_000_000_000)
             
@@ -961,7 +986,7 @@ def get_user_router() -> Router:
 
 async def process_successful_onboarding(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Спасибо! Доступ предоставлен.")
-    set_terms_agreed(callback.from_user.id)
+    await set_terms_agreed(callback.from_user.id)
     await state.clear()
     await callback.message.delete()
     await callback.message.answer("Приятного использования!", reply_markup=keyboards.main_reply_keyboard)
@@ -980,8 +1005,8 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         plan_id = metadata.get('plan_id')
         payment_method = metadata.get('payment_method', 'Unknown')
         
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
+        user_info = await get_user_context(user_id)
+        plan_info = await get_plan_by_id(plan_id)
 
         username = user_info.get('username', 'N/A') if user_info else 'N/A'
         plan_name = plan_info.get('plan_name', f'{months} мес.') if plan_info else f'{months} мес.'
@@ -1006,10 +1031,10 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         logger.error(f"Failed to send admin notification for purchase: {e}", exc_info=True)
 
 async def _create_heleket_payment_request(user_id: int, price: float, months: int, host_name: str, state_data: dict) -> str | None:
-    merchant_id = get_setting("heleket_merchant_id")
-    api_key = get_setting("heleket_api_key")
-    bot_username = get_setting("telegram_bot_username")
-    domain = get_setting("domain")
+    merchant_id = await get_setting("heleket_merchant_id")
+    api_key = await get_setting("heleket_api_key")
+    bot_username = await get_setting("telegram_bot_username")
+    domain = await get_setting("domain")
 
     if not all([merchant_id, api_key, bot_username, domain]):
         logger.error("Heleket Error: Not all required settings are configured.")
@@ -1115,6 +1140,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         plan_id = int(metadata['plan_id'])
         customer_email = metadata.get('customer_email')
         payment_method = metadata.get('payment_method')
+        payment_id = metadata.get('payment_id')
 
         chat_id_to_delete = metadata.get('chat_id')
         message_id_to_delete = metadata.get('message_id')
@@ -1135,21 +1161,24 @@ async def process_successful_payment(bot: Bot, metadata: dict):
     )
     try:
         email = ""
+        inbound_id = None
         if action == "new":
-            key_number = get_next_key_number(user_id)
+            key_number = await get_next_key_number(user_id)
             email = f"user{user_id}-key{key_number}@{host_name.replace(' ', '').lower()}.bot"
         elif action == "extend":
-            key_data = get_key_by_id(key_id)
+            key_data = await get_key_by_id(key_id)
             if not key_data or key_data['user_id'] != user_id:
                 await processing_message.edit_text("❌ Ошибка: ключ для продления не найден.")
                 return
             email = key_data['key_email']
+            inbound_id = key_data['inbound_id']
         
         days_to_add = months * 30
         result = await xui_api.create_or_update_key_on_host(
             host_name=host_name,
             email=email,
-            days_to_add=days_to_add
+            days_to_add=days_to_add,
+            inbound_id=inbound_id
         )
 
         if not result:
@@ -1157,22 +1186,23 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             return
 
         if action == "new":
-            key_id = add_new_key(user_id, host_name, result['client_uuid'], result['email'], result['expiry_timestamp_ms'])
+            key_id = await add_new_key(user_id, host_name, result['client_uuid'], result['email'], result['expiry_timestamp_ms'], result['inbound_id'])
+            host_placement.note_placement(host_name)
         elif action == "extend":
-            update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
+            await update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
         
         price = float(metadata.get('price')) 
 
-        user_data = get_user(user_id)
+        user_data = await get_user_context(user_id)
         referrer_id = user_data.get('referred_by')
 
         if referrer_id:
-            percentage = Decimal(get_setting("referral_percentage") or "0")
+            percentage = Decimal(await get_setting("referral_percentage") or "0")
             
             reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
             
             if float(reward) > 0:
-                add_to_referral_balance(referrer_id, float(reward))
+                await add_to_referral_balance(referrer_id, float(reward))
                 
                 try:
                     referrer_username = user_data.get('username', 'пользователь')
@@ -1184,19 +1214,19 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 except Exception as e:
                     logger.warning(f"Could not send referral reward notification to {referrer_id}: {e}")
 
-        update_user_stats(user_id, price, months)
+        await update_user_stats(user_id, price, months)
         
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
-        log_transaction(
+        plan_info = await get_plan_by_id(plan_id)
+        await log_transaction(
             user_id=user_id,
-            username=user_info.get('username', 'N/A') if user_info else 'N/A',
+            username=user_data.get('username', 'N/A') if user_data else 'N/A',
             email=customer_email,
             host_name=host_name,
             plan_name=plan_info.get('plan_name', 'Неизвестный') if plan_info else 'Неизвестный',
             months=months,
             amount=price,
-            method=payment_method or 'Неизвестный'
+            method=payment_method or 'Неизвестный',
+            payment_id=payment_id
         )
         
         await processing_message.delete()
@@ -1204,7 +1234,7 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         connection_string = result['connection_string']
         new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
         
-        all_user_keys = get_user_keys(user_id)
+        all_user_keys = await get_user_keys(user_id)
         key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
 
         final_text = get_purchase_success_text(
@@ -2,19 +2,21 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMar
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from datetime import datetime
 
+from shop_bot.modules import host_health
+
 main_reply_keyboard = ReplyKeyboardMarkup(
     keyboard=[[KeyboardButton(text="🏠 Главное меню")]],
     resize_keyboard=True
 )
 
-def create_main_menu_keyboard(user_keys: list, trial_available: bool) -> InlineKeyboardMarkup:
+def create_main_menu_keyboard(keys_count: int, trial_available: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     
     if trial_available:
         builder.button(text="🎁 Попробовать бесплатно (3 дня)", callback_data="get_trial")
 
     builder.button(text="👤 Мой профиль", callback_data="show_profile")
-    builder.button(text=f"🔑 Мои ключи ({len(user_keys)})", callback_data="manage_keys")
+    builder.button(text=f"🔑 Мои ключи ({keys_count})", callback_data="manage_keys")
     builder.button(text="🤝 Реферальная программа", callback_data="show_referral_program")
     builder.button(text="🆘 Поддержка", callback_data="show_help")
     builder.button(text="ℹ️ О проекте", callback_data="show_about")
@@ -54,19 +56,25 @@ def create_support_keyboard(support_user: str) -> InlineKeyboardMarkup:
 
 def create_host_selection_keyboard(hosts: list, action: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    for host in hosts:
+    # Недоступные хосты скрываем, пока их цепь разомкнута; если лежат все —
+    # показываем все, чтобы пользователь не остался без выбора
+    available_hosts = [host for host in hosts if not host_health.is_open(host['host_name'])] or hosts
+    for host in available_hosts:
         callback_data = f"select_host_{action}_{host['host_name']}"
-        builder.button(text=host['host_name'], callback_data=callback_data)
+        text = host['host_name']
+        if host_health.is_degraded(host['host_name']):
+            text = f"⚠️ {text}"
+        builder.button(text=text, callback_data=callback_data)
     builder.button(text="⬅️ Назад", callback_data="manage_keys" if action == 'new' else "back_to_main_menu")
     builder.adjust(1)
     return builder.as_markup()
 
-def create_plans_keyboard(plans: list[dict], action: str, host_name: str, key_id: int = 0) -> InlineKeyboardMarkup:
+def create_plans_keyboard(plans: list[dict], action: str, host_name: str, key_id: int = 0, back_callback: str | None = None) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for plan in plans:
         callback_data = f"buy_{host_name}_{plan['plan_id']}_{action}_{key_id}"
         builder.button(text=f"{plan['plan_name']} - {plan['price']:.0f} RUB", callback_data=callback_data)
-    back_callback = "manage_keys" if action == "extend" else "buy_new_key"
+    back_callback = back_callback or ("manage_keys" if action == "extend" else "buy_new_key")
     builder.button(text="⬅️ Назад", callback_data=back_callback)
     builder.adjust(1) 
     return builder.as_markup()
@@ -102,9 +110,10 @@ def create_payment_keyboard(payment_url: str) -> InlineKeyboardMarkup:
 def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if keys:
+        now = datetime.now()
         for i, key in enumerate(keys):
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            status_icon = "✅" if expiry_date > datetime.now() else "❌"
+            expiry_date = datetime.fromtimestamp((key['expiry_ms'] or 0) / 1000)
+            status_icon = "✅" if expiry_date > now else "❌"
             host_name = key.get('host_name', 'Неизвестный хост')
             button_text = f"{status_icon} Ключ #{i+1} ({host_name}) (до {expiry_date.strftime('%d.%m.%Y')})"
             builder.button(text=button_text, callback_data=f"show_key_{key['key_id']}")
@@ -1,9 +1,14 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
-from shop_bot.data_manager.database import get_user
+from shop_bot.data_manager.async_database import get_user_context
 
-class BanMiddleware(BaseMiddleware):
+class UserContextMiddleware(BaseMiddleware):
+    """Загружает пользователя и сводку по ключам один раз на апдейт.
+
+    Результат кладется в data['user_context'] и в TTL-кэш, так что
+    registration_required и хендлеры получают его без повторных запросов.
+    """
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -14,7 +19,8 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
+        user_data = await get_user_context(user.id)
+        data['user_context'] = user_data
         if user_data and user_data.get('is_banned'):
             ban_message_text = "Вы заблокированы и не можете использовать этого бота."
             if isinstance(event, CallbackQuery):
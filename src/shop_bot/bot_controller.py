@@ -8,7 +8,7 @@ from aiogram.enums import ParseMode
 
 from shop_bot.data_manager import database
 from shop_bot.bot.handlers import get_user_router
-from shop_bot.bot.middlewares import BanMiddleware
+from shop_bot.bot.middlewares import UserContextMiddleware
 from shop_bot.bot import handlers
 
 logger = logging.getLogger(__name__)
@@ -67,7 +67,7 @@ class BotController:
             self._bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
             self._dp = Dispatcher()
             
-            self._dp.update.middleware(BanMiddleware())
+            self._dp.update.middleware(UserContextMiddleware())
             
             user_router = get_user_router()
             
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 CHOOSE_PLAN_MESSAGE = "Выберите подходящий тариф:"
 CHOOSE_PAYMENT_METHOD_MESSAGE = "Выберите удобный способ оплаты:"
 VPN_INACTIVE_TEXT = "❌ <b>Статус VPN:</b> Неактивен (срок истек)"
@@ -17,14 +19,38 @@ def get_vpn_active_text(days_left, hours_left):
         f"⏳ <b>Осталось:</b> {days_left} д. {hours_left} ч."
     )
 
-def get_key_info_text(key_number, expiry_date, created_date, connection_string):
+# Клиент считается в сети, если панель видела его за последние два цикла планировщика
+ONLINE_WINDOW_MS = 10 * 60 * 1000
+
+def format_traffic(num_bytes: int) -> str:
+    for unit, size in (("ГБ", 1024 ** 3), ("МБ", 1024 ** 2)):
+        if num_bytes >= size:
+            return f"{num_bytes / size:.2f} {unit}"
+    return f"{num_bytes / 1024:.0f} КБ"
+
+def get_traffic_text(traffic: dict, now_ms: int) -> str:
+    if traffic['last_online_ms'] and now_ms - traffic['last_online_ms'] <= ONLINE_WINDOW_MS:
+        online_text = "🟢 в сети"
+    elif traffic['last_online_ms']:
+        online_text = f"был в сети {datetime.fromtimestamp(traffic['last_online_ms'] / 1000).strftime('%d.%m.%Y в %H:%M')}"
+    else:
+        online_text = "не подключался"
+    return (
+        f"📊 <b>Трафик:</b> {format_traffic(traffic['up_total'] + traffic['down_total'])}"
+        f" (за сутки: {format_traffic(traffic['day_up'] + traffic['day_down'])})\n"
+        f"📶 <b>Статус:</b> {online_text}\n"
+    )
+
+def get_key_info_text(key_number, expiry_date, created_date, connection_string, traffic: dict | None = None, now_ms: int = 0):
     expiry_formatted = expiry_date.strftime('%d.%m.%Y в %H:%M')
     created_formatted = created_date.strftime('%d.%m.%Y в %H:%M')
+    traffic_text = get_traffic_text(traffic, now_ms) if traffic else ""
     
     return (
         f"<b>🔑 Информация о ключе #{key_number}</b>\n\n"
         f"➕ <b>Приобретён:</b> {created_formatted}\n"
-        f"⏳ <b>Действителен до:</b> {expiry_formatted}\n\n"
+        f"⏳ <b>Действителен до:</b> {expiry_formatted}\n"
+        f"{traffic_text}\n"
         f"<code>{connection_string}</code>"
     )
 
@@ -36,4 +62,17 @@ def get_purchase_success_text(action: str, key_number: int, expiry_date, connect
         f"🎉 <b>Ваш ключ #{key_number} {action_text}!</b>\n\n"
         f"⏳ <b>Он будет действовать до:</b> {expiry_formatted}\n\n"
         f"<code>{connection_string}</code>"
-    )
\ No newline at end of file
+    )
+
+def get_expiry_reminder_text(kind: str, key_number: int, expiry_date: datetime) -> str:
+    expiry_formatted = expiry_date.strftime('%d.%m.%Y в %H:%M')
+    if kind == "expired":
+        return (
+            f"❌ <b>Срок действия ключа #{key_number} истек</b> ({expiry_formatted}).\n\n"
+            f"Продлите ключ, чтобы снова пользоваться VPN."
+        )
+    left_text = "3 дня" if kind == "3d" else "1 день"
+    return (
+        f"⏳ <b>Ключ #{key_number} истекает через {left_text}</b>\n\n"
+        f"Он действует до {expiry_formatted}. Продлите его заранее, чтобы не остаться без VPN."
+    )
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import logging
+
+from shop_bot.data_manager import database
+
+async def _sync_hosts(dry_run: bool):
+    from shop_bot.data_manager.scheduler import run_subscription_check_cycle
+    from shop_bot.modules.xui_client import close_http_session
+
+    try:
+        await run_subscription_check_cycle(dry_run=dry_run)
+    finally:
+        await close_http_session()
+
+def main():
+    """Служебные команды обслуживания базы: python -m shop_bot.data_manager <command>"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)s] - %(message)s")
+
+    parser = argparse.ArgumentParser(prog="shop_bot.data_manager", description="Database maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="Apply pending schema migrations")
+    subparsers.add_parser("analyze", help="Refresh SQLite query planner statistics")
+    subparsers.add_parser("reconcile-stats", help="Recompute dashboard counters from scratch")
+    subparsers.add_parser("backfill-rollups", help="Rebuild daily rollups from scratch")
+    subparsers.add_parser("compact-traffic", help="Downsample and expire the key traffic time series")
+    sync_parser = subparsers.add_parser("sync-hosts", help="Run one reconciliation cycle of keys against host panels")
+    sync_parser.add_argument("--dry-run", action="store_true", help="Only report the differences, do not change the database")
+    args = parser.parse_args()
+
+    database.initialize_db()
+    if args.command == "analyze":
+        database.analyze_db()
+    elif args.command == "reconcile-stats":
+        database.reconcile_stats_counters()
+        logging.info(f"Dashboard counters: {database.get_stats_counters()}")
+    elif args.command == "backfill-rollups":
+        database.rebuild_daily_rollups()
+    elif args.command == "compact-traffic":
+        database.compact_key_traffic()
+    elif args.command == "sync-hosts":
+        asyncio.run(_sync_hosts(args.dry_run))
+    database.close_all_connections()
+
+if __name__ == "__main__":
+    main()
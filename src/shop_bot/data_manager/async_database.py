@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# SQLite все равно сериализует запись, поэтому большой пул потоков не нужен:
+# достаточно, чтобы запросы не выполнялись в потоке событийного цикла
+DB_EXECUTOR_MAX_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_MAX_WORKERS, thread_name_prefix="db")
+
+async def run_in_db_executor(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Выполняет синхронную функцию database.* в выделенном пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def shutdown_executor():
+    _executor.shutdown(wait=True, cancel_futures=True)
+    logger.info("Database executor has been shut down.")
+
+async def get_setting(key: str) -> str | None:
+    # Пока кэш свежий, настройки читаются из памяти без похода в пул
+    if database.is_settings_cache_fresh():
+        return database.get_setting(key)
+    return await run_in_db_executor(database.get_setting, key)
+
+async def get_host(host_name: str) -> dict | None:
+    return await run_in_db_executor(database.get_host, host_name)
+
+async def get_inbound_metadata(host_name: str, inbound_id: int) -> dict | None:
+    return await run_in_db_executor(database.get_inbound_metadata, host_name, inbound_id)
+
+async def save_inbound_metadata(host_name: str, host_url: str, inbound_id: int, metadata: dict):
+    return await run_in_db_executor(database.save_inbound_metadata, host_name, host_url, inbound_id, metadata)
+
+async def get_all_hosts() -> list[dict]:
+    return await run_in_db_executor(database.get_all_hosts)
+
+async def get_plans_for_host(host_name: str) -> list[dict]:
+    return await run_in_db_executor(database.get_plans_for_host, host_name)
+
+async def get_plan_by_id(plan_id: int) -> dict | None:
+    return await run_in_db_executor(database.get_plan_by_id, plan_id)
+
+async def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
+    return await run_in_db_executor(database.register_user_if_not_exists, telegram_id, username, referrer_id)
+
+async def get_user(telegram_id: int) -> dict | None:
+    return await run_in_db_executor(database.get_user, telegram_id)
+
+async def get_user_context(telegram_id: int) -> dict | None:
+    context = database.peek_user_context(telegram_id)
+    if context is not None:
+        return context
+    return await run_in_db_executor(database.get_user_context, telegram_id)
+
+async def add_to_referral_balance(user_id: int, amount: float):
+    return await run_in_db_executor(database.add_to_referral_balance, user_id, amount)
+
+async def get_referral_count(user_id: int) -> int:
+    return await run_in_db_executor(database.get_referral_count, user_id)
+
+async def set_terms_agreed(telegram_id: int):
+    return await run_in_db_executor(database.set_terms_agreed, telegram_id)
+
+async def set_trial_used(telegram_id: int):
+    return await run_in_db_executor(database.set_trial_used, telegram_id)
+
+async def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
+    return await run_in_db_executor(database.update_user_stats, telegram_id, amount_spent, months_purchased)
+
+async def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
+    return await run_in_db_executor(database.create_pending_transaction, payment_id, user_id, amount_rub, metadata)
+
+async def log_transaction(user_id: int, username: str, email: str, host_name: str, plan_name: str, months: int, amount: float, method: str, payment_id: str | None = None):
+    return await run_in_db_executor(
+        database.log_transaction, user_id, username, email, host_name, plan_name, months, amount, method, payment_id
+    )
+
+async def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int, inbound_id: int | None = None) -> int | None:
+    return await run_in_db_executor(database.add_new_key, user_id, host_name, xui_client_uuid, key_email, expiry_timestamp_ms, inbound_id)
+
+async def get_user_keys(user_id: int) -> list[dict]:
+    return await run_in_db_executor(database.get_user_keys, user_id)
+
+async def get_key_by_id(key_id: int) -> dict | None:
+    return await run_in_db_executor(database.get_key_by_id, key_id)
+
+async def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
+    return await run_in_db_executor(database.update_key_info, key_id, new_xui_uuid, new_expiry_ms)
+
+async def get_next_key_number(user_id: int) -> int:
+    return await run_in_db_executor(database.get_next_key_number, user_id)
+
+async def get_keys_for_host(host_name: str) -> list[dict]:
+    return await run_in_db_executor(database.get_keys_for_host, host_name)
+
+async def get_keys_expiring_between(start_ms: int, end_ms: int) -> list[dict]:
+    return await run_in_db_executor(database.get_keys_expiring_between, start_ms, end_ms)
+
+async def get_active_keys_for_user(user_id: int) -> list[dict]:
+    return await run_in_db_executor(database.get_active_keys_for_user, user_id)
+
+async def get_inbound_client_counts(host_name: str) -> dict[int, int]:
+    return await run_in_db_executor(database.get_inbound_client_counts, host_name)
+
+async def get_active_keys_count_by_host() -> dict[str, int]:
+    return await run_in_db_executor(database.get_active_keys_count_by_host)
+
+async def record_key_traffic(samples: list[tuple[int, int, int, bool]]) -> int:
+    return await run_in_db_executor(database.record_key_traffic, samples)
+
+async def get_host_keys_version(host_name: str) -> int | None:
+    return await run_in_db_executor(database.get_host_keys_version, host_name)
+
+async def get_host_keys_snapshot(host_name: str) -> tuple[int, list[dict]] | None:
+    return await run_in_db_executor(database.get_host_keys_snapshot, host_name)
+
+async def apply_host_sync(
+    host_name: str,
+    updates: list[tuple[int, str, int]],
+    deleted_key_ids: list[int],
+    traffic_samples: list[tuple[int, int, int, bool]],
+    lease: tuple[str, str] | None = None,
+) -> tuple[int, int] | None:
+    return await run_in_db_executor(database.apply_host_sync, host_name, updates, deleted_key_ids, traffic_samples, lease)
+
+async def compact_key_traffic():
+    return await run_in_db_executor(database.compact_key_traffic)
+
+async def get_key_traffic_summary(key_id: int) -> dict | None:
+    return await run_in_db_executor(database.get_key_traffic_summary, key_id)
+
+async def try_acquire_lease(name: str, holder: str, ttl_ms: int) -> bool:
+    return await run_in_db_executor(database.try_acquire_lease, name, holder, ttl_ms)
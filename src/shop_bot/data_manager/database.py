@@ -1,17 +1,112 @@
 import sqlite3
 from datetime import datetime
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from itertools import groupby
 from pathlib import Path
 import json
+import uuid
+import re
+
+from shop_bot.data_manager import migrations, expiry_timers
 
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path("/app/project")
 DB_FILE = PROJECT_ROOT / "users.db"
 
+DB_BUSY_TIMEOUT_MS = 5000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_POOL_MAX_IDLE = 8
+
+_pool_lock = threading.Lock()
+_idle_connections: list[sqlite3.Connection] = []
+_thread_state = threading.local()
+
+# Кэш настроек сверяется с версией в базе не чаще, чем раз в
+# SETTINGS_VERSION_CHECK_SECONDS: настройки могли изменить в другом процессе
+SETTINGS_VERSION_CHECK_SECONDS = 5
+
+_settings_lock = threading.Lock()
+_settings_cache: dict[str, str | None] | None = None
+# Версия настроек в базе, из которой собран кэш, и момент последней сверки
+_settings_version: int | None = None
+_settings_checked_at = 0.0
+
+USER_CONTEXT_CACHE_TTL_SECONDS = 30
+USER_CONTEXT_CACHE_MAX_SIZE = 10000
+
+_user_context_lock = threading.Lock()
+_user_context_cache: dict[int, tuple[float, dict]] = {}
+_user_context_generation = 0
+
+def _open_connection() -> sqlite3.Connection:
+    # Соединение может переходить между потоками Flask, но в каждый момент
+    # времени им владеет только один поток (см. get_connection)
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # Нужно, чтобы INSERT OR REPLACE запускал DELETE-триггеры счетчиков
+    conn.execute("PRAGMA recursive_triggers=ON")
+    return conn
+
+def _acquire_connection() -> sqlite3.Connection:
+    with _pool_lock:
+        if _idle_connections:
+            return _idle_connections.pop()
+    return _open_connection()
+
+def _release_connection(conn: sqlite3.Connection):
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        if len(_idle_connections) < DB_POOL_MAX_IDLE:
+            _idle_connections.append(conn)
+            return
+    conn.close()
+
+@contextmanager
+def get_connection():
+    """Выдает переиспользуемое соединение из пула на время блока with.
+
+    Вложенные вызовы в том же потоке получают то же соединение, поэтому
+    поток событийного цикла бота всегда работает через одно соединение.
+    """
+    held = getattr(_thread_state, "conn", None)
+    if held is not None:
+        yield held
+        return
+
+    conn = _acquire_connection()
+    _thread_state.conn = conn
+    try:
+        with conn:
+            yield conn
+    finally:
+        _thread_state.conn = None
+        _release_connection(conn)
+
+def close_all_connections():
+    with _pool_lock:
+        connections = list(_idle_connections)
+        _idle_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logging.error(f"Failed to close database connection: {e}")
+
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -124,6 +219,12 @@ def initialize_db():
                 "domain": None,
                 "ton_wallet_address": None,
                 "tonapi_key": None,
+                "xui_connect_timeout": "5",
+                "xui_read_timeout": "20",
+                "auto_host_placement": "false",
+                "scheduler_host_concurrency": "8",
+                "scheduler_host_timeout": "120",
+                "scheduler_max_deletions": "100",
             }
             run_migration()
             
@@ -144,174 +245,198 @@ def initialize_db():
                 logging.info("Database updated with missing settings.")
             
             conn.commit()
+        invalidate_settings_cache()
     except sqlite3.Error as e:
         logging.error(f"Database error on initialization: {e}")
 
 def run_migration():
-    if not DB_FILE.exists():
-        logging.error("Файл базы данных users.db не найден. Нечего мигрировать.")
-        return
-
     logging.info(f"Начинаю миграцию базы данных: {DB_FILE}")
-
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        logging.info("The migration of the table 'users' ...")
-        
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'referred_by' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
-            logging.info("-> The column 'referred_by' is successfully added.")
-        else:
-            logging.info("-> The column 'referred_by' already exists.")
-            
-        if 'referral_balance' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
-            logging.info("-> The column 'referred_by' already exists.")
-        else:
-            logging.info("-> The column 'referred_by' already exists.")
-        
-        logging.info("-> The column 'referred_by' already exists.")
-
-
-        logging.info("The migration of the table 'Transactions' ...")
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
-        table_exists = cursor.fetchone()
-
-        if table_exists:
-            cursor.execute("PRAGMA table_info(transactions)")
-            trans_columns = [row[1] for row in cursor.fetchall()]
-            
-            if 'payment_id' in trans_columns and 'status' in trans_columns:
-                logging.info("The 'Transactions' table already has a new structure. Migration is not required.")
-            else:
-                backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
-                cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
-                
-                logging.info("I create a new table 'Transactions' with the correct structure ...")
-                create_new_transactions_table(cursor)
-                logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
-        else:
-            logging.info("TRANSACTIONS table was not found. I create a new one ...")
-            create_new_transactions_table(cursor)
-            logging.info("The new table 'Transactions' has been successfully created.")
-
-        conn.commit()
-        conn.close()
-        
-        logging.info("--- The database is successfully completed! ---")
-
+        with get_connection() as conn:
+            migrations.apply_migrations(conn)
     except sqlite3.Error as e:
         logging.error(f"An error occurred during migration: {e}")
 
-def create_new_transactions_table(cursor: sqlite3.Cursor):
-    cursor.execute('''
-        CREATE TABLE transactions (
-            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            payment_id TEXT UNIQUE NOT NULL,
-            user_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            amount_rub REAL NOT NULL,
-            amount_currency REAL,
-            currency_name TEXT,
-            payment_method TEXT,
-            metadata TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
+def analyze_db():
+    """Пересобирает статистику SQLite, чтобы планировщик выбирал индексы"""
+    try:
+        with get_connection() as conn:
+            migrations.analyze(conn)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to analyze database: {e}")
 
-def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
+def create_host(name: str, url: str, user: str, passwd: str, inbounds: list[int], max_clients_per_inbound: int | None = None):
+    """Создает хост с пулом инбаундов; первый инбаунд пула считается основным"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO xui_hosts (host_name, host_url, host_username, host_pass, host_inbound_id) VALUES (?, ?, ?, ?, ?)",
-                (name, url, user, passwd, inbound)
+                """INSERT INTO xui_hosts (host_name, host_url, host_username, host_pass, host_inbound_id,
+                                          host_inbound_ids, max_clients_per_inbound)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (name, url, user, passwd, inbounds[0], json.dumps(inbounds), max_clients_per_inbound)
             )
             conn.commit()
             logging.info(f"Successfully created a new host: {name}")
     except sqlite3.Error as e:
         logging.error(f"Error creating host '{name}': {e}")
 
+def update_host_inbounds(host_name: str, inbounds: list[int], max_clients_per_inbound: int | None = None) -> bool:
+    """Меняет пул инбаундов хоста и лимит клиентов на инбаунд. Ключи на
+    убранных из пула инбаундах остаются на месте: планировщик сверяет и их,
+    новые ключи туда просто больше не попадают"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.execute(
+                """UPDATE xui_hosts SET host_inbound_id = ?, host_inbound_ids = ?, max_clients_per_inbound = ?
+                   WHERE host_name = ?""",
+                (inbounds[0], json.dumps(inbounds), max_clients_per_inbound, host_name)
+            )
+            conn.commit()
+            if cursor.rowcount == 0:
+                logging.warning(f"Cannot update inbounds: host '{host_name}' not found.")
+                return False
+            logging.info(f"Updated inbound pool of host '{host_name}': {inbounds}, max clients {max_clients_per_inbound}.")
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Error updating inbounds of host '{host_name}': {e}")
+        return False
+
 def delete_host(host_name: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE host_name = ?", (host_name,))
+            cursor.execute("DELETE FROM host_inbound_metadata WHERE host_name = ?", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE host_name = ?", (host_name,))
             conn.commit()
             logging.info(f"Successfully deleted host '{host_name}' and its plans.")
     except sqlite3.Error as e:
         logging.error(f"Error deleting host '{host_name}': {e}")
 
+def get_inbound_metadata(host_name: str, inbound_id: int) -> dict | None:
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM host_inbound_metadata WHERE host_name = ? AND inbound_id = ?", (host_name, inbound_id)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            result = dict(row)
+            result['metadata'] = json.loads(result['metadata'])
+            return result
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Failed to get inbound metadata for host '{host_name}': {e}")
+        return None
+
+def save_inbound_metadata(host_name: str, host_url: str, inbound_id: int, metadata: dict):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO host_inbound_metadata (host_name, host_url, inbound_id, metadata, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(host_name, inbound_id) DO UPDATE SET
+                    host_url = excluded.host_url, metadata = excluded.metadata, updated_at = excluded.updated_at
+            """, (host_name, host_url, inbound_id, json.dumps(metadata)))
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to save inbound metadata for host '{host_name}': {e}")
+
+def _host_from_row(row) -> dict:
+    host = dict(row)
+    try:
+        inbound_ids = [int(inbound_id) for inbound_id in json.loads(host.get('host_inbound_ids') or '[]')]
+    except (ValueError, TypeError):
+        inbound_ids = []
+    host['inbound_ids'] = inbound_ids or [host['host_inbound_id']]
+    return host
+
 def get_host(host_name: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE host_name = ?", (host_name,))
             result = cursor.fetchone()
-            return dict(result) if result else None
+            return _host_from_row(result) if result else None
     except sqlite3.Error as e:
         logging.error(f"Error getting host '{host_name}': {e}")
         return None
 
 def get_all_hosts() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts")
             hosts = cursor.fetchall()
-            return [dict(row) for row in hosts]
+            return [_host_from_row(row) for row in hosts]
     except sqlite3.Error as e:
         logging.error(f"Error getting list of all hosts: {e}")
         return []
 
+def _load_settings_cache() -> dict:
+    global _settings_cache, _settings_version, _settings_checked_at
+    with _settings_lock:
+        if not is_settings_cache_fresh():
+            with get_connection() as conn:
+                # Версия читается до настроек: если их изменят между запросами,
+                # следующая сверка увидит новую версию и перечитает кэш
+                row = conn.execute("SELECT version FROM settings_version WHERE id = 1").fetchone()
+                version = row['version'] if row else None
+                if _settings_cache is None or version is None or version != _settings_version:
+                    cursor = conn.execute("SELECT key, value FROM bot_settings")
+                    _settings_cache = {row['key']: row['value'] for row in cursor.fetchall()}
+                    _settings_version = version
+            _settings_checked_at = time.monotonic()
+        return _settings_cache
+
+def is_settings_cache_fresh() -> bool:
+    """Кэш настроек загружен и недавно сверен с версией в базе"""
+    return _settings_cache is not None and time.monotonic() - _settings_checked_at < SETTINGS_VERSION_CHECK_SECONDS
+
+def invalidate_settings_cache():
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+        settings = _settings_cache if is_settings_cache_fresh() else _load_settings_cache()
+        return settings.get(key)
     except sqlite3.Error as e:
         logging.error(f"Failed to get setting '{key}': {e}")
         return None
         
 def get_all_settings() -> dict:
-    settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM bot_settings")
-            rows = cursor.fetchall()
-            for row in rows:
-                settings[row['key']] = row['value']
+        settings = _settings_cache if is_settings_cache_fresh() else _load_settings_cache()
+        return dict(settings)
     except sqlite3.Error as e:
         logging.error(f"Failed to get all settings: {e}")
-    return settings
+        return {}
 
 def update_setting(key: str, value: str):
+    global _settings_cache
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
-            logging.info(f"Setting '{key}' updated.")
+        # Словарь подменяется целиком, поэтому читатели без блокировки
+        # всегда видят согласованный снимок. Запомненная версия остается
+        # прежней: следующая сверка перечитает и изменения других процессов
+        with _settings_lock:
+            if _settings_cache is not None:
+                _settings_cache = {**_settings_cache, key: value}
+        logging.info(f"Setting '{key}' updated.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
 
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
@@ -324,8 +449,7 @@ def create_plan(host_name: str, plan_name: str, months: int, price: float):
 
 def get_plans_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE host_name = ? ORDER BY months", (host_name,))
             plans = cursor.fetchall()
@@ -336,8 +460,7 @@ def get_plans_for_host(host_name: str) -> list[dict]:
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
             plan = cursor.fetchone()
@@ -348,7 +471,7 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
@@ -358,7 +481,7 @@ def delete_plan(plan_id: int):
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
             if not cursor.fetchone():
@@ -369,21 +492,23 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
             else:
                 cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
             conn.commit()
+            _invalidate_user_context(telegram_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
 
 def add_to_referral_balance(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
             conn.commit()
+            _invalidate_user_context(user_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to add to referral balance for user {user_id}: {e}")
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -393,8 +518,7 @@ def get_referral_count(user_id: int) -> int:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
             user_data = cursor.fetchone()
@@ -403,58 +527,126 @@ def get_user(telegram_id: int):
         logging.error(f"Failed to get user {telegram_id}: {e}")
         return None
 
+def _invalidate_user_context(telegram_id: int):
+    global _user_context_generation
+    with _user_context_lock:
+        _user_context_cache.pop(telegram_id, None)
+        _user_context_generation += 1
+
+def clear_user_context_cache():
+    global _user_context_generation
+    with _user_context_lock:
+        _user_context_cache.clear()
+        _user_context_generation += 1
+
+def peek_user_context(telegram_id: int) -> dict | None:
+    """Возвращает контекст пользователя из кэша, не обращаясь к базе"""
+    with _user_context_lock:
+        cached = _user_context_cache.get(telegram_id)
+        if cached is None:
+            return None
+        expires_at, context = cached
+        if expires_at < time.monotonic():
+            del _user_context_cache[telegram_id]
+            return None
+        return dict(context)
+
+def get_user_context(telegram_id: int) -> dict | None:
+    """Строка пользователя и сводка по его ключам одним запросом (с TTL-кэшем)"""
+    context = peek_user_context(telegram_id)
+    if context is not None:
+        return context
+    generation = _user_context_generation
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT u.*,
+                       COUNT(k.key_id) AS keys_count,
+                       MAX(k.expiry_ms) AS latest_expiry_ms
+                FROM users u
+                LEFT JOIN vpn_keys k ON k.user_id = u.telegram_id
+                WHERE u.telegram_id = ?
+                GROUP BY u.telegram_id
+            """, (telegram_id,))
+            row = cursor.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get user context {telegram_id}: {e}")
+        return None
+    if not row:
+        return None
+
+    context = dict(row)
+    with _user_context_lock:
+        # Если за время запроса была запись, результат мог устареть — не кэшируем
+        if generation != _user_context_generation:
+            return dict(context)
+        if len(_user_context_cache) >= USER_CONTEXT_CACHE_MAX_SIZE:
+            # Вытесняем самые старые записи (dict хранит порядок вставки)
+            for stale_id in list(_user_context_cache)[:USER_CONTEXT_CACHE_MAX_SIZE // 4]:
+                del _user_context_cache[stale_id]
+        _user_context_cache[telegram_id] = (time.monotonic() + USER_CONTEXT_CACHE_TTL_SECONDS, context)
+    return dict(context)
+
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _invalidate_user_context(telegram_id)
             logging.info(f"User {telegram_id} has agreed to terms.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set terms agreed for user {telegram_id}: {e}")
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
             conn.commit()
+            _invalidate_user_context(telegram_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to update user stats for {telegram_id}: {e}")
 
-def get_user_count() -> int:
+def get_stats_counters() -> dict:
+    """Счетчики дашборда из stats_counters — чтение за O(1)"""
+    counters = {name: 0 for name in migrations.STATS_COUNTER_NAMES}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            return cursor.fetchone()[0] or 0
+            cursor.execute("SELECT name, value FROM stats_counters")
+            for row in cursor.fetchall():
+                counters[row['name']] = row['value']
     except sqlite3.Error as e:
-        logging.error(f"Failed to get user count: {e}")
-        return 0
+        logging.error(f"Failed to get stats counters: {e}")
+    return counters
 
-def get_total_keys_count() -> int:
+def reconcile_stats_counters():
+    """Пересчитывает счетчики дашборда с нуля"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM vpn_keys")
-            return cursor.fetchone()[0] or 0
+        with get_connection() as conn:
+            migrations.reconcile_stats_counters(conn)
+            conn.commit()
+            logging.info("Stats counters reconciled.")
     except sqlite3.Error as e:
-        logging.error(f"Failed to get total keys count: {e}")
-        return 0
+        logging.error(f"Failed to reconcile stats counters: {e}")
+
+def get_user_count() -> int:
+    return int(get_stats_counters()['users_count'])
+
+def get_total_keys_count() -> int:
+    return int(get_stats_counters()['keys_count'])
 
 def get_total_spent_sum() -> float:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT SUM(total_spent) FROM users")
-            return cursor.fetchone()[0] or 0.0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get total spent sum: {e}")
-        return 0.0
+    return float(get_stats_counters()['total_spent'])
+
+def get_hosts_count() -> int:
+    return int(get_stats_counters()['hosts_count'])
 
 def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
@@ -468,8 +660,7 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
 
 def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ? AND status = 'pending'", (payment_id,))
@@ -490,15 +681,24 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
         logging.error(f"Failed to complete TON transaction {payment_id}: {e}")
         return None
 
-def log_transaction(user_id: int, username: str, email: str, host_name: str, plan_name: str, months: int, amount: float, method: str):
+def log_transaction(user_id: int, username: str, email: str, host_name: str, plan_name: str, months: int, amount: float, method: str, payment_id: str | None = None):
+    """Записывает успешную оплату. Если платеж уже был создан как pending (TON),
+    обновляет ту же строку, чтобы выручка не учлась дважды"""
+    metadata = {
+        "username": username, "customer_email": email, "host_name": host_name,
+        "plan_name": plan_name, "months": months,
+    }
+    payment_id = payment_id or f"{method}-{user_id}-{uuid.uuid4().hex}"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """INSERT INTO transactions
-                   (user_id, username, email, host_name, plan_name, months, amount_spent, payment_method, transaction_date)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (user_id, username, email, host_name, plan_name, months, amount, method, datetime.now())
+                """INSERT INTO transactions (payment_id, user_id, status, amount_rub, payment_method, metadata)
+                   VALUES (?, ?, 'paid', ?, ?, ?)
+                   ON CONFLICT(payment_id) DO UPDATE SET
+                       status = 'paid', payment_method = excluded.payment_method,
+                       metadata = json_patch(COALESCE(transactions.metadata, '{}'), excluded.metadata)""",
+                (payment_id, user_id, amount, method, json.dumps(metadata))
             )
             conn.commit()
     except sqlite3.Error as e:
@@ -509,8 +709,7 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
     transactions = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT COUNT(*) FROM transactions")
@@ -526,25 +725,29 @@ def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _invalidate_user_context(telegram_id)
             logging.info(f"Trial period marked as used for user {telegram_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set trial used for user {telegram_id}: {e}")
 
-def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
+def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int, inbound_id: int | None = None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date)
+                """INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms, inbound_id)
+                   VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT host_inbound_id FROM xui_hosts WHERE host_name = ?)))""",
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, int(expiry_timestamp_ms), inbound_id, host_name)
             )
             new_key_id = cursor.lastrowid
             conn.commit()
+            _invalidate_user_context(user_id)
+            expiry_timers.track_key(new_key_id, int(expiry_timestamp_ms))
             return new_key_id
     except sqlite3.Error as e:
         logging.error(f"Failed to add new key for user {user_id}: {e}")
@@ -552,8 +755,7 @@ def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: s
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
             keys = cursor.fetchall()
@@ -564,8 +766,7 @@ def get_user_keys(user_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
             key_data = cursor.fetchone()
@@ -576,22 +777,51 @@ def get_key_by_id(key_id: int):
 
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
-            cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
+            cursor.execute(
+                "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, expiry_ms = ? WHERE key_id = ?",
+                (new_xui_uuid, expiry_date, int(new_expiry_ms), key_id)
+            )
+            cursor.execute("SELECT user_id FROM vpn_keys WHERE key_id = ?", (key_id,))
+            owner = cursor.fetchone()
             conn.commit()
+            if owner:
+                _invalidate_user_context(owner['user_id'])
+                expiry_timers.track_key(key_id, int(new_expiry_ms))
     except sqlite3.Error as e:
         logging.error(f"Failed to update key {key_id}: {e}")
 
+def update_keys_info_bulk(updates: list[tuple[int, str, int]]) -> int:
+    """Обновляет uuid и срок у многих ключей одной транзакцией: (key_id, xui_uuid, expiry_ms)"""
+    if not updates:
+        return 0
+    try:
+        with get_connection() as conn:
+            conn.executemany(
+                "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, expiry_ms = ? WHERE key_id = ?",
+                [
+                    (xui_uuid, datetime.fromtimestamp(expiry_ms / 1000), int(expiry_ms), key_id)
+                    for key_id, xui_uuid, expiry_ms in updates
+                ]
+            )
+            conn.commit()
+        clear_user_context_cache()
+        for key_id, _, expiry_ms in updates:
+            expiry_timers.track_key(key_id, int(expiry_ms))
+        return len(updates)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to bulk update {len(updates)} keys: {e}")
+        return 0
+
 def get_next_key_number(user_id: int) -> int:
     keys = get_user_keys(user_id)
     return len(keys) + 1
 
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE host_name = ?", (host_name,))
             keys = cursor.fetchall()
@@ -600,67 +830,344 @@ def get_keys_for_host(host_name: str) -> list[dict]:
         logging.error(f"Failed to get keys for host '{host_name}': {e}")
         return []
 
-def get_all_vpn_users():
+def get_inbound_client_counts(host_name: str) -> dict[int, int]:
+    """Количество ключей (клиентов панели) на каждом инбаунде хоста"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
-            users = cursor.fetchall()
-            return [dict(user) for user in users]
+            cursor.execute(
+                "SELECT inbound_id, COUNT(*) FROM vpn_keys WHERE host_name = ? GROUP BY inbound_id", (host_name,)
+            )
+            return {inbound_id: count for inbound_id, count in cursor.fetchall()}
     except sqlite3.Error as e:
-        logging.error(f"Failed to get all vpn users: {e}")
+        logging.error(f"Failed to get inbound client counts for host '{host_name}': {e}")
+        return {}
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _expiry_ms_from_date(expiry_date) -> int | None:
+    """ISO-дата окончания (локальное время, как пишет add_new_key) -> эпоха в мс"""
+    if not expiry_date:
+        return None
+    try:
+        return int(datetime.fromisoformat(str(expiry_date).replace('Z', '+00:00')).timestamp() * 1000)
+    except (ValueError, TypeError):
+        return None
+
+def get_keys_expiring_between(start_ms: int, end_ms: int) -> list[dict]:
+    """Ключи, срок которых истекает в полуинтервале [start_ms, end_ms)"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM vpn_keys WHERE expiry_ms >= ? AND expiry_ms < ? ORDER BY expiry_ms",
+                (start_ms, end_ms)
+            )
+            return [dict(key) for key in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get keys expiring between {start_ms} and {end_ms}: {e}")
         return []
 
-def update_key_status_from_server(key_email: str, xui_client_data):
+def get_active_keys_for_user(user_id: int, now_ms: int | None = None) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
-            if xui_client_data:
-                expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
-                cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?", (xui_client_data.id, expiry_date, key_email))
-            else:
-                cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
+            cursor.execute(
+                "SELECT * FROM vpn_keys WHERE user_id = ? AND expiry_ms > ? ORDER BY key_id",
+                (user_id, now_ms or _now_ms())
+            )
+            return [dict(key) for key in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get active keys for user {user_id}: {e}")
+        return []
+
+def get_active_keys_count_by_host(now_ms: int | None = None) -> dict[str, int]:
+    """Количество активных ключей на каждом хосте (по индексу host_name, expiry_ms)"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT host_name, COUNT(*) FROM vpn_keys WHERE expiry_ms > ? GROUP BY host_name",
+                (now_ms or _now_ms(),)
+            )
+            return {host_name: count for host_name, count in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get active keys count by host: {e}")
+        return {}
+
+HOUR_MS = 3_600_000
+DAY_MS = 86_400_000
+# Сырые точки трафика (раз в цикл планировщика) храним двое суток, часовые
+# корзины — месяц, суточные — полгода
+KEY_TRAFFIC_RAW_RETENTION_MS = 2 * DAY_MS
+KEY_TRAFFIC_HOURLY_RETENTION_MS = 30 * DAY_MS
+KEY_TRAFFIC_RETENTION_MS = 180 * DAY_MS
+
+def _write_key_traffic(conn: sqlite3.Connection, samples: list[tuple[int, int, int, bool]], now_ms: int) -> int:
+    before = conn.total_changes
+    conn.executemany("""
+        INSERT INTO key_traffic (key_id, ts, up, down)
+        SELECT c.key_id, ?4,
+               CASE WHEN ?2 >= c.up_total THEN ?2 - c.up_total ELSE ?2 END,
+               CASE WHEN ?3 >= c.down_total THEN ?3 - c.down_total ELSE ?3 END
+        FROM key_traffic_counters c
+        WHERE c.key_id = ?1 AND (c.up_total != ?2 OR c.down_total != ?3)
+        ON CONFLICT(key_id, ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down
+    """, [(key_id, up_total, down_total, now_ms) for key_id, up_total, down_total, _ in samples])
+    points_written = conn.total_changes - before
+    conn.executemany("""
+        INSERT INTO key_traffic_counters (key_id, up_total, down_total, updated_ms, last_online_ms)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(key_id) DO UPDATE SET
+            up_total = excluded.up_total, down_total = excluded.down_total, updated_ms = excluded.updated_ms,
+            last_online_ms = COALESCE(excluded.last_online_ms, last_online_ms)
+    """, [
+        (key_id, up_total, down_total, now_ms, now_ms if online else None)
+        for key_id, up_total, down_total, online in samples
+    ])
+    return points_written
+
+def record_key_traffic(samples: list[tuple[int, int, int, bool]], now_ms: int | None = None) -> int:
+    """Сохраняет снимок счетчиков панели одной транзакцией: samples — (key_id,
+    up_total, down_total, online). В ряд пишутся только ненулевые приращения;
+    первый снимок ключа служит базой и точку не создает. Сброс счетчика в панели
+    считается трафиком с нуля"""
+    if not samples:
+        return 0
+    try:
+        with get_connection() as conn:
+            points_written = _write_key_traffic(conn, samples, now_ms or _now_ms())
             conn.commit()
+            return points_written
     except sqlite3.Error as e:
-        logging.error(f"Failed to update key status for {key_email}: {e}")
+        logging.error(f"Failed to record traffic for {len(samples)} keys: {e}")
+        return 0
+
+def _host_keys_version(conn: sqlite3.Connection, host_name: str) -> int:
+    row = conn.execute("SELECT version FROM host_key_versions WHERE host_name = ?", (host_name,)).fetchone()
+    return row[0] if row else 0
+
+def get_host_keys_version(host_name: str) -> int | None:
+    """Версия набора ключей хоста; меняется при любом изменении его ключей (см. миграцию 11)"""
+    try:
+        with get_connection() as conn:
+            return _host_keys_version(conn, host_name)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get key version for host '{host_name}': {e}")
+        return None
+
+def get_host_keys_snapshot(host_name: str) -> tuple[int, list[dict]] | None:
+    """Версия и ключи хоста, прочитанные одним согласованным снимком"""
+    try:
+        with get_connection() as conn:
+            conn.execute("BEGIN")
+            version = _host_keys_version(conn, host_name)
+            keys = conn.execute(
+                "SELECT key_id, key_email, expiry_ms, inbound_id FROM vpn_keys WHERE host_name = ?", (host_name,)
+            ).fetchall()
+            conn.commit()
+            return version, [dict(key) for key in keys]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get keys snapshot for host '{host_name}': {e}")
+        return None
+
+def apply_host_sync(
+    host_name: str,
+    updates: list[tuple[int, str, int]],
+    deleted_key_ids: list[int],
+    traffic_samples: list[tuple[int, int, int, bool]],
+    lease: tuple[str, str] | None = None,
+) -> tuple[int, int] | None:
+    """Применяет результат сверки хоста с панелью одной транзакцией: updates —
+    (key_id, xui_uuid, expiry_ms), deleted_key_ids — ключи, которых нет на
+    панели, traffic_samples — как в record_key_traffic. lease — (имя, владелец):
+    запись делается, только если аренда еще принадлежит владельцу. Возвращает
+    версию ключей хоста до и после записи; None — ничего не записано"""
+    try:
+        with get_connection() as conn:
+            # Сразу берем блокировку записи, чтобы между чтением версии
+            # и записью ключи хоста не изменил никто другой
+            conn.execute("BEGIN IMMEDIATE")
+            if lease and not _lease_held(conn, *lease, _now_ms()):
+                conn.rollback()
+                logging.warning(f"Skipped host sync for '{host_name}': lease '{lease[0]}' is no longer held by {lease[1]}.")
+                return None
+            version_before = _host_keys_version(conn, host_name)
+            conn.executemany(
+                "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, expiry_ms = ? WHERE key_id = ?",
+                [
+                    (xui_uuid, datetime.fromtimestamp(expiry_ms / 1000), int(expiry_ms), key_id)
+                    for key_id, xui_uuid, expiry_ms in updates
+                ]
+            )
+            conn.executemany("DELETE FROM vpn_keys WHERE key_id = ?", [(key_id,) for key_id in deleted_key_ids])
+            if traffic_samples:
+                _write_key_traffic(conn, traffic_samples, _now_ms())
+            version_after = _host_keys_version(conn, host_name)
+            conn.commit()
+        if updates or deleted_key_ids:
+            clear_user_context_cache()
+        for key_id, _, expiry_ms in updates:
+            expiry_timers.track_key(key_id, int(expiry_ms))
+        for key_id in deleted_key_ids:
+            expiry_timers.forget_key(key_id)
+        return version_before, version_after
+    except sqlite3.Error as e:
+        logging.error(f"Failed to apply host sync for '{host_name}' ({len(updates)} updates, {len(deleted_key_ids)} deletions): {e}")
+        return None
+
+def _fold_key_traffic(conn: sqlite3.Connection, bucket_ms: int, cutoff_ms: int):
+    # Точки старше cutoff_ms сворачиваются в корзины bucket_ms; уже выровненные
+    # корзины не трогаются, новые точки добавляются к ним через upsert
+    cutoff_ms -= cutoff_ms % bucket_ms
+    conn.execute("""
+        INSERT INTO key_traffic (key_id, ts, up, down)
+        SELECT key_id, ts - ts % ?1, SUM(up), SUM(down)
+        FROM key_traffic
+        WHERE ts < ?2 AND ts % ?1 != 0
+        GROUP BY key_id, ts - ts % ?1
+        ON CONFLICT(key_id, ts) DO UPDATE SET up = up + excluded.up, down = down + excluded.down
+    """, (bucket_ms, cutoff_ms))
+    conn.execute("DELETE FROM key_traffic WHERE ts < ?1 AND ts % ?2 != 0", (cutoff_ms, bucket_ms))
+
+def compact_key_traffic(now_ms: int | None = None):
+    """Прореживает ряд трафика: сырые точки -> часы -> сутки, самые старые удаляет"""
+    now_ms = now_ms or _now_ms()
+    try:
+        with get_connection() as conn:
+            conn.execute("DELETE FROM key_traffic WHERE ts < ?", (now_ms - KEY_TRAFFIC_RETENTION_MS,))
+            _fold_key_traffic(conn, DAY_MS, now_ms - KEY_TRAFFIC_HOURLY_RETENTION_MS)
+            _fold_key_traffic(conn, HOUR_MS, now_ms - KEY_TRAFFIC_RAW_RETENTION_MS)
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to compact key traffic: {e}")
+
+def _lease_held(conn: sqlite3.Connection, name: str, holder: str, now_ms: int) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM leader_leases WHERE name = ? AND holder = ? AND expires_ms > ?", (name, holder, now_ms)
+    ).fetchone()
+    return row is not None
+
+def try_acquire_lease(name: str, holder: str, ttl_ms: int, now_ms: int | None = None) -> bool:
+    """Берет или продлевает аренду name для holder одной атомарной записью.
+    Удается, если аренда свободна, истекла или уже принадлежит holder"""
+    now_ms = now_ms or _now_ms()
+    try:
+        with get_connection() as conn:
+            cursor = conn.execute("""
+                INSERT INTO leader_leases (name, holder, acquired_ms, expires_ms)
+                VALUES (?1, ?2, ?3, ?3 + ?4)
+                ON CONFLICT(name) DO UPDATE SET
+                    holder = excluded.holder,
+                    expires_ms = excluded.expires_ms,
+                    acquired_ms = CASE WHEN leader_leases.holder = excluded.holder
+                                       THEN leader_leases.acquired_ms ELSE excluded.acquired_ms END
+                WHERE leader_leases.holder = excluded.holder OR leader_leases.expires_ms <= ?3
+            """, (name, holder, now_ms, ttl_ms))
+            conn.commit()
+            return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logging.error(f"Failed to acquire lease '{name}' for {holder}: {e}")
+        return False
+
+def release_lease(name: str, holder: str):
+    try:
+        with get_connection() as conn:
+            conn.execute("DELETE FROM leader_leases WHERE name = ? AND holder = ?", (name, holder))
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to release lease '{name}' for {holder}: {e}")
+
+def get_lease(name: str) -> dict | None:
+    try:
+        with get_connection() as conn:
+            row = conn.execute("SELECT * FROM leader_leases WHERE name = ?", (name,)).fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get lease '{name}': {e}")
+        return None
+
+def get_key_traffic_summary(key_id: int, now_ms: int | None = None) -> dict | None:
+    """Трафик ключа без обращения к панели: накопительные счетчики, расход
+    за последние сутки и время последнего появления в сети"""
+    now_ms = now_ms or _now_ms()
+    try:
+        with get_connection() as conn:
+            row = conn.execute("""
+                SELECT c.up_total, c.down_total, c.updated_ms, c.last_online_ms,
+                       COALESCE(SUM(t.up), 0) AS day_up, COALESCE(SUM(t.down), 0) AS day_down
+                FROM key_traffic_counters c
+                LEFT JOIN key_traffic t ON t.key_id = c.key_id AND t.ts >= ?
+                WHERE c.key_id = ?
+                GROUP BY c.key_id
+            """, (now_ms - DAY_MS, key_id)).fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get traffic summary for key {key_id}: {e}")
+        return None
+
+def get_key_traffic_series(key_id: int, since_ms: int) -> list[dict]:
+    try:
+        with get_connection() as conn:
+            rows = conn.execute(
+                "SELECT ts, up, down FROM key_traffic WHERE key_id = ? AND ts >= ? ORDER BY ts", (key_id, since_ms)
+            ).fetchall()
+            return [dict(row) for row in rows]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get traffic series for key {key_id}: {e}")
+        return []
+
+def get_all_vpn_users():
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
+            users = cursor.fetchall()
+            return [dict(user) for user in users]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get all vpn users: {e}")
+        return []
 
 def get_daily_stats_for_charts(days: int = 30) -> dict:
-    stats = {'users': {}, 'keys': {}}
+    """Дневные ряды для графиков из daily_rollups: читается только диапазон последних дней"""
+    stats = {'users': {}, 'keys': {}, 'revenue': {}, 'transactions': {}}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
-            query_users = """
-                SELECT date(registration_date) as day, COUNT(*)
-                FROM users
-                WHERE registration_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_users, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['users'][row[0]] = row[1]
-            
-            query_keys = """
-                SELECT date(created_date) as day, COUNT(*)
-                FROM vpn_keys
-                WHERE created_date >= date('now', ?)
+            cursor.execute("""
+                SELECT day, SUM(new_users), SUM(new_keys), SUM(revenue), SUM(transactions_count)
+                FROM daily_rollups
+                WHERE day >= date('now', ?)
                 GROUP BY day
                 ORDER BY day;
-            """
-            cursor.execute(query_keys, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['keys'][row[0]] = row[1]
+            """, (f'-{days} days',))
+            for day, new_users, new_keys, revenue, transactions_count in cursor.fetchall():
+                if new_users:
+                    stats['users'][day] = new_users
+                if new_keys:
+                    stats['keys'][day] = new_keys
+                if transactions_count:
+                    stats['revenue'][day] = round(revenue, 2)
+                    stats['transactions'][day] = transactions_count
     except sqlite3.Error as e:
         logging.error(f"Failed to get daily stats for charts: {e}")
     return stats
 
+def rebuild_daily_rollups():
+    """Пересчитывает daily_rollups с нуля"""
+    try:
+        with get_connection() as conn:
+            migrations.rebuild_daily_rollups(conn)
+            conn.commit()
+            logging.info("Daily rollups rebuilt.")
+    except sqlite3.Error as e:
+        logging.error(f"Failed to rebuild daily rollups: {e}")
 
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             query = """
                 SELECT
@@ -682,8 +1189,7 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
             return [dict(row) for row in cursor.fetchall()]
@@ -693,64 +1199,61 @@ def get_all_users() -> list[dict]:
 
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _invalidate_user_context(telegram_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to ban user {telegram_id}: {e}")
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
             conn.commit()
+            _invalidate_user_context(telegram_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to unban user {telegram_id}: {e}")
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
             conn.commit()
+            _invalidate_user_context(user_id)
     except sqlite3.Error as e:
         logging.error(f"Failed to delete keys for user {user_id}: {e}")
 
+def _remaining_days(expiry_ms: int | None, now_ms: int | None = None) -> int:
+    if not expiry_ms:
+        return 0
+    return max(0, (expiry_ms - (now_ms or _now_ms())) // 86_400_000)
+
 def get_user_keys_with_remaining_time(user_id: int) -> list[dict]:
     """Получает ключи пользователя с информацией об оставшемся времени"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
+            # Оставшееся время считается в SQLite, без разбора дат в Python
+            # Трафик берется из локального ряда, панель не опрашивается
+            now_ms = _now_ms()
             cursor.execute("""
-                SELECT key_id, host_name, xui_client_uuid, key_email, 
-                       expiry_date, created_date
-                FROM vpn_keys 
-                WHERE user_id = ? 
-                ORDER BY key_id
-            """, (user_id,))
-            
-            keys = []
-            for row in cursor.fetchall():
-                key_data = dict(row)
-                
-                # Вычисляем оставшееся время
-                if key_data['expiry_date']:
-                    try:
-                        expiry = datetime.fromisoformat(key_data['expiry_date'].replace('Z', '+00:00'))
-                        now = datetime.utcnow()
-                        remaining_days = max(0, (expiry - now).days)
-                        key_data['remaining_days'] = remaining_days
-                    except:
-                        key_data['remaining_days'] = 0
-                else:
-                    key_data['remaining_days'] = 0
-                
-                keys.append(key_data)
-            
-            return keys
+                SELECT k.key_id, k.host_name, k.inbound_id, k.xui_client_uuid, k.key_email,
+                       k.expiry_date, k.expiry_ms, k.created_date,
+                       MAX(0, (COALESCE(k.expiry_ms, 0) - ?1) / 86400000) AS remaining_days,
+                       COALESCE(c.up_total, 0) + COALESCE(c.down_total, 0) AS traffic_total,
+                       (SELECT COALESCE(SUM(t.up + t.down), 0) FROM key_traffic t
+                        WHERE t.key_id = k.key_id AND t.ts >= ?1 - 86400000) AS traffic_day,
+                       c.last_online_ms
+                FROM vpn_keys k
+                LEFT JOIN key_traffic_counters c ON c.key_id = k.key_id
+                WHERE k.user_id = ?2
+                ORDER BY k.key_id
+            """, (now_ms, user_id))
+            return [dict(row) for row in cursor.fetchall()]
     except sqlite3.Error as e:
         logging.error(f"Failed to get keys with remaining time for user {user_id}: {e}")
         return []
@@ -758,8 +1261,7 @@ def get_user_keys_with_remaining_time(user_id: int) -> list[dict]:
 def get_user_transactions(user_id: int) -> list[dict]:
     """Получает транзакции пользователя"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT transaction_id, username, email, host_name, plan_name,
@@ -774,23 +1276,111 @@ def get_user_transactions(user_id: int) -> list[dict]:
         logging.error(f"Failed to get transactions for user {user_id}: {e}")
         return []
 
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _next_group(groups) -> tuple:
+    return next(groups, (None, None))
+
+def iter_export_user_records():
+    """Построчно отдает пользователей вместе с их ключами и транзакциями.
+
+    Три упорядоченных по user_id курсора сливаются на лету, поэтому память
+    не зависит от количества пользователей. Используется отдельное соединение
+    в одной читающей транзакции, чтобы выгрузка была согласованным снимком.
+    """
+    conn = _open_connection()
+    try:
+        conn.execute("BEGIN")
+        now_ms = _now_ms()
+        users_cursor = conn.execute("SELECT * FROM users ORDER BY telegram_id")
+        keys_cursor = conn.execute("""
+            SELECT user_id, key_id, host_name, inbound_id, xui_client_uuid, key_email,
+                   expiry_date, expiry_ms, created_date
+            FROM vpn_keys
+            ORDER BY user_id, key_id
+        """)
+        transactions_cursor = conn.execute("SELECT * FROM transactions ORDER BY user_id, created_date DESC")
+
+        key_groups = groupby(keys_cursor, key=lambda row: row['user_id'])
+        transaction_groups = groupby(transactions_cursor, key=lambda row: row['user_id'])
+        keys_user_id, user_keys = _next_group(key_groups)
+        transactions_user_id, user_transactions = _next_group(transaction_groups)
+
+        for user_row in users_cursor:
+            telegram_id = user_row['telegram_id']
+            user_data = dict(user_row)
+
+            # Ключи и транзакции пользователей, которых нет в users, пропускаем
+            while keys_user_id is not None and keys_user_id < telegram_id:
+                keys_user_id, user_keys = _next_group(key_groups)
+            user_data['keys'] = []
+            if keys_user_id == telegram_id:
+                for key_row in user_keys:
+                    key_data = dict(key_row)
+                    del key_data['user_id']
+                    key_data['remaining_days'] = _remaining_days(key_data['expiry_ms'], now_ms)
+                    user_data['keys'].append(key_data)
+                keys_user_id, user_keys = _next_group(key_groups)
+
+            while transactions_user_id is not None and transactions_user_id < telegram_id:
+                transactions_user_id, user_transactions = _next_group(transaction_groups)
+            user_data['transactions'] = []
+            if transactions_user_id == telegram_id:
+                user_data['transactions'] = [dict(row) for row in user_transactions]
+                transactions_user_id, user_transactions = _next_group(transaction_groups)
+
+            yield user_data
+    finally:
+        conn.rollback()
+        conn.close()
+
+def iter_export_users_json(ndjson: bool = False):
+    """Отдает экспорт пользователей кусками JSON (или NDJSON) постоянного размера"""
+    total_users = get_user_count()
+    header = {
+        "export_date": datetime.utcnow().isoformat() + "Z",
+        "version": "1.0",
+        "total_users": total_users,
+    }
+
+    buffer = []
+    buffered = 0
+    if ndjson:
+        buffer.append(json.dumps(header, ensure_ascii=False) + "\n")
+    else:
+        buffer.append(json.dumps(header, ensure_ascii=False)[:-1] + ', "users": [\n')
+
+    exported = 0
+    for user_data in iter_export_user_records():
+        line = json.dumps(user_data, ensure_ascii=False, default=str)
+        if ndjson:
+            line += "\n"
+        elif exported:
+            line = ",\n" + line
+        buffer.append(line)
+        buffered += len(line)
+        exported += 1
+        if buffered >= EXPORT_CHUNK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+
+    if not ndjson:
+        buffer.append("\n]}\n")
+    yield "".join(buffer)
+    logging.info(f"Successfully exported {exported} users")
+
 def export_all_users() -> dict:
     """Экспортирует всех пользователей с их данными в JSON формат"""
     try:
-        users = get_all_users()
+        users = list(iter_export_user_records())
         export_data = {
             "export_date": datetime.utcnow().isoformat() + "Z",
             "version": "1.0",
             "total_users": len(users),
-            "users": []
+            "users": users
         }
         
-        for user in users:
-            user_data = dict(user)
-            user_data['keys'] = get_user_keys_with_remaining_time(user['telegram_id'])
-            user_data['transactions'] = get_user_transactions(user['telegram_id'])
-            export_data['users'].append(user_data)
-        
         logging.info(f"Successfully exported {len(users)} users")
         return export_data
         
@@ -798,151 +1388,236 @@ def export_all_users() -> dict:
         logging.error(f"Failed to export users: {e}")
         raise
 
-def import_users_from_data(import_data: dict, overwrite_existing: bool = True) -> dict:
-    """Импортирует пользователей из JSON данных"""
+IMPORT_BATCH_SIZE = 500
+IMPORT_READ_CHUNK_SIZE = 64 * 1024
+IMPORT_PROGRESS_LOG_EVERY = 10000
+
+_USERS_ARRAY_START = re.compile(r'"users"\s*:\s*\[')
+
+def _iter_json_array_items(stream, chunk_size: int = IMPORT_READ_CHUNK_SIZE):
+    """Инкрементально разбирает элементы массива "users" из текстового потока"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while True:
+        match = _USERS_ARRAY_START.search(buffer)
+        if match:
+            buffer = buffer[match.end():]
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("No users array found in import file")
+        # Заголовок маленький, но на всякий случай не копим его целиком
+        buffer = buffer[-64:] + chunk
+
+    pos = 0
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of import file")
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+def _iter_ndjson_items(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        # Первая строка экспорта в NDJSON — заголовок без пользователя
+        if 'telegram_id' not in item and 'export_date' in item:
+            continue
+        yield item
+
+def _user_import_row(user_data: dict) -> tuple:
+    return (
+        user_data['telegram_id'],
+        user_data.get('username'),
+        user_data.get('total_spent', 0),
+        user_data.get('total_months', 0),
+        user_data.get('trial_used', False),
+        user_data.get('agreed_to_terms', False),
+        user_data.get('registration_date') or datetime.utcnow().isoformat(),
+        user_data.get('is_banned', False),
+        user_data.get('referred_by'),
+        user_data.get('referral_balance', 0)
+    )
+
+def _key_import_row(telegram_id: int, key_data: dict) -> tuple:
+    return (
+        telegram_id,
+        key_data.get('host_name'),
+        key_data.get('inbound_id'),
+        key_data.get('xui_client_uuid'),
+        key_data.get('key_email'),
+        key_data.get('expiry_date'),
+        key_data.get('expiry_ms') or _expiry_ms_from_date(key_data.get('expiry_date')),
+        key_data.get('created_date') or datetime.utcnow().isoformat()
+    )
+
+def _transaction_import_row(telegram_id: int, transaction_data: dict) -> tuple:
+    created_date = transaction_data.get('created_date') or transaction_data.get('transaction_date')
+    amount_rub = transaction_data.get('amount_rub', transaction_data.get('amount_spent')) or 0
+    # Дубликаты отсекает UNIQUE(payment_id); для старых выгрузок без payment_id
+    # строим детерминированный идентификатор, чтобы повторный импорт не дублировал записи
+    payment_id = transaction_data.get('payment_id') or f"import-{telegram_id}-{created_date}-{amount_rub}"
+    metadata = transaction_data.get('metadata')
+    if isinstance(metadata, dict):
+        metadata = json.dumps(metadata)
+    return (
+        payment_id,
+        telegram_id,
+        transaction_data.get('status') or 'paid',
+        amount_rub,
+        transaction_data.get('amount_currency'),
+        transaction_data.get('currency_name'),
+        transaction_data.get('payment_method'),
+        metadata,
+        created_date or datetime.utcnow().isoformat()
+    )
+
+def _import_users_batch(conn: sqlite3.Connection, batch: list[dict], overwrite_existing: bool, results: dict):
+    telegram_ids = [user_data['telegram_id'] for user_data in batch]
+    placeholders = ",".join("?" * len(telegram_ids))
+    cursor = conn.execute(f"SELECT telegram_id FROM users WHERE telegram_id IN ({placeholders})", telegram_ids)
+    existing_ids = {row[0] for row in cursor.fetchall()}
+
+    if not overwrite_existing:
+        results['skipped'] += sum(1 for user_data in batch if user_data['telegram_id'] in existing_ids)
+        batch = [user_data for user_data in batch if user_data['telegram_id'] not in existing_ids]
+        if not batch:
+            return
+
+    conn.executemany("""
+        INSERT INTO users
+        (telegram_id, username, total_spent, total_months, trial_used,
+         agreed_to_terms, registration_date, is_banned, referred_by, referral_balance)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            username = excluded.username, total_spent = excluded.total_spent,
+            total_months = excluded.total_months, trial_used = excluded.trial_used,
+            agreed_to_terms = excluded.agreed_to_terms, registration_date = excluded.registration_date,
+            is_banned = excluded.is_banned, referred_by = excluded.referred_by,
+            referral_balance = excluded.referral_balance
+    """, [_user_import_row(user_data) for user_data in batch])
+    updated = sum(1 for user_data in batch if user_data['telegram_id'] in existing_ids)
+    results['updated'] += updated
+    results['imported'] += len(batch) - updated
+
+    users_with_keys = [user_data for user_data in batch if user_data.get('keys')]
+    if overwrite_existing and users_with_keys:
+        # Удаляем старые ключи если перезаписываем
+        conn.executemany("DELETE FROM vpn_keys WHERE user_id = ?", [(user_data['telegram_id'],) for user_data in users_with_keys])
+    key_rows = [
+        _key_import_row(user_data['telegram_id'], key_data)
+        for user_data in users_with_keys for key_data in user_data['keys']
+    ]
+    if key_rows:
+        conn.executemany("""
+            INSERT OR REPLACE INTO vpn_keys
+            (user_id, host_name, inbound_id, xui_client_uuid, key_email, expiry_date, expiry_ms, created_date)
+            VALUES (?1, ?2, COALESCE(?3, (SELECT host_inbound_id FROM xui_hosts WHERE xui_hosts.host_name = ?2)), ?4, ?5, ?6, ?7, ?8)
+        """, key_rows)
+        results['keys_imported'] += len(key_rows)
+
+    transaction_rows = [
+        _transaction_import_row(user_data['telegram_id'], transaction_data)
+        for user_data in batch for transaction_data in (user_data.get('transactions') or [])
+    ]
+    if transaction_rows:
+        cursor = conn.executemany("""
+            INSERT OR IGNORE INTO transactions
+            (payment_id, user_id, status, amount_rub, amount_currency, currency_name,
+             payment_method, metadata, created_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, transaction_rows)
+        results['transactions_imported'] += cursor.rowcount
+
+def import_users_from_records(records, overwrite_existing: bool = True, progress_callback=None) -> dict:
+    """Импортирует пользователей пачками, каждая пачка — отдельная транзакция"""
     results = {
         "imported": 0,
         "updated": 0,
         "skipped": 0,
         "errors": [],
         "keys_imported": 0,
-        "transactions_imported": 0
+        "transactions_imported": 0,
+        "processed": 0
     }
-    
-    if not import_data.get('users'):
-        results['errors'].append("No users data found in import file")
-        return results
-    
+
+    def flush(batch: list[dict]):
+        try:
+            with get_connection() as conn:
+                _import_users_batch(conn, batch, overwrite_existing, results)
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Database error during import: {e}")
+            results['errors'].append(f"Users {batch[0]['telegram_id']}..{batch[-1]['telegram_id']}: {str(e)}")
+        results['processed'] += len(batch)
+        if progress_callback:
+            progress_callback(results)
+        if results['processed'] % IMPORT_PROGRESS_LOG_EVERY < len(batch):
+            logging.info(f"Import progress: {results['processed']} users processed")
+
+    batch = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            
-            for user_data in import_data['users']:
-                try:
-                    telegram_id = user_data.get('telegram_id')
-                    if not telegram_id:
-                        results['errors'].append("User without telegram_id found")
-                        continue
-                    
-                    # Проверяем существует ли пользователь
-                    cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
-                    existing_user = cursor.fetchone()
-                    
-                    if existing_user and not overwrite_existing:
-                        results['skipped'] += 1
-                        continue
-                    
-                    # Импортируем/обновляем пользователя
-                    if existing_user:
-                        # Обновляем существующего пользователя
-                        cursor.execute("""
-                            UPDATE users SET 
-                                username = ?, total_spent = ?, total_months = ?,
-                                trial_used = ?, agreed_to_terms = ?, registration_date = ?,
-                                is_banned = ?, referred_by = ?, referral_balance = ?
-                            WHERE telegram_id = ?
-                        """, (
-                            user_data.get('username'),
-                            user_data.get('total_spent', 0),
-                            user_data.get('total_months', 0),
-                            user_data.get('trial_used', False),
-                            user_data.get('agreed_to_terms', False),
-                            user_data.get('registration_date'),
-                            user_data.get('is_banned', False),
-                            user_data.get('referred_by'),
-                            user_data.get('referral_balance', 0),
-                            telegram_id
-                        ))
-                        results['updated'] += 1
-                    else:
-                        # Создаем нового пользователя
-                        cursor.execute("""
-                            INSERT INTO users 
-                            (telegram_id, username, total_spent, total_months, trial_used,
-                             agreed_to_terms, registration_date, is_banned, referred_by, referral_balance)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """, (
-                            telegram_id,
-                            user_data.get('username'),
-                            user_data.get('total_spent', 0),
-                            user_data.get('total_months', 0),
-                            user_data.get('trial_used', False),
-                            user_data.get('agreed_to_terms', False),
-                            user_data.get('registration_date', datetime.utcnow().isoformat()),
-                            user_data.get('is_banned', False),
-                            user_data.get('referred_by'),
-                            user_data.get('referral_balance', 0)
-                        ))
-                        results['imported'] += 1
-                    
-                    # Импортируем ключи пользователя
-                    if user_data.get('keys'):
-                        # Удаляем старые ключи если перезаписываем
-                        if overwrite_existing:
-                            cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (telegram_id,))
-                        
-                        for key_data in user_data['keys']:
-                            cursor.execute("""
-                                INSERT OR REPLACE INTO vpn_keys 
-                                (user_id, host_name, xui_client_uuid, key_email, expiry_date, created_date)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                            """, (
-                                telegram_id,
-                                key_data.get('host_name'),
-                                key_data.get('xui_client_uuid'),
-                                key_data.get('key_email'),
-                                key_data.get('expiry_date'),
-                                key_data.get('created_date', datetime.utcnow().isoformat())
-                            ))
-                            results['keys_imported'] += 1
-                    
-                    # Импортируем транзакции пользователя
-                    if user_data.get('transactions'):
-                        for transaction_data in user_data['transactions']:
-                            # Проверяем, существует ли транзакция
-                            cursor.execute("""
-                                SELECT transaction_id FROM transactions 
-                                WHERE user_id = ? AND transaction_date = ? AND amount_spent = ?
-                            """, (
-                                telegram_id,
-                                transaction_data.get('transaction_date'),
-                                transaction_data.get('amount_spent')
-                            ))
-                            
-                            if not cursor.fetchone():  # Добавляем только если транзакции нет
-                                cursor.execute("""
-                                    INSERT INTO transactions 
-                                    (user_id, username, email, host_name, plan_name, months,
-                                     amount_spent, payment_method, transaction_date)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                """, (
-                                    telegram_id,
-                                    transaction_data.get('username'),
-                                    transaction_data.get('email'),
-                                    transaction_data.get('host_name'),
-                                    transaction_data.get('plan_name'),
-                                    transaction_data.get('months'),
-                                    transaction_data.get('amount_spent'),
-                                    transaction_data.get('payment_method'),
-                                    transaction_data.get('transaction_date')
-                                ))
-                                results['transactions_imported'] += 1
-                
-                except Exception as e:
-                    results['errors'].append(f"User {telegram_id}: {str(e)}")
-                    continue
-            
-            conn.commit()
-            logging.info(f"Import completed: {results}")
-            
-    except sqlite3.Error as e:
-        logging.error(f"Database error during import: {e}")
-        results['errors'].append(f"Database error: {str(e)}")
-    
+        for user_data in records:
+            if not isinstance(user_data, dict) or not user_data.get('telegram_id'):
+                results['errors'].append("User without telegram_id found")
+                continue
+            batch.append(user_data)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush(batch)
+                batch = []
+    except (ValueError, UnicodeDecodeError) as e:
+        logging.error(f"Failed to parse import data: {e}")
+        results['errors'].append(f"Parse error: {str(e)}")
+    if batch:
+        flush(batch)
+
+    if not results['processed'] and not results['errors']:
+        results['errors'].append("No users data found in import file")
+
+    clear_user_context_cache()
+    # Импортированные ключи не проходят через track_key: таймеры строятся заново
+    expiry_timers.reset()
+    logging.info(f"Import completed: {results}")
     return results
 
+def import_users_from_stream(stream, ndjson: bool = False, overwrite_existing: bool = True, progress_callback=None) -> dict:
+    """Импортирует пользователей из текстового потока JSON/NDJSON, не читая его целиком"""
+    records = _iter_ndjson_items(stream) if ndjson else _iter_json_array_items(stream)
+    return import_users_from_records(records, overwrite_existing, progress_callback)
+
+def import_users_from_data(import_data: dict, overwrite_existing: bool = True) -> dict:
+    """Импортирует пользователей из JSON данных"""
+    if not import_data.get('users'):
+        return {
+            "imported": 0, "updated": 0, "skipped": 0,
+            "errors": ["No users data found in import file"],
+            "keys_imported": 0, "transactions_imported": 0, "processed": 0
+        }
+    return import_users_from_records(import_data['users'], overwrite_existing)
+
 async def extend_user_key_time(key_id: int, days_to_add: int) -> dict:
     """Продлевает время действия конкретного ключа пользователя"""
+    from shop_bot.data_manager.async_database import run_in_db_executor
     from shop_bot.modules.xui_api import create_or_update_key_on_host
     
     result = {
@@ -954,21 +1629,22 @@ async def extend_user_key_time(key_id: int, days_to_add: int) -> dict:
     
     try:
         # Получаем данные ключа
-        key_data = get_key_by_id(key_id)
+        key_data = await run_in_db_executor(get_key_by_id, key_id)
         if not key_data:
             result["message"] = "Ключ не найден"
             return result
         
         # Сохраняем старую дату истечения
-        if key_data['expiry_date']:
-            old_expiry = datetime.fromisoformat(key_data['expiry_date'].replace('Z', '+00:00'))
+        if key_data['expiry_ms']:
+            old_expiry = datetime.fromtimestamp(key_data['expiry_ms'] / 1000)
             result["old_expiry"] = old_expiry.strftime('%Y-%m-%d %H:%M')
         
         # Обновляем ключ на x-ui сервере
         xui_result = await create_or_update_key_on_host(
             host_name=key_data['host_name'],
             email=key_data['key_email'],
-            days_to_add=days_to_add
+            days_to_add=days_to_add,
+            inbound_id=key_data['inbound_id']
         )
         
         if not xui_result:
@@ -976,7 +1652,8 @@ async def extend_user_key_time(key_id: int, days_to_add: int) -> dict:
             return result
         
         # Обновляем данные в базе
-        update_key_info(
+        await run_in_db_executor(
+            update_key_info,
             key_id=key_id,
             new_xui_uuid=xui_result['client_uuid'],
             new_expiry_ms=xui_result['expiry_timestamp_ms']
@@ -987,7 +1664,7 @@ async def extend_user_key_time(key_id: int, days_to_add: int) -> dict:
         result["new_expiry"] = new_expiry.strftime('%Y-%m-%d %H:%M')
         
         result["success"] = True
-        result["message"] = f"Ключ успешно {'продлен' if days_to_add > 0 else 'сокращен'} на {abs(days_to_add)} дней"
+        result["message"] = _extend_result_message(days_to_add)
         
         logging.info(f"Key {key_id} time updated: {days_to_add} days added")
         
@@ -997,8 +1674,36 @@ async def extend_user_key_time(key_id: int, days_to_add: int) -> dict:
     
     return result
 
+async def _extend_keys_time(keys: list[dict], days_to_add: int) -> dict[int, dict]:
+    """Продлевает набор ключей: одна пакетная запись в панель на хост и одна транзакция в БД.
+    Возвращает результат по key_id"""
+    from shop_bot.data_manager.async_database import run_in_db_executor
+    from shop_bot.modules.xui_api import bulk_extend_clients
+
+    panel_results = await bulk_extend_clients(
+        [(key['host_name'], key['inbound_id'], key['key_email'], days_to_add) for key in keys]
+    )
+    results = {}
+    updates = []
+    for key in keys:
+        panel_result = panel_results.get(key['key_email']) or {"success": False, "message": "Нет ответа от панели"}
+        results[key['key_id']] = panel_result
+        if panel_result['success']:
+            updates.append((key['key_id'], panel_result['client_uuid'], panel_result['expiry_timestamp_ms']))
+
+    if updates and await run_in_db_executor(update_keys_info_bulk, updates) != len(updates):
+        # Панель уже обновлена, а БД нет — планировщик подтянет сроки при следующей сверке
+        for key_id, _, _ in updates:
+            results[key_id] = {"success": False, "message": "Ошибка записи в базу данных"}
+    return results
+
+def _extend_result_message(days_to_add: int) -> str:
+    return f"Ключ успешно {'продлен' if days_to_add > 0 else 'сокращен'} на {abs(days_to_add)} дней"
+
 async def extend_user_all_keys_time(user_id: int, days_to_add: int) -> dict:
     """Продлевает время действия всех ключей пользователя"""
+    from shop_bot.data_manager.async_database import run_in_db_executor
+
     result = {
         "success": False,
         "message": "",
@@ -1008,23 +1713,20 @@ async def extend_user_all_keys_time(user_id: int, days_to_add: int) -> dict:
     }
     
     try:
-        user_keys = get_user_keys(user_id)
+        user_keys = await run_in_db_executor(get_user_keys, user_id)
         if not user_keys:
             result["message"] = "У пользователя нет ключей"
             return result
         
+        key_results = await _extend_keys_time(user_keys, days_to_add)
         for key in user_keys:
-            try:
-                key_result = await extend_user_key_time(key['key_id'], days_to_add)
-                if key_result["success"]:
-                    result["updated_keys"] += 1
-                    result["details"].append(f"✅ {key['key_email']}: {key_result['message']}")
-                else:
-                    result["failed_keys"] += 1
-                    result["details"].append(f"❌ {key['key_email']}: {key_result['message']}")
-            except Exception as e:
+            key_result = key_results[key['key_id']]
+            if key_result["success"]:
+                result["updated_keys"] += 1
+                result["details"].append(f"✅ {key['key_email']}: {_extend_result_message(days_to_add)}")
+            else:
                 result["failed_keys"] += 1
-                result["details"].append(f"❌ {key['key_email']}: {str(e)}")
+                result["details"].append(f"❌ {key['key_email']}: {key_result['message']}")
         
         if result["updated_keys"] > 0:
             result["success"] = True
@@ -1040,8 +1742,14 @@ async def extend_user_all_keys_time(user_id: int, days_to_add: int) -> dict:
     
     return result
 
+def _get_all_keys_by_user() -> list[dict]:
+    with get_connection() as conn:
+        return [dict(row) for row in conn.execute("SELECT * FROM vpn_keys ORDER BY user_id, key_id")]
+
 async def extend_all_users_keys_time(days_to_add: int, admin_user: str = "admin") -> dict:
     """Продлевает время действия всех ключей всех пользователей"""
+    from shop_bot.data_manager.async_database import run_in_db_executor
+
     result = {
         "success": False,
         "message": "",
@@ -1052,28 +1760,32 @@ async def extend_all_users_keys_time(days_to_add: int, admin_user: str = "admin"
     }
     
     try:
-        all_users = get_all_users()
+        all_users = await run_in_db_executor(get_all_users)
         if not all_users:
             result["message"] = "Пользователи не найдены"
             return result
         
+        all_keys = await run_in_db_executor(_get_all_keys_by_user)
+        key_results = await _extend_keys_time(all_keys, days_to_add)
+
+        keys_by_user = {user_id: list(keys) for user_id, keys in groupby(all_keys, key=lambda key: key['user_id'])}
         for user in all_users:
             user_id = user['telegram_id']
             username = user.get('username', f'ID_{user_id}')
-            
-            try:
-                user_result = await extend_user_all_keys_time(user_id, days_to_add)
-                result["processed_users"] += 1
-                result["updated_keys"] += user_result["updated_keys"]
-                result["failed_keys"] += user_result["failed_keys"]
-                
-                if user_result["updated_keys"] > 0:
-                    result["details"].append(f"👤 {username}: обновлено {user_result['updated_keys']} ключей")
-                elif user_result["failed_keys"] > 0:
-                    result["details"].append(f"👤 {username}: ошибки с {user_result['failed_keys']} ключами")
-                    
-            except Exception as e:
-                result["details"].append(f"👤 {username}: ошибка - {str(e)}")
+            user_updated = user_failed = 0
+            for key in keys_by_user.get(user_id, []):
+                if key_results[key['key_id']]["success"]:
+                    user_updated += 1
+                else:
+                    user_failed += 1
+
+            result["processed_users"] += 1
+            result["updated_keys"] += user_updated
+            result["failed_keys"] += user_failed
+            if user_updated > 0:
+                result["details"].append(f"👤 {username}: обновлено {user_updated} ключей")
+            elif user_failed > 0:
+                result["details"].append(f"👤 {username}: ошибки с {user_failed} ключами")
         
         if result["updated_keys"] > 0:
             result["success"] = True
@@ -1087,4 +1799,4 @@ async def extend_all_users_keys_time(days_to_add: int, admin_user: str = "admin"
         logging.error(f"Failed to extend all users keys time: {e}", exc_info=True)
         result["message"] = f"Ошибка: {str(e)}"
     
-    return result
\ No newline at end of file
+    return result
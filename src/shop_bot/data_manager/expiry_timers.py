@@ -0,0 +1,123 @@
+import asyncio
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86_400_000
+# Напоминания об окончании ключа: (вид события, за сколько до окончания)
+REMINDER_OFFSETS_MS = (("3d", 3 * DAY_MS), ("1d", DAY_MS), ("expired", 0))
+# В куче держатся только ключи, истекающие в ближайшие дни; следующее окно
+# дочитывается планировщиком по индексу expiry_ms раз в WINDOW_STEP_MS
+LOOKAHEAD_MS = 7 * DAY_MS
+WINDOW_STEP_MS = DAY_MS
+
+_lock = threading.Lock()
+# (момент срабатывания, key_id, вид события, срок ключа, для которого оно создано)
+_heap: list[tuple[int, int, str, int]] = []
+# key_id -> срок, для которого в куче лежат актуальные события. События
+# с другим сроком устарели (ключ продлили или удалили) и пропускаются при извлечении
+_tracked: dict[int, int] = {}
+# Ключи со сроком до этого момента уже загружены; 0 — таймеры не запущены
+_horizon_ms = 0
+_wakeup: tuple[asyncio.AbstractEventLoop, asyncio.Event] | None = None
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _push(key_id: int, expiry_ms: int, now_ms: int):
+    for kind, offset_ms in REMINDER_OFFSETS_MS:
+        fire_at_ms = expiry_ms - offset_ms
+        if fire_at_ms > now_ms:
+            heapq.heappush(_heap, (fire_at_ms, key_id, kind, expiry_ms))
+
+def _notify():
+    # Вызывается и из потоков пула базы, поэтому будим цикл потокобезопасно
+    if _wakeup is not None:
+        loop, event = _wakeup
+        loop.call_soon_threadsafe(event.set)
+
+def bind_loop(loop: asyncio.AbstractEventLoop) -> asyncio.Event:
+    """Событие, которое выставляется, когда появился таймер раньше текущего ближайшего"""
+    global _wakeup
+    _wakeup = (loop, asyncio.Event())
+    return _wakeup[1]
+
+def track_key(key_id: int, expiry_ms: int, now_ms: int | None = None):
+    """Ставит таймеры ключа с новым сроком; прежние таймеры ключа устаревают.
+    O(log n). Пока таймеры не запущены или срок за пределами загруженного
+    окна, ничего не делает — такой ключ подхватит загрузка окна"""
+    if not _horizon_ms or expiry_ms is None:
+        return
+    with _lock:
+        if _tracked.get(key_id) == expiry_ms:
+            return
+        if expiry_ms >= _horizon_ms:
+            _tracked.pop(key_id, None)
+            return
+        _tracked[key_id] = expiry_ms
+        head_before = _heap[0][0] if _heap else None
+        _push(key_id, expiry_ms, now_ms or _now_ms())
+        moved_earlier = bool(_heap) and _heap[0][0] != head_before
+    if moved_earlier:
+        _notify()
+
+def forget_key(key_id: int):
+    with _lock:
+        _tracked.pop(key_id, None)
+
+def next_window_ms() -> int:
+    """Когда пора дочитать следующее окно; 0 — немедленно"""
+    with _lock:
+        return _horizon_ms - LOOKAHEAD_MS + WINDOW_STEP_MS if _horizon_ms else 0
+
+def begin_window(now_ms: int) -> tuple[int, int]:
+    """Сдвигает окно вперед и возвращает полуинтервал сроков, который нужно
+    дочитать из базы. Окно сдвигается до чтения, чтобы изменения, сделанные
+    во время чтения, уже попадали в track_key"""
+    global _horizon_ms
+    with _lock:
+        start_ms = _horizon_ms or now_ms
+        _horizon_ms = max(_horizon_ms, now_ms + LOOKAHEAD_MS)
+        return start_ms, _horizon_ms
+
+def load_window(keys: list[tuple[int, int]], now_ms: int | None = None):
+    """Добавляет ключи (key_id, срок), прочитанные для окна из begin_window.
+    Ключи, которые уже успел поставить track_key, не трогаются — у них срок свежее"""
+    now_ms = now_ms or _now_ms()
+    with _lock:
+        for key_id, expiry_ms in keys:
+            if key_id not in _tracked and expiry_ms is not None:
+                _tracked[key_id] = expiry_ms
+                _push(key_id, expiry_ms, now_ms)
+        size = len(_heap)
+    logger.info(f"Expiry timers: loaded {len(keys)} keys, {size} timers queued.")
+
+def pop_due(now_ms: int) -> list[tuple[int, str, int]]:
+    """Снимает наступившие события: (key_id, вид, срок). Если у ключа наступило
+    сразу несколько (бот был остановлен), возвращается только последнее"""
+    due: dict[int, tuple[int, str, int]] = {}
+    with _lock:
+        while _heap and _heap[0][0] <= now_ms:
+            _, key_id, kind, expiry_ms = heapq.heappop(_heap)
+            if _tracked.get(key_id) != expiry_ms:
+                continue
+            due[key_id] = (key_id, kind, expiry_ms)
+            if kind == "expired":
+                _tracked.pop(key_id, None)
+    return list(due.values())
+
+def next_fire_ms() -> int | None:
+    with _lock:
+        return _heap[0][0] if _heap else None
+
+def reset():
+    """Сбрасывает все таймеры; следующая загрузка окна прочитает ключи заново"""
+    global _horizon_ms
+    with _lock:
+        _heap.clear()
+        _tracked.clear()
+        _horizon_ms = 0
+    _notify()
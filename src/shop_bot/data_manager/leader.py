@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from shop_bot.data_manager import async_database, database
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LEASE_NAME = "scheduler"
+# Ведущий продлевает аренду каждые LEASE_RENEW_SECONDS; если он умер, ведомый
+# перехватит роль не позже чем через LEASE_TTL_SECONDS + LEASE_RENEW_SECONDS
+LEASE_TTL_SECONDS = 10
+LEASE_RENEW_SECONDS = 3
+# Попытка продления ограничена, чтобы зависшая база (busy_timeout) не отложила
+# решение об остановке задач за пределы аренды
+LEASE_ATTEMPT_TIMEOUT_SECONDS = 1
+
+# Уникален для процесса: два контейнера могут получить одинаковый PID
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Аренда, под которой сейчас работают задачи этого процесса
+_held_lease: tuple[str, str] | None = None
+
+def current_lease() -> tuple[str, str] | None:
+    """(имя аренды, владелец), если задачи запущены ведущим; передается в записи,
+    которые должны выполняться только пока аренда действительно наша"""
+    return _held_lease
+
+def _start_jobs(jobs: list[Callable[[], Awaitable]]) -> list[asyncio.Task]:
+    return [asyncio.create_task(job()) for job in jobs]
+
+async def _stop_jobs(tasks: list[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run_as_leader(jobs: list[Callable[[], Awaitable]], lease_name: str = SCHEDULER_LEASE_NAME):
+    """Запускает фоновые задачи только в одном из процессов, работающих с общей
+    базой. Роль ведущего — аренда в таблице leader_leases: ведущий продлевает
+    ее, остальные процессы периодически пытаются ее взять. Если продлить аренду
+    не удалось до ее истечения, задачи останавливаются, чтобы два процесса
+    никогда не работали одновременно"""
+    global _held_lease
+    ttl_ms = LEASE_TTL_SECONDS * 1000
+    tasks: list[asyncio.Task] = []
+    # Момент, до которого аренда гарантированно наша (по локальным часам)
+    lease_valid_until = 0.0
+    logger.info(f"Leader election started for '{lease_name}' as {PROCESS_ID}.")
+
+    try:
+        while True:
+            attempt_started = time.monotonic()
+            try:
+                acquired = await asyncio.wait_for(
+                    async_database.try_acquire_lease(lease_name, PROCESS_ID, ttl_ms),
+                    timeout=LEASE_ATTEMPT_TIMEOUT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Lease '{lease_name}' renewal timed out.")
+                acquired = False
+
+            if acquired:
+                lease_valid_until = attempt_started + LEASE_TTL_SECONDS
+                if not tasks:
+                    logger.info(f"This process is now the leader for '{lease_name}'. Starting background jobs.")
+                    _held_lease = (lease_name, PROCESS_ID)
+                    tasks = _start_jobs(jobs)
+
+            # Следующая попытка завершится не позже чем через сон и ее таймаут;
+            # если аренда может истечь раньше, задачи останавливаются сейчас
+            deadline = time.monotonic() + LEASE_RENEW_SECONDS + LEASE_ATTEMPT_TIMEOUT_SECONDS
+            if tasks and deadline >= lease_valid_until:
+                logger.warning(f"Lost leadership for '{lease_name}'. Stopping background jobs.")
+                _held_lease = None
+                await _stop_jobs(tasks)
+                tasks = []
+
+            await asyncio.sleep(LEASE_RENEW_SECONDS)
+    finally:
+        _held_lease = None
+        if tasks:
+            await _stop_jobs(tasks)
+            # Отпускаем аренду сразу, чтобы ведомый не ждал ее истечения
+            database.release_lease(lease_name, PROCESS_ID)
+            logger.info(f"Released leadership for '{lease_name}'.")
@@ -0,0 +1,453 @@
+import sqlite3
+import logging
+from datetime import datetime
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def _create_transactions_table(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE transactions (
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id TEXT UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            amount_rub REAL NOT NULL,
+            amount_currency REAL,
+            currency_name TEXT,
+            payment_method TEXT,
+            metadata TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_001_legacy_columns(conn: sqlite3.Connection):
+    columns = _table_columns(conn, "users")
+    if 'referred_by' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
+        logger.info("-> The column 'referred_by' is successfully added.")
+    if 'referral_balance' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
+        logger.info("-> The column 'referral_balance' is successfully added.")
+
+    trans_columns = _table_columns(conn, "transactions")
+    if not trans_columns:
+        _create_transactions_table(conn)
+        logger.info("-> The table 'transactions' has been created.")
+    elif 'payment_id' not in trans_columns or 'status' not in trans_columns:
+        backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        logger.warning(f"The old structure of the 'transactions' table was discovered. Renaming it to '{backup_name}' ...")
+        conn.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
+        _create_transactions_table(conn)
+        logger.info("-> The new table 'transactions' has been created. The old data is saved.")
+
+def _migration_002_vpn_keys_indexes(conn: sqlite3.Connection):
+    # get_user_keys: WHERE user_id = ? ORDER BY key_id
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys (user_id, key_id)")
+    # get_keys_for_host / планировщик
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_name ON vpn_keys (host_name)")
+    # get_daily_stats_for_charts, get_recent_transactions
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_created_date ON vpn_keys (created_date)")
+
+def _migration_003_users_indexes(conn: sqlite3.Connection):
+    # get_referral_count: COUNT(*) целиком по индексу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)")
+    # get_daily_stats_for_charts, get_all_users
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)")
+
+def _migration_004_transactions_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id, created_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created_date ON transactions (created_date)")
+
+STATS_COUNTER_NAMES = ("users_count", "keys_count", "total_spent", "hosts_count")
+
+def reconcile_stats_counters(conn: sqlite3.Connection):
+    """Пересчитывает stats_counters с нуля по исходным таблицам"""
+    conn.executemany(
+        "INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)",
+        [
+            ("users_count", conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]),
+            ("keys_count", conn.execute("SELECT COUNT(*) FROM vpn_keys").fetchone()[0]),
+            ("total_spent", conn.execute("SELECT COALESCE(SUM(total_spent), 0) FROM users").fetchone()[0]),
+            ("hosts_count", conn.execute("SELECT COUNT(*) FROM xui_hosts").fetchone()[0]),
+        ]
+    )
+
+def _migration_005_stats_counters(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # Счетчики обновляются триггерами, поэтому их не обходит ни один путь записи:
+    # ни хендлеры, ни импорт, ни планировщик
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users_count';
+            UPDATE stats_counters SET value = value + COALESCE(NEW.total_spent, 0) WHERE name = 'total_spent';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users_count';
+            UPDATE stats_counters SET value = value - COALESCE(OLD.total_spent, 0) WHERE name = 'total_spent';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_spent AFTER UPDATE OF total_spent ON users
+        BEGIN
+            UPDATE stats_counters
+            SET value = value + COALESCE(NEW.total_spent, 0) - COALESCE(OLD.total_spent, 0)
+            WHERE name = 'total_spent';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_keys_insert AFTER INSERT ON vpn_keys
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'keys_count';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_keys_delete AFTER DELETE ON vpn_keys
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'keys_count';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_hosts_insert AFTER INSERT ON xui_hosts
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'hosts_count';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_hosts_delete AFTER DELETE ON xui_hosts
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'hosts_count';
+        END
+    ''')
+    reconcile_stats_counters(conn)
+
+# Срез выручки: хост и тариф берутся из metadata платежа, для старых
+# платежей без plan_name тариф ищется по plan_id
+_ROLLUP_HOST_SQL = "COALESCE(json_extract({row}.metadata, '$.host_name'), '')"
+_ROLLUP_PLAN_SQL = (
+    "COALESCE(json_extract({row}.metadata, '$.plan_name'), "
+    "(SELECT plan_name FROM plans WHERE plan_id = json_extract({row}.metadata, '$.plan_id')), '')"
+)
+
+def _rollup_upsert_sql(columns: str, values: str, deltas: str) -> str:
+    return f'''
+        INSERT INTO daily_rollups (day, host_name, plan_name, payment_method, {columns})
+        VALUES ({values})
+        ON CONFLICT(day, host_name, plan_name, payment_method) DO UPDATE SET {deltas};
+    '''
+
+def _user_rollup_sql(row: str, sign: int) -> str:
+    return _rollup_upsert_sql(
+        "new_users",
+        f"date({row}.registration_date), '', '', '', {sign}",
+        f"new_users = new_users + ({sign})",
+    )
+
+def _key_rollup_sql(row: str, sign: int) -> str:
+    return _rollup_upsert_sql(
+        "new_keys",
+        f"date({row}.created_date), {row}.host_name, '', '', {sign}",
+        f"new_keys = new_keys + ({sign})",
+    )
+
+def _transaction_rollup_sql(row: str, sign: int) -> str:
+    host = _ROLLUP_HOST_SQL.format(row=row)
+    plan = _ROLLUP_PLAN_SQL.format(row=row)
+    return _rollup_upsert_sql(
+        "revenue, transactions_count",
+        f"date({row}.created_date), {host}, {plan}, COALESCE({row}.payment_method, ''), "
+        f"{sign} * {row}.amount_rub, {sign}",
+        f"revenue = revenue + excluded.revenue, transactions_count = transactions_count + ({sign})",
+    )
+
+def rebuild_daily_rollups(conn: sqlite3.Connection):
+    """Пересобирает daily_rollups с нуля по исходным таблицам"""
+    conn.execute("DELETE FROM daily_rollups")
+    conn.execute('''
+        INSERT INTO daily_rollups (day, host_name, plan_name, payment_method, new_users)
+        SELECT date(registration_date), '', '', '', COUNT(*)
+        FROM users WHERE registration_date IS NOT NULL
+        GROUP BY 1
+    ''')
+    conn.execute('''
+        INSERT INTO daily_rollups (day, host_name, plan_name, payment_method, new_keys)
+        SELECT date(created_date), host_name, '', '', COUNT(*)
+        FROM vpn_keys WHERE created_date IS NOT NULL
+        GROUP BY 1, 2
+    ''')
+    host = _ROLLUP_HOST_SQL.format(row="t")
+    plan = _ROLLUP_PLAN_SQL.format(row="t")
+    conn.execute(f'''
+        INSERT INTO daily_rollups (day, host_name, plan_name, payment_method, revenue, transactions_count)
+        SELECT date(t.created_date), {host}, {plan}, COALESCE(t.payment_method, ''),
+               SUM(t.amount_rub), COUNT(*)
+        FROM transactions t
+        WHERE t.status = 'paid' AND t.created_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT(day, host_name, plan_name, payment_method) DO UPDATE SET
+            revenue = excluded.revenue, transactions_count = excluded.transactions_count
+    ''')
+
+def _migration_006_daily_rollups(conn: sqlite3.Connection):
+    # day идет первым в ключе: графики читают только диапазон последних N дней
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            day TEXT NOT NULL,
+            host_name TEXT NOT NULL DEFAULT '',
+            plan_name TEXT NOT NULL DEFAULT '',
+            payment_method TEXT NOT NULL DEFAULT '',
+            new_users INTEGER NOT NULL DEFAULT 0,
+            new_keys INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            transactions_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, host_name, plan_name, payment_method)
+        ) WITHOUT ROWID
+    ''')
+    triggers = {
+        "trg_rollup_users_insert": ("AFTER INSERT ON users WHEN NEW.registration_date IS NOT NULL",
+                                    _user_rollup_sql("NEW", 1)),
+        "trg_rollup_users_delete": ("AFTER DELETE ON users WHEN OLD.registration_date IS NOT NULL",
+                                    _user_rollup_sql("OLD", -1)),
+        "trg_rollup_users_update": ("AFTER UPDATE OF registration_date ON users "
+                                    "WHEN date(OLD.registration_date) IS NOT date(NEW.registration_date)",
+                                    _user_rollup_sql("OLD", -1) + _user_rollup_sql("NEW", 1)),
+        "trg_rollup_keys_insert": ("AFTER INSERT ON vpn_keys WHEN NEW.created_date IS NOT NULL",
+                                   _key_rollup_sql("NEW", 1)),
+        "trg_rollup_keys_delete": ("AFTER DELETE ON vpn_keys WHEN OLD.created_date IS NOT NULL",
+                                   _key_rollup_sql("OLD", -1)),
+        # Выручка учитывается в момент перехода платежа в статус 'paid'
+        "trg_rollup_transactions_insert": ("AFTER INSERT ON transactions WHEN NEW.status = 'paid'",
+                                           _transaction_rollup_sql("NEW", 1)),
+        "trg_rollup_transactions_paid": ("AFTER UPDATE OF status ON transactions "
+                                         "WHEN NEW.status = 'paid' AND OLD.status IS NOT 'paid'",
+                                         _transaction_rollup_sql("NEW", 1)),
+        "trg_rollup_transactions_delete": ("AFTER DELETE ON transactions WHEN OLD.status = 'paid'",
+                                           _transaction_rollup_sql("OLD", -1)),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+    rebuild_daily_rollups(conn)
+
+# expiry_date хранится как локальное время без зоны (datetime.fromtimestamp),
+# поэтому модификатор 'utc' переводит его в UTC перед расчетом эпохи
+EXPIRY_MS_FROM_DATE_SQL = "CAST(ROUND((julianday(expiry_date, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+
+def _migration_007_vpn_keys_expiry_ms(conn: sqlite3.Connection):
+    if 'expiry_ms' not in _table_columns(conn, "vpn_keys"):
+        conn.execute("ALTER TABLE vpn_keys ADD COLUMN expiry_ms INTEGER")
+    conn.execute(f"UPDATE vpn_keys SET expiry_ms = {EXPIRY_MS_FROM_DATE_SQL} WHERE expiry_date IS NOT NULL")
+    # Ключи, истекающие в окне времени (напоминания, планировщик)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_ms ON vpn_keys (expiry_ms)")
+    # Активные ключи по хосту считаются целиком по индексу; он же заменяет
+    # индекс по одному host_name для get_keys_for_host
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_expiry ON vpn_keys (host_name, expiry_ms)")
+    conn.execute("DROP INDEX IF EXISTS idx_vpn_keys_host_name")
+
+def _migration_008_host_inbound_metadata(conn: sqlite3.Connection):
+    # Параметры reality-инбаунда хоста: ссылка на ключ собирается локально,
+    # без логина в панель, и переживает перезапуск бота
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS host_inbound_metadata (
+            host_name TEXT PRIMARY KEY,
+            host_url TEXT NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            metadata TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_009_host_inbound_pool(conn: sqlite3.Connection):
+    # Пул инбаундов хоста (JSON-массив ID) и лимит клиентов на один инбаунд;
+    # host_inbound_id остается первым инбаундом пула
+    host_columns = _table_columns(conn, "xui_hosts")
+    if 'host_inbound_ids' not in host_columns:
+        conn.execute("ALTER TABLE xui_hosts ADD COLUMN host_inbound_ids TEXT")
+    if 'max_clients_per_inbound' not in host_columns:
+        conn.execute("ALTER TABLE xui_hosts ADD COLUMN max_clients_per_inbound INTEGER")
+    conn.execute("UPDATE xui_hosts SET host_inbound_ids = json_array(host_inbound_id) WHERE host_inbound_ids IS NULL")
+
+    # Инбаунд, на котором живет клиент ключа
+    if 'inbound_id' not in _table_columns(conn, "vpn_keys"):
+        conn.execute("ALTER TABLE vpn_keys ADD COLUMN inbound_id INTEGER")
+    conn.execute('''
+        UPDATE vpn_keys SET inbound_id = (
+            SELECT host_inbound_id FROM xui_hosts WHERE xui_hosts.host_name = vpn_keys.host_name
+        ) WHERE inbound_id IS NULL
+    ''')
+    # Заполненность инбаундов хоста при выборе инбаунда для нового ключа
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_inbound ON vpn_keys (host_name, inbound_id)")
+
+    # Метаданные теперь хранятся по каждому инбаунду; таблица — только кэш,
+    # поэтому старые записи не переносим
+    conn.execute("DROP TABLE IF EXISTS host_inbound_metadata")
+    conn.execute('''
+        CREATE TABLE host_inbound_metadata (
+            host_name TEXT NOT NULL,
+            inbound_id INTEGER NOT NULL,
+            host_url TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (host_name, inbound_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_010_key_traffic(conn: sqlite3.Connection):
+    # Последние накопительные счетчики панели по ключу: от них считаются
+    # приращения трафика, last_online_ms — когда клиент последний раз был в сети
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS key_traffic_counters (
+            key_id INTEGER PRIMARY KEY,
+            up_total INTEGER NOT NULL DEFAULT 0,
+            down_total INTEGER NOT NULL DEFAULT 0,
+            updated_ms INTEGER NOT NULL,
+            last_online_ms INTEGER
+        )
+    ''')
+    # Временной ряд приращений трафика; старые точки сворачиваются в часовые
+    # и суточные корзины (ts выровнен по началу корзины)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS key_traffic (
+            key_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            up INTEGER NOT NULL DEFAULT 0,
+            down INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (key_id, ts)
+        ) WITHOUT ROWID
+    ''')
+    # Прореживание и удаление выбирают точки по времени, а не по ключу
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_key_traffic_ts ON key_traffic (ts)")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_key_traffic_keys_delete AFTER DELETE ON vpn_keys BEGIN
+            DELETE FROM key_traffic WHERE key_id = OLD.key_id;
+            DELETE FROM key_traffic_counters WHERE key_id = OLD.key_id;
+        END
+    ''')
+
+def _migration_011_host_key_versions(conn: sqlite3.Connection):
+    # Номер версии набора ключей хоста растет при любом изменении его ключей.
+    # Планировщик сравнивает его с запомненным и не перечитывает ключи хоста,
+    # если с прошлого цикла ничего не менялось
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS host_key_versions (
+            host_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    bump_sql = (
+        "INSERT INTO host_key_versions (host_name, version) VALUES ({row}.host_name, 1) "
+        "ON CONFLICT(host_name) DO UPDATE SET version = version + 1;"
+    )
+    triggers = {
+        "trg_host_key_versions_insert": ("AFTER INSERT ON vpn_keys", bump_sql.format(row="NEW")),
+        "trg_host_key_versions_delete": ("AFTER DELETE ON vpn_keys", bump_sql.format(row="OLD")),
+        "trg_host_key_versions_update": (
+            "AFTER UPDATE OF host_name, inbound_id, key_email, xui_client_uuid, expiry_ms ON vpn_keys",
+            bump_sql.format(row="OLD") + " " + bump_sql.format(row="NEW"),
+        ),
+    }
+    for name, (event, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END")
+
+def _migration_012_leader_leases(conn: sqlite3.Connection):
+    # Аренда роли ведущего: фоновые задачи выполняет только процесс, который
+    # держит строку аренды и продлевает ее до истечения expires_ms
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leader_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            acquired_ms INTEGER NOT NULL,
+            expires_ms INTEGER NOT NULL
+        )
+    ''')
+
+def _migration_013_settings_version(conn: sqlite3.Connection):
+    # Номер версии настроек растет при любом изменении bot_settings. Процессы,
+    # работающие с общей базой, сверяют его со своим кэшем настроек
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS settings_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)")
+    bump_sql = "UPDATE settings_version SET version = version + 1 WHERE id = 1;"
+    for name, event in {
+        "trg_settings_version_insert": "AFTER INSERT ON bot_settings",
+        "trg_settings_version_update": "AFTER UPDATE ON bot_settings",
+        "trg_settings_version_delete": "AFTER DELETE ON bot_settings",
+    }.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {bump_sql} END")
+
+# Новые миграции добавляются только в конец списка, номера не переиспользуются
+MIGRATIONS: list[tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "legacy_columns", _migration_001_legacy_columns),
+    (2, "vpn_keys_indexes", _migration_002_vpn_keys_indexes),
+    (3, "users_indexes", _migration_003_users_indexes),
+    (4, "transactions_indexes", _migration_004_transactions_indexes),
+    (5, "stats_counters", _migration_005_stats_counters),
+    (6, "daily_rollups", _migration_006_daily_rollups),
+    (7, "vpn_keys_expiry_ms", _migration_007_vpn_keys_expiry_ms),
+    (8, "host_inbound_metadata", _migration_008_host_inbound_metadata),
+    (9, "host_inbound_pool", _migration_009_host_inbound_pool),
+    (10, "key_traffic", _migration_010_key_traffic),
+    (11, "host_key_versions", _migration_011_host_key_versions),
+    (12, "leader_leases", _migration_012_leader_leases),
+    (13, "settings_version", _migration_013_settings_version),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+def analyze(conn: sqlite3.Connection):
+    """Обновляет статистику планировщика запросов SQLite"""
+    conn.execute("ANALYZE")
+    conn.commit()
+    logger.info("ANALYZE completed.")
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """Применяет все еще не примененные миграции, каждую в своей транзакции"""
+    if conn.in_transaction:
+        conn.commit()
+
+    current_version = get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > current_version]
+    if not pending:
+        logger.info(f"Database schema is up to date (version {current_version}).")
+        return current_version
+
+    for version, name, migrate in pending:
+        logger.info(f"Applying migration {version:03d}_{name} ...")
+        conn.execute("BEGIN")
+        try:
+            migrate(conn)
+            conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {version:03d}_{name} failed, rolled back.")
+            raise
+        current_version = version
+
+    analyze(conn)
+    logger.info(f"Database schema migrated to version {current_version}.")
+    return current_version
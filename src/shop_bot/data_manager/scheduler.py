@@ -1,74 +1,379 @@
 import asyncio
 import logging
+import time
 from datetime import datetime
 
-from shop_bot.data_manager import database
-from shop_bot.modules import xui_api
+from shop_bot.config import get_expiry_reminder_text
+from shop_bot.data_manager import async_database, expiry_timers, leader
+from shop_bot.modules import xui_api, host_health, host_placement
 
 CHECK_INTERVAL_SECONDS = 300 
+TRAFFIC_COMPACTION_INTERVAL_SECONDS = 3600
+# Сколько хостов сверяется одновременно и сколько ждать один хост;
+# переопределяются настройками scheduler_host_concurrency и scheduler_host_timeout
+SCHEDULER_HOST_CONCURRENCY = 8
+SCHEDULER_HOST_TIMEOUT_SECONDS = 120
+# Сколько ключей за цикл можно удалить из базы из-за их отсутствия на панели
+# (настройка scheduler_max_deletions). Защищает от массового удаления, когда
+# панель восстановлена из старого бэкапа; остальные удаления ждут следующего цикла
+SCHEDULER_MAX_DELETIONS = 100
+# Как часто проверять, не запустили ли бота, пока напоминания ждут отправки
+EXPIRY_REMINDER_BOT_POLL_SECONDS = 30
 logger = logging.getLogger(__name__)
 
+# host_name -> состояние хоста после прошлой сверки: версия ключей в базе,
+# пул инбаундов, ключи и клиенты панели по инбаундам (email -> (uuid, срок)).
+# Позволяет сравнивать только то, что изменилось с прошлого цикла
+_host_snapshots: dict[str, dict] = {}
+
+def _number_setting(value: str | None, default: float, minimum: float) -> float:
+    try:
+        return max(minimum, float(value)) if value else default
+    except ValueError:
+        return default
+
+async def _get_scheduler_limits() -> tuple[int, float, int]:
+    """Параллелизм, таймаут сверки одного хоста и лимит удалений за цикл
+    из настроек панели администратора"""
+    return (
+        int(_number_setting(await async_database.get_setting("scheduler_host_concurrency"), SCHEDULER_HOST_CONCURRENCY, 1)),
+        _number_setting(await async_database.get_setting("scheduler_host_timeout"), SCHEDULER_HOST_TIMEOUT_SECONDS, 1),
+        int(_number_setting(await async_database.get_setting("scheduler_max_deletions"), SCHEDULER_MAX_DELETIONS, 0)),
+    )
+
+def _panel_clients(inbound: dict) -> dict[str, tuple[str, int]]:
+    return {
+        panel_client['email']: (panel_client['id'], panel_client.get('expiryTime', 0))
+        for panel_client in inbound['settings']['clients']
+    }
+
+def _changed_emails(current: dict, previous: dict) -> set[str]:
+    # Симметрическая разность пар (email, значение): новые, удаленные и измененные
+    return {email for email, _ in current.items() ^ previous.items()}
+
+def _diff_inbound(
+    inbound: dict,
+    keys: dict[str, tuple[int, int]],
+    online_emails: set[str],
+    previous_clients: dict[str, tuple[str, int]] | None = None,
+    previous_keys: dict[str, tuple[int, int]] | None = None,
+) -> dict:
+    """Сопоставляет ключи из базы (email -> (key_id, срок)) с клиентами инбаунда.
+    Если известно состояние прошлого цикла, сравниваются только изменившиеся
+    с тех пор email; иначе — все. Чистая функция без ввода-вывода: на больших
+    инбаундах выполняется вне событийного цикла"""
+    stats = inbound.get('clientStats') or []
+    clients = _panel_clients(inbound)
+    diff = {
+        'clients': clients,
+        'traffic': sum((stat.get('up') or 0) + (stat.get('down') or 0) for stat in stats),
+        'traffic_samples': _traffic_samples(stats, keys, online_emails),
+        # (key_id, key_email, uuid, срок) — срок на панели разошелся с базой
+        'updates': [],
+        # (key_id, key_email) — клиента на панели нет
+        'deletions': [],
+        'orphan_emails': [],
+    }
+    if previous_clients is None or previous_keys is None:
+        emails = clients.keys() | keys.keys()
+    else:
+        emails = _changed_emails(clients, previous_clients) | _changed_emails(keys, previous_keys)
+    for email in emails:
+        db_key = keys.get(email)
+        server_client = clients.get(email)
+        if db_key is None:
+            if server_client is not None:
+                diff['orphan_emails'].append(email)
+        elif server_client is None:
+            diff['deletions'].append((db_key[0], email))
+        elif abs(server_client[1] - db_key[1]) > 1000:
+            diff['updates'].append((db_key[0], email, *server_client))
+    return diff
+
+def _traffic_samples(stats: list[dict], keys: dict[str, tuple[int, int]], online_emails: set[str]) -> list[tuple[int, int, int, bool]]:
+    samples = []
+    for stat in stats:
+        db_key = keys.get(stat.get('email'))
+        if db_key:
+            samples.append((db_key[0], stat.get('up') or 0, stat.get('down') or 0, stat.get('email') in online_emails))
+    return samples
+
+async def _load_host_keys(host: dict, snapshot: dict | None) -> tuple[int | None, dict[int, dict[str, tuple[int, int]]]] | None:
+    """Ключи хоста по инбаундам. Если версия ключей в базе не изменилась
+    с прошлого цикла, берутся из снимка без чтения таблицы ключей"""
+    host_name = host['host_name']
+    if snapshot is not None and await async_database.get_host_keys_version(host_name) == snapshot['version']:
+        return snapshot['version'], snapshot['keys']
+    loaded = await async_database.get_host_keys_snapshot(host_name)
+    if loaded is None:
+        return None
+    version, db_keys = loaded
+    keys_by_inbound: dict[int, dict[str, tuple[int, int]]] = {}
+    for db_key in db_keys:
+        keys_by_inbound.setdefault(db_key['inbound_id'] or host['host_inbound_id'], {})[db_key['key_email']] = (
+            db_key['key_id'], db_key['expiry_ms'] or 0
+        )
+    return version, keys_by_inbound
+
+async def _sync_host(host: dict, deletion_budget: dict, dry_run: bool = False) -> tuple[int, int] | None:
+    """Сверяет все инбаунды хоста: один запрос за списком инбаундов с трафиком
+    и один за клиентами в сети, затем одна транзакция с изменениями по всему
+    хосту. Инбаунд, у которого с прошлого цикла не изменились ни клиенты на
+    панели, ни ключи в базе, не сравнивается вовсе; иначе сравниваются только
+    изменившиеся email. deletion_budget['remaining'] — сколько удалений еще
+    разрешено в этом цикле. В режиме dry_run расхождения только логируются.
+    Возвращает (число измененных записей, трафик клиентов хоста); None — панель не ответила"""
+    host_name = host['host_name']
+    inbounds = await xui_api.fetch_host_inbounds(host)
+    if inbounds is None:
+        logger.error(f"Scheduler: Could not load inbounds of host '{host_name}'. Skipping this host.")
+        return None
+    online_emails = await xui_api.fetch_online_emails(host)
+
+    pool = (tuple(host['inbound_ids']), host['host_inbound_id'])
+    snapshot = _host_snapshots.get(host_name)
+    if snapshot is not None and snapshot['pool'] != pool:
+        snapshot = None
+    loaded = await _load_host_keys(host, snapshot)
+    if loaded is None:
+        logger.error(f"Scheduler: Could not load keys of host '{host_name}'. Skipping this host.")
+        return None
+    version, keys_by_inbound = loaded
+    keys_unchanged = snapshot is not None and version == snapshot['version']
+
+    updates, deletions, traffic_samples = [], [], []
+    total_traffic = skipped_inbounds = 0
+    clients_by_inbound = {}
+    # Инбаунд, убранный из пула, сверяется, пока на нем остаются ключи
+    for inbound_id in dict.fromkeys([*host['inbound_ids'], *keys_by_inbound]):
+        inbound = inbounds.get(inbound_id)
+        if inbound is None:
+            # Не удаляем ключи: инбаунд мог пропасть по ошибке администратора
+            logger.error(f"Scheduler: Inbound {inbound_id} not found on host '{host_name}'. Skipping this inbound.")
+            continue
+        if not dry_run:
+            await xui_api.remember_inbound(xui_api.for_inbound(host, inbound_id), inbound)
+        keys = keys_by_inbound.get(inbound_id, {})
+        previous = snapshot['panel'].get(inbound_id) if snapshot else None
+        digest = inbound.get('settingsDigest')
+
+        if keys_unchanged and previous and digest and previous[0] == digest:
+            stats = inbound.get('clientStats') or []
+            total_traffic += sum((stat.get('up') or 0) + (stat.get('down') or 0) for stat in stats)
+            traffic_samples += _traffic_samples(stats, keys, online_emails)
+            clients_by_inbound[inbound_id] = previous
+            skipped_inbounds += 1
+            continue
+
+        diff = await asyncio.to_thread(
+            _diff_inbound, inbound, keys, online_emails,
+            previous[1] if previous else None,
+            snapshot['keys'].get(inbound_id, {}) if snapshot else None,
+        )
+        logger.info(f"Scheduler: Found {len(diff['clients'])} clients on inbound {inbound_id} of the '{host_name}' panel.")
+        for orphan_email in diff['orphan_emails']:
+            logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on inbound {inbound_id} of host '{host_name}' that is not tracked by the bot.")
+        clients_by_inbound[inbound_id] = (digest, diff['clients'])
+        updates += diff['updates']
+        deletions += diff['deletions']
+        traffic_samples += diff['traffic_samples']
+        total_traffic += diff['traffic']
+    if skipped_inbounds:
+        logger.info(f"Scheduler: {skipped_inbounds} inbounds of host '{host_name}' are unchanged since the last cycle.")
+
+    # Проверка и списание бюджета идут без await между ними, поэтому
+    # параллельно сверяемые хосты не превысят лимит
+    allowed_deletions = min(len(deletions), deletion_budget['remaining'])
+    deletion_budget['remaining'] -= allowed_deletions
+    deletions_deferred = allowed_deletions < len(deletions)
+    if deletions_deferred:
+        logger.warning(
+            f"Scheduler: {len(deletions)} keys of host '{host_name}' are missing on the panel, but only {allowed_deletions} "
+            f"may be deleted this cycle (scheduler_max_deletions). The rest are kept until the next cycle."
+        )
+    deletions = deletions[:allowed_deletions]
+
+    mode = "[dry run] " if dry_run else ""
+    for _, key_email, _, expiry_ms in updates:
+        logger.info(f"Scheduler: {mode}Synced key '{key_email}' for host '{host_name}' (expiry {expiry_ms}).")
+    for _, key_email in deletions:
+        logger.warning(f"Scheduler: {mode}Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
+    if dry_run:
+        return len(updates) + len(deletions), total_traffic
+
+    applied = await async_database.apply_host_sync(
+        host_name,
+        [(key_id, client_uuid, int(expiry_ms)) for key_id, _, client_uuid, expiry_ms in updates],
+        [key_id for key_id, _ in deletions],
+        traffic_samples,
+        # Процесс, потерявший аренду, не должен перезаписать результаты нового ведущего
+        lease=leader.current_lease(),
+    )
+    if applied is None:
+        _host_snapshots.pop(host_name, None)
+        logger.error(f"Scheduler: Could not save sync results for host '{host_name}'. They will be retried next cycle.")
+        return 0, total_traffic
+
+    # Отложенные удаления должны найтись снова, поэтому снимок не сохраняем
+    if deletions_deferred:
+        _host_snapshots.pop(host_name, None)
+    else:
+        version_before, version_after = applied
+        # Снимок ключей приводится к тому, что теперь записано в базе
+        for key_id, key_email, _, expiry_ms in updates:
+            for keys in keys_by_inbound.values():
+                if key_email in keys:
+                    keys[key_email] = (key_id, expiry_ms)
+                    break
+        for _, key_email in deletions:
+            for keys in keys_by_inbound.values():
+                keys.pop(key_email, None)
+        _host_snapshots[host_name] = {
+            # Если между чтением ключей и записью их менял кто-то еще, версия
+            # не совпадет и в следующем цикле ключи будут перечитаны
+            'version': version_after if version_before == version else None,
+            'pool': pool,
+            'keys': keys_by_inbound,
+            'panel': clients_by_inbound,
+        }
+    return len(updates) + len(deletions), total_traffic
+
+async def _check_host(host: dict, semaphore: asyncio.Semaphore, host_timeout: float, deletion_budget: dict, dry_run: bool) -> tuple[int, int] | None:
+    """Сверка одного хоста под общим ограничением параллелизма и с собственным
+    таймаутом, чтобы зависшая панель не задерживала остальные хосты"""
+    host_name = host['host_name']
+    async with semaphore:
+        if host_health.is_open(host_name):
+            logger.warning(f"Scheduler: Host '{host_name}' is unavailable (circuit open). Skipping this host.")
+            return None
+        logger.info(f"Scheduler: Processing host: '{host_name}'")
+        started = time.monotonic()
+        try:
+            synced = await asyncio.wait_for(_sync_host(host, deletion_budget, dry_run), timeout=host_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Scheduler: Host '{host_name}' did not finish within {host_timeout:.0f}s. Skipping it until the next cycle.")
+            return None
+        except Exception as e:
+            logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}", exc_info=True)
+            return None
+        logger.info(f"Scheduler: Host '{host_name}' processed in {time.monotonic() - started:.2f}s.")
+        return synced
+
+async def run_subscription_check_cycle(dry_run: bool = False) -> int:
+    """Один цикл сверки всех хостов с панелями; возвращает число измененных записей.
+    С dry_run=True только сообщает о расхождениях, ничего не записывая в базу"""
+    logger.info(f"Scheduler: Starting {'dry-run ' if dry_run else ''}periodic subscription check cycle...")
+    started = time.monotonic()
+
+    all_hosts = await async_database.get_all_hosts()
+    if not all_hosts:
+        logger.info("Scheduler: No hosts configured in the database. Skipping check.")
+        return 0
+
+    concurrency, host_timeout, max_deletions = await _get_scheduler_limits()
+    semaphore = asyncio.Semaphore(concurrency)
+    deletion_budget = {'remaining': max_deletions}
+    results = await asyncio.gather(*(
+        _check_host(host, semaphore, host_timeout, deletion_budget, dry_run) for host in all_hosts
+    ))
+
+    for host_name in _host_snapshots.keys() - {host['host_name'] for host in all_hosts}:
+        _host_snapshots.pop(host_name, None)
+
+    total_affected_records = 0
+    # host_name -> суммарный трафик клиентов; None — хост в этом цикле не опрошен
+    traffic_by_host = {}
+    for host, synced in zip(all_hosts, results):
+        traffic_by_host[host['host_name']] = None
+        if synced is not None:
+            affected_records, traffic_by_host[host['host_name']] = synced
+            total_affected_records += affected_records
+
+    if dry_run:
+        logger.info(f"Scheduler: Dry run finished in {time.monotonic() - started:.2f}s. Records that would be affected: {total_affected_records}.")
+        return total_affected_records
+    
+    host_placement.update_host_loads(await async_database.get_active_keys_count_by_host(), traffic_by_host)
+    logger.info(
+        f"Scheduler: Cycle finished in {time.monotonic() - started:.2f}s "
+        f"({len(all_hosts)} hosts, up to {concurrency} at a time). Total records affected this cycle: {total_affected_records}."
+    )
+    return total_affected_records
+
 async def periodic_subscription_check():
     logger.info("Scheduler has been started. Initial check will be in a moment.")
     await asyncio.sleep(10)
+    last_traffic_compaction = 0.0
 
     while True:
-        logger.info("Scheduler: Starting periodic subscription check cycle...")
-        total_affected_records = 0
+        await run_subscription_check_cycle()
+        if time.monotonic() - last_traffic_compaction >= TRAFFIC_COMPACTION_INTERVAL_SECONDS:
+            await async_database.compact_key_traffic()
+            last_traffic_compaction = time.monotonic()
+        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
 
-        all_hosts = database.get_all_hosts()
-        if not all_hosts:
-            logger.info("Scheduler: No hosts configured in the database. Skipping check.")
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS)
-            continue
+async def _load_expiry_window(now_ms: int):
+    start_ms, end_ms = expiry_timers.begin_window(now_ms)
+    keys = await async_database.get_keys_expiring_between(start_ms, end_ms)
+    expiry_timers.load_window([(key['key_id'], key['expiry_ms']) for key in keys], now_ms)
 
-        for host in all_hosts:
-            host_name = host['host_name']
-            logger.info(f"Scheduler: Processing host: '{host_name}'")
-            
-            try:
-                api, inbound = xui_api.login_to_host(
-                    host_url=host['host_url'],
-                    username=host['host_username'],
-                    password=host['host_pass'],
-                    inbound_id=host['host_inbound_id']
-                )
-
-                if not api or not inbound:
-                    logger.error(f"Scheduler: Could not log in to host '{host_name}'. Skipping this host.")
-                    continue
-                
-                full_inbound_details = api.inbound.get_by_id(inbound.id)
-                clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
-                logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
-
-                keys_in_db = database.get_keys_for_host(host_name)
-                
-                for db_key in keys_in_db:
-                    key_email = db_key['key_email']
-                    
-                    server_client = clients_on_server.pop(key_email, None)
-
-                    if server_client:
-                        server_expiry_ms = server_client.expiry_time
-                        local_expiry_dt = datetime.fromisoformat(db_key['expiry_date'])
-                        local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
-
-                        if abs(server_expiry_ms - local_expiry_ms) > 1000:
-                            database.update_key_status_from_server(key_email, server_client)
-                            total_affected_records += 1
-                            logger.info(f"Scheduler: Synced key '{key_email}' for host '{host_name}'.")
-                    else:
-                        logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
-                        database.update_key_status_from_server(key_email, None)
-                        total_affected_records += 1
-
-                if clients_on_server:
-                    for orphan_email in clients_on_server.keys():
-                        logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on host '{host_name}' that is not tracked by the bot.")
+async def _send_expiry_reminder(bot, key_id: int, kind: str, expiry_ms: int):
+    # Клавиатуры тянут aiogram; служебные команды планировщика работают и без него
+    from shop_bot.bot import keyboards
+
+    key = await async_database.get_key_by_id(key_id)
+    if key is None:
+        return
+    if key['expiry_ms'] != expiry_ms:
+        # Срок изменили в обход track_key — переставляем таймеры по базе
+        expiry_timers.track_key(key_id, key['expiry_ms'])
+        return
+    user_keys = await async_database.get_user_keys(key['user_id'])
+    key_number = next((i + 1 for i, user_key in enumerate(user_keys) if user_key['key_id'] == key_id), len(user_keys))
+    try:
+        await bot.send_message(
+            chat_id=key['user_id'],
+            text=get_expiry_reminder_text(kind, key_number, datetime.fromtimestamp(expiry_ms / 1000)),
+            reply_markup=keyboards.create_key_info_keyboard(key_id),
+        )
+        logger.info(f"Expiry reminder '{kind}' sent for key {key_id} to user {key['user_id']}.")
+    except Exception as e:
+        logger.warning(f"Could not send expiry reminder '{kind}' for key {key_id} to user {key['user_id']}: {e}")
 
+async def expiry_reminder_loop(bot_controller):
+    """Напоминания «осталось 3 дня / 1 день / срок истек» по таймерам из
+    expiry_timers: спит до ближайшего события, а не сканирует все ключи.
+    Пока бот остановлен, наступившие события ждут его запуска"""
+    wakeup = expiry_timers.bind_loop(asyncio.get_running_loop())
+    logger.info("Expiry reminders have been started.")
+
+    try:
+        while True:
+            wakeup.clear()
+            now_ms = int(time.time() * 1000)
+            try:
+                if now_ms >= expiry_timers.next_window_ms():
+                    await _load_expiry_window(now_ms)
+                bot = bot_controller.get_bot_instance()
+                if bot is not None:
+                    for key_id, kind, expiry_ms in expiry_timers.pop_due(now_ms):
+                        await _send_expiry_reminder(bot, key_id, kind, expiry_ms)
             except Exception as e:
-                logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}", exc_info=True)
-        
-        logger.info(f"Scheduler: Cycle finished. Total records affected this cycle: {total_affected_records}.")
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
\ No newline at end of file
+                logger.error(f"Expiry reminders: unexpected error: {e}", exc_info=True)
+
+            now_ms = int(time.time() * 1000)
+            timeout = (expiry_timers.next_window_ms() - now_ms) / 1000
+            next_fire_ms = expiry_timers.next_fire_ms()
+            if bot_controller.get_bot_instance() is None:
+                # Запуск бота не будит цикл, поэтому проверяем его периодически
+                timeout = min(timeout, EXPIRY_REMINDER_BOT_POLL_SECONDS)
+            elif next_fire_ms is not None:
+                timeout = min(timeout, (next_fire_ms - now_ms) / 1000)
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=max(timeout, 0.1))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Таймеры нужны только работающему циклу: при потере роли ведущего
+        # или остановке они будут построены заново при следующем запуске
+        expiry_timers.reset()
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import logging
+import math
+import tempfile
+import time
+from pathlib import Path
+
+from shop_bot.data_manager import database
+from shop_bot.devtools.fake_xui import FakeXuiPanel
+
+logger = logging.getLogger(__name__)
+
+BENCH_USER_ID = 1
+
+def _percentile(sorted_values: list[float], percent: float) -> float:
+    # Ближайший ранг: для p99 на 100 замерах — 99-й по величине
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+def _report(name: str, latencies_ms: list[float], errors: int, elapsed_s: float):
+    latencies_ms = sorted(latencies_ms)
+    total = len(latencies_ms) + errors
+    print(
+        f"{name:<22} ops={total:<6} errors={errors:<5} "
+        f"throughput={total / elapsed_s if elapsed_s else 0:8.1f}/s  "
+        f"p50={_percentile(latencies_ms, 50):8.1f}ms  p99={_percentile(latencies_ms, 99):8.1f}ms  "
+        f"max={latencies_ms[-1] if latencies_ms else 0:8.1f}ms"
+    )
+
+def _prepare_database(db_dir: Path, panels: list[tuple[str, str, FakeXuiPanel]], inbounds_per_host: int):
+    """Хосты и ключи, совпадающие с заранее созданными клиентами фейковых панелей,
+    чтобы сверка шла по реальному сценарию, а не удаляла «чужие» ключи"""
+    database.PROJECT_ROOT = db_dir
+    database.DB_FILE = db_dir / "users.db"
+    database.initialize_db()
+    with database.get_connection() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, 'benchmark')", (BENCH_USER_ID,))
+        conn.commit()
+    for host_name, url, panel in panels:
+        database.create_host(host_name, url, panel.username, panel.password, list(range(1, inbounds_per_host + 1)))
+        key_rows = [
+            (BENCH_USER_ID, host_name, inbound_id, client['id'], client['email'], client['expiryTime'])
+            for inbound_id, inbound in panel.inbounds.items()
+            for client in inbound['settings']['clients']
+        ]
+        with database.get_connection() as conn:
+            conn.executemany("""
+                INSERT INTO vpn_keys (user_id, host_name, inbound_id, xui_client_uuid, key_email, expiry_ms, expiry_date)
+                VALUES (?1, ?2, ?3, ?4, ?5, ?6, datetime(?6 / 1000, 'unixepoch', 'localtime'))
+            """, key_rows)
+            conn.commit()
+
+async def _bench_purchases(host_names: list[str], purchases: int, concurrency: int):
+    from shop_bot.modules import xui_api
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies_ms: list[float] = []
+    errors = 0
+
+    async def purchase(number: int):
+        nonlocal errors
+        host_name = host_names[number % len(host_names)]
+        async with semaphore:
+            started = time.perf_counter()
+            result = await xui_api.create_or_update_key_on_host(host_name, f"bench-{number}@{host_name}.bot", 30)
+            if result:
+                latencies_ms.append((time.perf_counter() - started) * 1000)
+                await asyncio.to_thread(
+                    database.add_new_key, BENCH_USER_ID, host_name, result['client_uuid'],
+                    result['email'], result['expiry_timestamp_ms'], result['inbound_id']
+                )
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(purchase(number) for number in range(purchases)))
+    _report("create_or_update_key", latencies_ms, errors, time.perf_counter() - started)
+
+async def _bench_scheduler(cycles: int):
+    from shop_bot.data_manager.scheduler import run_subscription_check_cycle
+
+    latencies_ms: list[float] = []
+    started = time.perf_counter()
+    for _ in range(cycles):
+        cycle_started = time.perf_counter()
+        await run_subscription_check_cycle()
+        latencies_ms.append((time.perf_counter() - cycle_started) * 1000)
+    _report("subscription_check", latencies_ms, 0, time.perf_counter() - started)
+
+async def run_benchmark(args: argparse.Namespace):
+    from shop_bot.modules import xui_client
+    from shop_bot.modules import host_health
+
+    clients_per_inbound = math.ceil(args.clients / args.inbounds)
+    runners = []
+    panels = []
+    for number in range(args.hosts):
+        panel = FakeXuiPanel(
+            inbounds=args.inbounds, clients_per_inbound=clients_per_inbound,
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+            email_prefix=f"bench-host{number}", seed=number,
+        )
+        runner, url = await panel.start()
+        runners.append(runner)
+        panels.append((f"bench-host{number}", url, panel))
+
+    with tempfile.TemporaryDirectory(prefix="shop-bot-bench-") as db_dir:
+        await asyncio.to_thread(_prepare_database, Path(db_dir), panels, args.inbounds)
+        print(
+            f"{args.hosts} fake hosts x {args.inbounds} inbounds, {clients_per_inbound * args.inbounds} clients per host; "
+            f"latency {args.latency_ms}±{args.jitter_ms}ms, error rate {args.error_rate:.0%}"
+        )
+        try:
+            await _bench_purchases([host_name for host_name, _, _ in panels], args.purchases, args.concurrency)
+            await _bench_scheduler(args.cycles)
+        finally:
+            await xui_client.close_http_session()
+            for runner in runners:
+                await runner.cleanup()
+            database.close_all_connections()
+
+    requests_by_endpoint: dict[str, int] = {}
+    for _, _, panel in panels:
+        for endpoint, count in panel.request_counts.items():
+            requests_by_endpoint[endpoint] = requests_by_endpoint.get(endpoint, 0) + count
+    print("Panel requests:")
+    for endpoint, count in sorted(requests_by_endpoint.items(), key=lambda item: -item[1]):
+        print(f"  {count:>8}  {endpoint}")
+    sent = sum(panel.bytes_sent for _, _, panel in panels)
+    received = sum(panel.bytes_received for _, _, panel in panels)
+    print(f"Panel traffic: {sent / 1024:.0f} KiB sent, {received / 1024:.0f} KiB received")
+    open_hosts = [host_name for host_name, _, _ in panels if host_health.is_open(host_name)]
+    if open_hosts:
+        print(f"Hosts with open circuit at the end: {', '.join(open_hosts)}")
+
+def main():
+    """Бенчмарк работы с панелями на фейковых хостах: python -m shop_bot.devtools.benchmark"""
+    parser = argparse.ArgumentParser(prog="shop_bot.devtools.benchmark", description="Benchmark panel workflows against fake 3x-ui hosts")
+    parser.add_argument("--hosts", type=int, default=3, help="Number of fake hosts (N)")
+    parser.add_argument("--clients", type=int, default=1000, help="Pre-existing clients per host (M)")
+    parser.add_argument("--inbounds", type=int, default=1, help="Inbounds per host")
+    parser.add_argument("--purchases", type=int, default=300, help="Keys to create via create_or_update_key_on_host")
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent purchases")
+    parser.add_argument("--cycles", type=int, default=3, help="Scheduler reconciliation cycles")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="Show bot logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+        format="%(asctime)s - [%(levelname)s] - %(message)s",
+    )
+    asyncio.run(run_benchmark(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import secrets
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Параметры reality, которые отдает каждый инбаунд фейковой панели
+FAKE_REALITY_SETTINGS = {
+    "settings": {"publicKey": "fake-public-key", "fingerprint": "chrome"},
+    "serverNames": ["fake.example.com"],
+    "shortIds": ["0123abcd"],
+}
+
+class FakeXuiPanel:
+    """Заглушка панели 3x-ui для офлайн-бенчмарков и ручной проверки бота.
+
+    Повторяет те части API, которыми пользуется бот: логин по форме с куки
+    сессии, список/чтение/запись инбаунда, добавление/изменение/удаление
+    клиента, статистику клиента и список клиентов в сети. Как и настоящая
+    панель, без сессии отвечает 404, а поля settings/streamSettings/sniffing
+    отдает JSON-строками. Задержка, доля ошибок (HTTP 500) и размер инбаундов
+    настраиваются."""
+
+    def __init__(
+        self,
+        username: str = "admin",
+        password: str = "admin",
+        inbounds: int = 1,
+        clients_per_inbound: int = 0,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        error_rate: float = 0.0,
+        email_prefix: str = "fake",
+        seed: int | None = None,
+    ):
+        self.username = username
+        self.password = password
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sessions: set[str] = set()
+        # Счетчики запросов по эндпоинтам — для отчетов бенчмарка
+        self.request_counts: dict[str, int] = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.inbounds: dict[int, dict] = {}
+        self.client_stats: dict[str, dict] = {}
+        # Заранее созданные клиенты активны еще 30 дней
+        expiry_ms = int(time.time() * 1000) + 30 * 86_400_000
+        for inbound_id in range(1, inbounds + 1):
+            self.inbounds[inbound_id] = {
+                "id": inbound_id, "remark": f"fake-{inbound_id}", "enable": True,
+                "port": 443 + inbound_id - 1, "protocol": "vless",
+                "settings": {"clients": [], "decryption": "none", "fallbacks": []},
+                "streamSettings": {"network": "tcp", "security": "reality", "realitySettings": FAKE_REALITY_SETTINGS},
+                "sniffing": {"enabled": False},
+            }
+            for number in range(clients_per_inbound):
+                self._add_client(inbound_id, {
+                    "id": str(uuid.uuid4()), "email": f"{email_prefix}-{inbound_id}-{number}@fake.bot",
+                    "enable": True, "expiryTime": expiry_ms, "flow": "xtls-rprx-vision", "totalGB": 0,
+                })
+
+    def client_emails(self, inbound_id: int) -> list[str]:
+        return [client["email"] for client in self.inbounds[inbound_id]["settings"]["clients"]]
+
+    def _add_client(self, inbound_id: int, client: dict):
+        self.inbounds[inbound_id]["settings"]["clients"].append(client)
+        self.client_stats[client["email"]] = {
+            "inboundId": inbound_id, "email": client["email"], "enable": client.get("enable", True),
+            "up": 0, "down": 0, "expiryTime": client.get("expiryTime", 0), "total": 0,
+        }
+
+    def _find_client(self, inbound_id: int, client_uuid: str) -> int | None:
+        clients = self.inbounds[inbound_id]["settings"]["clients"]
+        return next((i for i, client in enumerate(clients) if client["id"] == client_uuid), None)
+
+    def _serialize(self, inbound: dict) -> dict:
+        payload = {
+            **inbound,
+            "settings": json.dumps(inbound["settings"]),
+            "streamSettings": json.dumps(inbound["streamSettings"]),
+            "sniffing": json.dumps(inbound["sniffing"]),
+        }
+        payload["clientStats"] = [
+            self.client_stats[client["email"]] for client in inbound["settings"]["clients"]
+            if client["email"] in self.client_stats
+        ]
+        return payload
+
+    def _ok(self, obj=None) -> web.Response:
+        return web.json_response({"success": True, "msg": "", "obj": obj})
+
+    def _fail(self, msg: str) -> web.Response:
+        return web.json_response({"success": False, "msg": msg, "obj": None})
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        endpoint = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+        self.bytes_received += request.content_length or 0
+        if self.latency_ms or self.jitter_ms:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms))
+            await asyncio.sleep(delay / 1000)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=500, text="fake panel failure")
+        if endpoint != "/login" and request.cookies.get("3x-ui") not in self.sessions:
+            return web.Response(status=404)
+        response = await handler(request)
+        self.bytes_sent += len(response.body or b"")
+        return response
+
+    async def _login(self, request: web.Request):
+        form = await request.post()
+        if form.get("username") != self.username or form.get("password") != self.password:
+            return self._fail("Wrong username or password")
+        token = secrets.token_hex(16)
+        self.sessions.add(token)
+        response = self._ok()
+        response.set_cookie("3x-ui", token)
+        return response
+
+    def _inbound_or_none(self, request: web.Request) -> dict | None:
+        return self.inbounds.get(int(request.match_info["inbound_id"]))
+
+    async def _list(self, request: web.Request):
+        # Клиенты, которые "в сети", понемногу тратят трафик между опросами
+        for stats in self.client_stats.values():
+            if self.random.random() < 0.3:
+                stats["up"] += self.random.randint(0, 5 * 1024 ** 2)
+                stats["down"] += self.random.randint(0, 50 * 1024 ** 2)
+        return self._ok([self._serialize(inbound) for inbound in self.inbounds.values()])
+
+    async def _get(self, request: web.Request):
+        inbound = self._inbound_or_none(request)
+        if inbound is None:
+            return self._fail("Inbound not found")
+        payload = self._serialize(inbound)
+        # Как и 3x-ui, одиночный инбаунд отдается без статистики клиентов
+        payload.pop("clientStats")
+        return self._ok(payload)
+
+    async def _update(self, request: web.Request):
+        inbound = self._inbound_or_none(request)
+        if inbound is None:
+            return self._fail("Inbound not found")
+        data = await request.json()
+        clients = json.loads(data["settings"])["clients"]
+        removed_emails = set(self.client_emails(inbound["id"])) - {client["email"] for client in clients}
+        for email in removed_emails:
+            self.client_stats.pop(email, None)
+        inbound["settings"]["clients"] = []
+        for client in clients:
+            stats = self.client_stats.get(client["email"])
+            self._add_client(inbound["id"], client)
+            if stats:
+                self.client_stats[client["email"]].update(up=stats["up"], down=stats["down"])
+        return self._ok(self._serialize(inbound))
+
+    async def _add_client_route(self, request: web.Request):
+        data = await request.json()
+        inbound = self.inbounds.get(int(data["id"]))
+        if inbound is None:
+            return self._fail("Inbound not found")
+        for client in json.loads(data["settings"])["clients"]:
+            if client["email"] in self.client_stats:
+                return self._fail(f"Duplicate email: {client['email']}")
+            self._add_client(inbound["id"], client)
+        return self._ok()
+
+    async def _update_client(self, request: web.Request):
+        data = await request.json()
+        inbound_id = int(data["id"])
+        if inbound_id not in self.inbounds:
+            return self._fail("Inbound not found")
+        index = self._find_client(inbound_id, request.match_info["client_uuid"])
+        if index is None:
+            return self._fail("Client not found")
+        client = json.loads(data["settings"])["clients"][0]
+        self.inbounds[inbound_id]["settings"]["clients"][index] = client
+        self.client_stats.setdefault(client["email"], {"inboundId": inbound_id, "email": client["email"], "up": 0, "down": 0, "total": 0})
+        self.client_stats[client["email"]].update(expiryTime=client.get("expiryTime", 0), enable=client.get("enable", True))
+        return self._ok()
+
+    async def _delete_client(self, request: web.Request):
+        inbound = self._inbound_or_none(request)
+        if inbound is None:
+            return self._fail("Inbound not found")
+        index = self._find_client(inbound["id"], request.match_info["client_uuid"])
+        if index is None:
+            return self._fail("Client not found")
+        client = inbound["settings"]["clients"].pop(index)
+        self.client_stats.pop(client["email"], None)
+        return self._ok()
+
+    async def _client_traffics(self, request: web.Request):
+        return self._ok(self.client_stats.get(request.match_info["email"]))
+
+    async def _onlines(self, request: web.Request):
+        # Примерно каждый десятый клиент в сети
+        return self._ok([email for email in self.client_stats if zlib.crc32(email.encode()) % 10 == 0])
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_post("/login", self._login)
+        app.router.add_get("/panel/api/inbounds/list", self._list)
+        app.router.add_get("/panel/api/inbounds/get/{inbound_id}", self._get)
+        app.router.add_post("/panel/api/inbounds/update/{inbound_id}", self._update)
+        app.router.add_post("/panel/api/inbounds/addClient", self._add_client_route)
+        app.router.add_post("/panel/api/inbounds/updateClient/{client_uuid}", self._update_client)
+        app.router.add_post("/panel/api/inbounds/{inbound_id}/delClient/{client_uuid}", self._delete_client)
+        app.router.add_get("/panel/api/inbounds/getClientTraffics/{email}", self._client_traffics)
+        app.router.add_post("/panel/api/inbounds/onlines", self._onlines)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+        """Запускает панель в текущем цикле событий; port=0 — любой свободный.
+        Возвращает runner (для cleanup) и URL панели"""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        bound_host, bound_port = runner.addresses[0][:2]
+        return runner, f"http://{bound_host}:{bound_port}"
+
+def main():
+    """Фейковая панель 3x-ui: python -m shop_bot.devtools.fake_xui --port 2053"""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - [%(levelname)s] - %(message)s")
+    parser = argparse.ArgumentParser(prog="shop_bot.devtools.fake_xui", description="Fake 3x-ui panel for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin")
+    parser.add_argument("--inbounds", type=int, default=1, help="Number of inbounds (IDs 1..N)")
+    parser.add_argument("--clients", type=int, default=0, help="Pre-populated clients per inbound")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with HTTP 500")
+    args = parser.parse_args()
+
+    panel = FakeXuiPanel(
+        username=args.username, password=args.password, inbounds=args.inbounds,
+        clients_per_inbound=args.clients, latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+    )
+    logger.info(f"Fake 3x-ui panel on http://{args.host}:{args.port} ({args.inbounds} inbounds x {args.clients} clients)")
+    web.run_app(panel.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Подряд идущих сбоев до размыкания цепи
+CIRCUIT_FAILURE_THRESHOLD = 3
+# Сколько цепь остается разомкнутой до пробного запроса; при повторных
+# неудачах пауза удваивается до максимума
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_MAX_OPEN_SECONDS = 600
+# Вес нового замера в EWMA задержки и доли ошибок
+EWMA_ALPHA = 0.2
+# Хост считается деградировавшим при такой доле ошибок или задержке
+DEGRADED_ERROR_RATE = 0.3
+DEGRADED_LATENCY_MS = 3000
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+_lock = threading.Lock()
+_hosts: dict[str, dict] = {}
+
+def _new_state() -> dict:
+    return {
+        "state": STATE_CLOSED,
+        "consecutive_failures": 0,
+        "open_seconds": CIRCUIT_OPEN_SECONDS,
+        "opened_until": 0.0,
+        "probe_in_flight": False,
+        "ewma_latency_ms": None,
+        "ewma_error_rate": 0.0,
+        "total_requests": 0,
+        "total_failures": 0,
+        "last_error": None,
+    }
+
+def _get(host_name: str) -> dict:
+    return _hosts.setdefault(host_name, _new_state())
+
+def allow_request(host_name: str) -> bool:
+    """Можно ли сейчас обращаться к хосту. После паузы разомкнутая цепь
+    пропускает ровно один пробный запрос (half-open)"""
+    with _lock:
+        health = _get(host_name)
+        if health["state"] == STATE_CLOSED:
+            return True
+        if health["state"] == STATE_OPEN and time.monotonic() >= health["opened_until"]:
+            health["state"] = STATE_HALF_OPEN
+            health["probe_in_flight"] = False
+        if health["state"] == STATE_HALF_OPEN and not health["probe_in_flight"]:
+            health["probe_in_flight"] = True
+            logger.info(f"Circuit for host '{host_name}' is half-open, sending a probe request.")
+            return True
+        return False
+
+def _update_ewma(health: dict, latency_ms: float | None, failed: bool):
+    health["total_requests"] += 1
+    health["ewma_error_rate"] += EWMA_ALPHA * ((1.0 if failed else 0.0) - health["ewma_error_rate"])
+    if latency_ms is not None:
+        if health["ewma_latency_ms"] is None:
+            health["ewma_latency_ms"] = latency_ms
+        else:
+            health["ewma_latency_ms"] += EWMA_ALPHA * (latency_ms - health["ewma_latency_ms"])
+
+def record_success(host_name: str, latency_ms: float):
+    with _lock:
+        health = _get(host_name)
+        _update_ewma(health, latency_ms, failed=False)
+        if health["state"] != STATE_CLOSED:
+            logger.info(f"Circuit for host '{host_name}' closed again.")
+        health.update(state=STATE_CLOSED, consecutive_failures=0, open_seconds=CIRCUIT_OPEN_SECONDS, probe_in_flight=False)
+
+def record_failure(host_name: str, error: Exception, latency_ms: float | None = None):
+    with _lock:
+        health = _get(host_name)
+        _update_ewma(health, latency_ms, failed=True)
+        health["total_failures"] += 1
+        health["consecutive_failures"] += 1
+        health["last_error"] = str(error)[:200]
+
+        if health["state"] == STATE_HALF_OPEN:
+            # Проба не прошла: размыкаем снова на удвоенное время
+            health["open_seconds"] = min(health["open_seconds"] * 2, CIRCUIT_MAX_OPEN_SECONDS)
+        elif health["state"] == STATE_OPEN or health["consecutive_failures"] < CIRCUIT_FAILURE_THRESHOLD:
+            return
+        health.update(state=STATE_OPEN, opened_until=time.monotonic() + health["open_seconds"], probe_in_flight=False)
+        logger.warning(
+            f"Circuit for host '{host_name}' opened for {health['open_seconds']}s "
+            f"after {health['consecutive_failures']} consecutive failures: {health['last_error']}"
+        )
+
+def release_probe(host_name: str):
+    """Пробный запрос прерван без результата (отмена) — разрешаем следующую пробу"""
+    with _lock:
+        health = _hosts.get(host_name)
+        if health:
+            health["probe_in_flight"] = False
+
+def is_open(host_name: str) -> bool:
+    """Цепь разомкнута и пауза еще не истекла: запрос заведомо не пройдет"""
+    with _lock:
+        health = _hosts.get(host_name)
+        return bool(health) and health["state"] == STATE_OPEN and time.monotonic() < health["opened_until"]
+
+def is_degraded(host_name: str) -> bool:
+    with _lock:
+        health = _hosts.get(host_name)
+        if not health:
+            return False
+        return (
+            health["state"] != STATE_CLOSED
+            or health["ewma_error_rate"] >= DEGRADED_ERROR_RATE
+            or (health["ewma_latency_ms"] or 0) >= DEGRADED_LATENCY_MS
+        )
+
+def get_host_health(host_name: str) -> dict:
+    """Снимок состояния хоста для интерфейса и логов"""
+    with _lock:
+        health = dict(_hosts.get(host_name) or _new_state())
+    opened_until = health.pop("opened_until")
+    health["retry_in_seconds"] = max(0, round(opened_until - time.monotonic())) if health["state"] == STATE_OPEN else 0
+    health.pop("probe_in_flight")
+    health["degraded"] = is_degraded(host_name)
+    return health
+
+def get_all_host_health() -> dict[str, dict]:
+    with _lock:
+        host_names = list(_hosts)
+    return {host_name: get_host_health(host_name) for host_name in host_names}
+
+def forget_host(host_name: str):
+    with _lock:
+        _hosts.pop(host_name, None)
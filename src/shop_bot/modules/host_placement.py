@@ -0,0 +1,65 @@
+import logging
+import threading
+
+from shop_bot.modules import host_health
+
+logger = logging.getLogger(__name__)
+
+# Сколько трафика приравнивается к одному активному ключу при оценке загрузки
+TRAFFIC_BYTES_PER_KEY = 50 * 1024 ** 3
+# Каждая секунда средней задержки панели удваивает оценку загрузки хоста
+LATENCY_MS_PER_DOUBLING = 1000
+
+_lock = threading.Lock()
+# host_name -> (активные ключи, трафик в байтах); обновляет планировщик
+_loads: dict[str, tuple[int, int]] = {}
+# Хосты от наименее к наиболее загруженному
+_ranking: list[str] = []
+
+def _score(host_name: str, active_keys: int, traffic_bytes: int) -> tuple[bool, float]:
+    health = host_health.get_host_health(host_name)
+    load = active_keys + 1 + traffic_bytes / TRAFFIC_BYTES_PER_KEY
+    latency_factor = 1 + (health['ewma_latency_ms'] or 0) / LATENCY_MS_PER_DOUBLING
+    # Нестабильные хосты — в конец очереди независимо от загрузки
+    return health['degraded'], load * latency_factor
+
+def _rerank():
+    _ranking[:] = sorted(_loads, key=lambda host_name: _score(host_name, *_loads[host_name]))
+
+def update_host_loads(active_keys_by_host: dict[str, int], traffic_by_host: dict[str, int | None]):
+    """Пересчитывает таблицу загрузки по данным очередного цикла планировщика.
+    Трафик None означает, что хост в этом цикле не опрашивался — берем прежний"""
+    with _lock:
+        previous = dict(_loads)
+        _loads.clear()
+        for host_name, traffic_bytes in traffic_by_host.items():
+            if traffic_bytes is None:
+                traffic_bytes = previous.get(host_name, (0, 0))[1]
+            _loads[host_name] = (active_keys_by_host.get(host_name, 0), traffic_bytes)
+        _rerank()
+    logger.info(f"Host placement ranking updated: {_ranking}")
+
+def note_placement(host_name: str):
+    """Учитывает выданный ключ сразу, не дожидаясь следующего цикла планировщика,
+    чтобы поток новых ключей не уходил целиком на один хост"""
+    with _lock:
+        if host_name in _loads:
+            active_keys, traffic_bytes = _loads[host_name]
+            _loads[host_name] = (active_keys + 1, traffic_bytes)
+            _rerank()
+
+def pick_host(host_names: list[str]) -> str | None:
+    """Наименее загруженный доступный хост из переданных. None — таблица еще
+    не заполнена планировщиком или все хосты недоступны"""
+    allowed = set(host_names)
+    with _lock:
+        ranking = list(_ranking)
+    for host_name in ranking:
+        if host_name in allowed and not host_health.is_open(host_name):
+            return host_name
+    return None
+
+def forget_host(host_name: str):
+    with _lock:
+        if _loads.pop(host_name, None) is not None:
+            _rerank()
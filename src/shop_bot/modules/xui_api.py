@@ -1,137 +1,398 @@
+import asyncio
 import uuid
 from datetime import datetime, timedelta
 import logging
+import threading
+import time
 from urllib.parse import urlparse
-from typing import List, Dict
+from typing import Awaitable, Callable, Dict, TypeVar
 
-from py3xui import Api, Client, Inbound
-
-from shop_bot.data_manager.database import get_host
+from shop_bot.modules import host_health
+from shop_bot.modules.xui_client import (
+    XuiClient, XuiAuthError, XuiError, XuiConnectionError, XuiCircuitOpenError, make_timeout,
+    XUI_CONNECT_TIMEOUT_SECONDS, XUI_READ_TIMEOUT_SECONDS,
+)
+from shop_bot.data_manager.async_database import get_host, get_setting, save_inbound_metadata, get_inbound_client_counts
+from shop_bot.data_manager.async_database import get_inbound_metadata as load_inbound_metadata
 
 logger = logging.getLogger(__name__)
 
-def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+T = TypeVar("T")
+
+# 3x-ui по умолчанию держит сессию 60 минут; перелогиниваемся заранее
+XUI_SESSION_TTL_SECONDS = 30 * 60
+# Одновременных запросов к одному инбаунду при массовом продлении
+BULK_CLIENT_CONCURRENCY = 8
+
+_sessions_lock = threading.Lock()
+# host_name -> (отпечаток учетных данных, момент истечения, залогиненный клиент)
+_sessions: dict[str, tuple[tuple, float, XuiClient]] = {}
+
+def _host_fingerprint(host_data: dict, timeouts: tuple[float, float]) -> tuple:
+    return host_data['host_url'], host_data['host_username'], host_data['host_pass'], timeouts
+
+def _float_setting(value: str | None, default: float) -> float:
     try:
-        api = Api(host=host_url, username=username, password=password)
-        api.login()
-        inbounds: List[Inbound] = api.inbound.get_list()
-        target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
-        
+        return float(value) if value else default
+    except ValueError:
+        return default
+
+async def _get_panel_timeouts() -> tuple[float, float]:
+    """Таймауты подключения и чтения из настроек панели администратора"""
+    return (
+        _float_setting(await get_setting("xui_connect_timeout"), XUI_CONNECT_TIMEOUT_SECONDS),
+        _float_setting(await get_setting("xui_read_timeout"), XUI_READ_TIMEOUT_SECONDS),
+    )
+
+async def _tracked(host_name: str, call: Callable[[], Awaitable[T]]) -> T:
+    """Запрос к панели через предохранитель хоста: при разомкнутой цепи не
+    отправляется вовсе, иначе его исход и задержка обновляют здоровье хоста.
+    Сбоем считаются только таймауты, сетевые ошибки и HTTP 5xx — ответ панели
+    с ошибкой (дубликат email, протухшая сессия) говорит о том, что она жива"""
+    if not host_health.allow_request(host_name):
+        raise XuiCircuitOpenError(f"Host '{host_name}' is temporarily unavailable (circuit open)")
+    started = time.monotonic()
+    try:
+        result = await call()
+    except XuiConnectionError as e:
+        host_health.record_failure(host_name, e, (time.monotonic() - started) * 1000)
+        raise
+    except XuiError:
+        host_health.record_success(host_name, (time.monotonic() - started) * 1000)
+        raise
+    except BaseException:
+        host_health.release_probe(host_name)
+        raise
+    host_health.record_success(host_name, (time.monotonic() - started) * 1000)
+    return result
+
+def invalidate_host_session(host_name: str):
+    """Сбрасывает сессию хоста (после редактирования/удаления или ошибки авторизации)"""
+    with _sessions_lock:
+        _sessions.pop(host_name, None)
+
+def clear_host_sessions():
+    with _sessions_lock:
+        _sessions.clear()
+
+async def get_host_session(host_data: dict) -> XuiClient:
+    """Залогиненный клиент для хоста из пула; логин выполняется только при
+    отсутствии сессии, истечении TTL или смене учетных данных хоста"""
+    host_name = host_data['host_name']
+    timeouts = await _get_panel_timeouts()
+    fingerprint = _host_fingerprint(host_data, timeouts)
+    with _sessions_lock:
+        entry = _sessions.get(host_name)
+    if entry and entry[0] == fingerprint and entry[1] > time.monotonic() and entry[2].is_logged_in:
+        return entry[2]
+
+    # Одновременные промахи могут залогиниться дважды — это безвредно,
+    # в пуле останется последняя сессия
+    client = XuiClient(host_data['host_url'], host_data['host_username'], host_data['host_pass'], make_timeout(*timeouts))
+    await _tracked(host_name, client.login)
+    with _sessions_lock:
+        _sessions[host_name] = (fingerprint, time.monotonic() + XUI_SESSION_TTL_SECONDS, client)
+    logger.info(f"Logged in to host '{host_name}', session cached.")
+    return client
+
+async def _call_with_session(host_data: dict, operation: Callable[[XuiClient], Awaitable[T]]) -> T:
+    """Выполняет запрос к панели через сессию из пула. Если сессия протухла
+    раньше TTL (перезапуск панели, смена пароля), логинится заново один раз"""
+    host_name = host_data['host_name']
+    client = await get_host_session(host_data)
+    try:
+        return await _tracked(host_name, lambda: operation(client))
+    except XuiAuthError as e:
+        logger.warning(f"Session for host '{host_name}' expired ({e}), re-authenticating...")
+        invalidate_host_session(host_name)
+        client = await get_host_session(host_data)
+        return await _tracked(host_name, lambda: operation(client))
+
+def for_inbound(host_data: dict, inbound_id: int | None) -> dict:
+    """Данные хоста, привязанные к одному инбаунду из его пула. Все функции
+    модуля работают с инбаундом host_data['host_inbound_id']"""
+    if inbound_id is None or inbound_id == host_data['host_inbound_id']:
+        return host_data
+    return {**host_data, 'host_inbound_id': inbound_id}
+
+def _inbound_key(host_data: dict) -> tuple[str, int]:
+    return host_data['host_name'], host_data['host_inbound_id']
+
+async def choose_inbound(host_data: dict) -> int:
+    """Наименее заполненный инбаунд пула хоста для нового клиента"""
+    inbound_ids = host_data.get('inbound_ids') or [host_data['host_inbound_id']]
+    counts = await get_inbound_client_counts(host_data['host_name'])
+    inbound_id = min(inbound_ids, key=lambda candidate: counts.get(candidate, 0))
+    max_clients = host_data.get('max_clients_per_inbound')
+    if max_clients and counts.get(inbound_id, 0) >= max_clients:
+        # Лимит мягкий: оплаченный ключ важнее, но администратору пора добавить инбаунд
+        logger.error(
+            f"All inbounds of host '{host_data['host_name']}' reached the limit of {max_clients} clients, "
+            f"placing the client on inbound {inbound_id} anyway."
+        )
+    return inbound_id
+
+async def login_to_host(host_data: dict) -> tuple[XuiClient | None, dict | None]:
+    host_name = host_data['host_name']
+    inbound_id = host_data['host_inbound_id']
+    try:
+        target_inbound = await _call_with_session(host_data, lambda client: client.get_inbound(inbound_id))
+        client = await get_host_session(host_data)
+
         if target_inbound is None:
-            logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
-            return api, None
-        return api, target_inbound
+            logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_name}'")
+            return client, None
+        return client, target_inbound
+    except XuiCircuitOpenError as e:
+        logger.warning(f"Skipping inbound retrieval: {e}")
+        return None, None
     except Exception as e:
-        logger.error(f"Login or inbound retrieval failed for host '{host_url}': {e}", exc_info=True)
+        invalidate_host_session(host_name)
+        logger.error(f"Login or inbound retrieval failed for host '{host_name}': {e}", exc_info=True)
         return None, None
 
-def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+async def fetch_host_inbounds(host_data: dict) -> dict[int, dict] | None:
+    """Все инбаунды панели одним запросом (со счетчиками трафика клиентов
+    clientStats, которых нет в ответе на запрос одного инбаунда)"""
+    host_name = host_data['host_name']
+    try:
+        inbounds = await _call_with_session(host_data, lambda client: client.get_inbounds())
+        return {inbound['id']: inbound for inbound in inbounds}
+    except XuiCircuitOpenError as e:
+        logger.warning(f"Skipping inbound list retrieval: {e}")
+        return None
+    except Exception as e:
+        invalidate_host_session(host_name)
+        logger.error(f"Inbound list retrieval failed for host '{host_name}': {e}", exc_info=True)
+        return None
+
+async def fetch_online_emails(host_data: dict) -> set[str]:
+    """Email клиентов хоста, которые сейчас в сети; при ошибке — пустое множество"""
+    try:
+        return set(await _call_with_session(host_data, lambda client: client.get_online_clients()))
+    except Exception as e:
+        logger.warning(f"Could not get online clients of host '{host_data['host_name']}': {e}")
+        return set()
+
+def extract_inbound_metadata(inbound: dict) -> dict | None:
+    """Параметры reality-инбаунда, общие для всех его клиентов"""
     if not inbound: return None
-    settings = inbound.stream_settings.reality_settings.get("settings")
+    reality_settings = inbound.get('streamSettings', {}).get('realitySettings') or {}
+    settings = reality_settings.get("settings")
     if not settings: return None
-    
-    public_key = settings.get("publicKey")
-    fp = settings.get("fingerprint")
-    server_names = inbound.stream_settings.reality_settings.get("serverNames")
-    short_ids = inbound.stream_settings.reality_settings.get("shortIds")
-    port = inbound.port
-    
-    if not all([public_key, server_names, short_ids]): return None
-    
+
+    metadata = {
+        "port": inbound.get('port'),
+        "public_key": settings.get("publicKey"),
+        "fingerprint": settings.get("fingerprint"),
+        "server_names": reality_settings.get("serverNames"),
+        "short_ids": reality_settings.get("shortIds"),
+    }
+    if not all([metadata["public_key"], metadata["server_names"], metadata["short_ids"]]): return None
+    return metadata
+
+def render_connection_string(metadata: dict, user_uuid: str, host_url: str, remark: str) -> str | None:
+    if not metadata: return None
     parsed_url = urlparse(host_url)
-    short_id = short_ids[0]
-    
+
     connection_string = (
-        f"vless://{user_uuid}@{parsed_url.hostname}:{port}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp={fp}&sni={server_names[0]}"
-        f"&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{remark}"
+        f"vless://{user_uuid}@{parsed_url.hostname}:{metadata['port']}"
+        f"?type=tcp&security=reality&pbk={metadata['public_key']}&fp={metadata['fingerprint']}"
+        f"&sni={metadata['server_names'][0]}&sid={metadata['short_ids'][0]}"
+        f"&spx=%2F&flow=xtls-rprx-vision#{remark}"
     )
     return connection_string
 
-def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days_to_add: int) -> tuple[str | None, int | None]:
-    try:
-        inbound_to_modify = api.inbound.get_by_id(inbound_id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound_id}")
-
-        if inbound_to_modify.settings.clients is None:
-            inbound_to_modify.settings.clients = []
-            
-        client_index = -1
-        for i, client in enumerate(inbound_to_modify.settings.clients):
-            if client.email == email:
-                client_index = i
-                break
-        
-        if client_index != -1:
-            existing_client = inbound_to_modify.settings.clients[client_index]
-            if existing_client.expiry_time > int(datetime.now().timestamp() * 1000):
-                current_expiry_dt = datetime.fromtimestamp(existing_client.expiry_time / 1000)
-                new_expiry_dt = current_expiry_dt + timedelta(days=days_to_add)
-            else:
-                new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
-        else:
-            new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
+def get_connection_string(inbound: dict, user_uuid: str, host_url: str, remark: str) -> str | None:
+    return render_connection_string(extract_inbound_metadata(inbound), user_uuid, host_url, remark)
+
+# (host_name, inbound_id) -> (host_url, metadata); копия таблицы host_inbound_metadata в памяти
+_inbound_metadata_lock = threading.Lock()
+_inbound_metadata_cache: dict[tuple[str, int], tuple[str, dict]] = {}
+
+def invalidate_inbound_metadata(host_name: str):
+    with _inbound_metadata_lock:
+        for key in [key for key in _inbound_metadata_cache if key[0] == host_name]:
+            del _inbound_metadata_cache[key]
+
+async def remember_inbound_metadata(host_data: dict, inbound: dict) -> dict | None:
+    """Обновляет кэш метаданных инбаунда по свежему ответу панели"""
+    metadata = extract_inbound_metadata(inbound)
+    if not metadata:
+        return None
+    entry = (host_data['host_url'], metadata)
+    with _inbound_metadata_lock:
+        cached = _inbound_metadata_cache.get(_inbound_key(host_data))
+        _inbound_metadata_cache[_inbound_key(host_data)] = entry
+    if cached != entry:
+        await save_inbound_metadata(host_data['host_name'], host_data['host_url'], host_data['host_inbound_id'], metadata)
+    return metadata
+
+async def get_inbound_metadata(host_data: dict, refresh: bool = False) -> dict | None:
+    """Метаданные инбаунда: память -> БД -> панель (только при промахе или refresh=True).
+    Запись считается устаревшей, если у хоста сменился URL"""
+    key = _inbound_key(host_data)
+    if not refresh:
+        with _inbound_metadata_lock:
+            cached = _inbound_metadata_cache.get(key)
+        if cached and cached[0] == host_data['host_url']:
+            return cached[1]
 
-        new_expiry_ms = int(new_expiry_dt.timestamp() * 1000)
+        stored = await load_inbound_metadata(*key)
+        if stored and stored['host_url'] == host_data['host_url']:
+            with _inbound_metadata_lock:
+                _inbound_metadata_cache[key] = (stored['host_url'], stored['metadata'])
+            return stored['metadata']
 
-        if client_index != -1:
-            inbound_to_modify.settings.clients[client_index].expiry_time = new_expiry_ms
-            inbound_to_modify.settings.clients[client_index].total_gb = 0
-            inbound_to_modify.settings.clients[client_index].enable = True
-            
-            client_uuid = inbound_to_modify.settings.clients[client_index].id
+    client, inbound = await login_to_host(host_data)
+    if not client or not inbound:
+        return None
+    return await remember_inbound(host_data, inbound)
+
+# (host_name, inbound_id) -> (host_url, {email: клиент}); индекс клиентов инбаунда,
+# чтобы покупка не скачивала весь инбаунд ради поиска клиента по email
+_client_index_lock = threading.Lock()
+_client_index: dict[tuple[str, int], tuple[str, dict[str, dict]]] = {}
+
+def invalidate_client_index(host_name: str):
+    with _client_index_lock:
+        for key in [key for key in _client_index if key[0] == host_name]:
+            del _client_index[key]
+
+def remember_inbound_clients(host_data: dict, inbound: dict):
+    """Пересобирает индекс email -> клиент по свежему ответу панели"""
+    clients = {panel_client['email']: panel_client for panel_client in inbound['settings']['clients']}
+    with _client_index_lock:
+        _client_index[_inbound_key(host_data)] = (host_data['host_url'], clients)
+
+async def remember_inbound(host_data: dict, inbound: dict) -> dict | None:
+    remember_inbound_clients(host_data, inbound)
+    return await remember_inbound_metadata(host_data, inbound)
+
+def _index_client(host_data: dict, panel_client: dict | None, email: str):
+    with _client_index_lock:
+        entry = _client_index.get(_inbound_key(host_data))
+        if not entry or entry[0] != host_data['host_url']:
+            return
+        if panel_client is None:
+            entry[1].pop(email, None)
         else:
-            client_uuid = str(uuid.uuid4())
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=True,
-                expiry_time=new_expiry_ms,
-                flow="xtls-rprx-vision",
-                total_gb=0
-            )
-            inbound_to_modify.settings.clients.append(new_client)
+            entry[1][email] = panel_client
+
+async def find_panel_client(host_data: dict, email: str, refresh: bool = False) -> dict | None:
+    """Клиент панели по email из индекса; инбаунд скачивается только при
+    отсутствии индекса для инбаунда (или refresh=True)"""
+    if not refresh:
+        with _client_index_lock:
+            entry = _client_index.get(_inbound_key(host_data))
+        if entry and entry[0] == host_data['host_url']:
+            return entry[1].get(email)
+
+    client, inbound = await login_to_host(host_data)
+    if not client or not inbound:
+        raise XuiError(f"Could not load inbound {host_data['host_inbound_id']} of host '{host_data['host_name']}'")
+    await remember_inbound(host_data, inbound)
+    with _client_index_lock:
+        return _client_index[_inbound_key(host_data)][1].get(email)
+
+def _new_expiry_ms(current_expiry_ms: int, days_to_add: int) -> int:
+    now = datetime.now()
+    if current_expiry_ms > int(now.timestamp() * 1000):
+        new_expiry_dt = datetime.fromtimestamp(current_expiry_ms / 1000) + timedelta(days=days_to_add)
+    else:
+        new_expiry_dt = now + timedelta(days=days_to_add)
+    return int(new_expiry_dt.timestamp() * 1000)
 
-        api.inbound.update(inbound_id, inbound_to_modify)
+async def _extend_panel_client(host_data: dict, existing_client: dict, email: str, days_to_add: int) -> tuple[str, int] | None:
+    # Актуальный срок берем из статистики клиента (O(1)), а не из индекса:
+    # его могли поменять в панели вручную
+    traffic = await _call_with_session(host_data, lambda client: client.get_client_traffics(email))
+    if traffic is None:
+        # Клиента удалили в панели — индекс устарел
+        _index_client(host_data, None, email)
+        return None
+
+    new_expiry_ms = _new_expiry_ms(traffic.get('expiryTime', 0), days_to_add)
+    updated_client = {**existing_client, "expiryTime": new_expiry_ms, "totalGB": 0, "enable": True}
+    client_uuid = updated_client['id']
+    await _call_with_session(
+        host_data, lambda client: client.update_client(host_data['host_inbound_id'], client_uuid, updated_client)
+    )
+    _index_client(host_data, updated_client, email)
+    return client_uuid, new_expiry_ms
+
+async def _add_panel_client(host_data: dict, email: str, days_to_add: int) -> tuple[str, int]:
+    new_expiry_ms = _new_expiry_ms(0, days_to_add)
+    client_uuid = str(uuid.uuid4())
+    new_client = {
+        "id": client_uuid,
+        "email": email,
+        "enable": True,
+        "expiryTime": new_expiry_ms,
+        "flow": "xtls-rprx-vision",
+        "totalGB": 0,
+    }
+    await _call_with_session(host_data, lambda client: client.add_client(host_data['host_inbound_id'], new_client))
+    _index_client(host_data, new_client, email)
+    return client_uuid, new_expiry_ms
 
-        return client_uuid, new_expiry_ms
+async def update_or_create_client_on_panel(host_data: dict, email: str, days_to_add: int) -> tuple[str | None, int | None]:
+    """Создает или продлевает одного клиента через addClient/updateClient:
+    объем запросов не зависит от числа клиентов на инбаунде"""
+    try:
+        existing_client = await find_panel_client(host_data, email)
+        result = None
+        if existing_client:
+            result = await _extend_panel_client(host_data, existing_client, email, days_to_add)
+        if result is None:
+            try:
+                result = await _add_panel_client(host_data, email, days_to_add)
+            except XuiAuthError:
+                raise
+            except XuiError:
+                # Клиента с таким email добавили в панели в обход бота — индекс
+                # устарел; перечитываем его один раз и продлеваем найденного клиента
+                existing_client = await find_panel_client(host_data, email, refresh=True)
+                if not existing_client:
+                    raise
+                result = await _extend_panel_client(host_data, existing_client, email, days_to_add)
+                if result is None:
+                    raise
+        return result
 
     except Exception as e:
+        invalidate_client_index(host_data['host_name'])
         logger.error(f"Error in update_or_create_client_on_panel: {e}", exc_info=True)
         return None, None
 
-async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int) -> Dict | None:
-    host_data = get_host(host_name)
+async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int, inbound_id: int | None = None) -> Dict | None:
+    """Создает или продлевает клиента. Существующий ключ продлевается на своем
+    инбаунде (inbound_id), новый размещается на наименее заполненном инбаунде хоста"""
+    host_data = await get_host(host_name)
     if not host_data:
         logger.error(f"Workflow failed: Host '{host_name}' not found in the database.")
         return None
+    if inbound_id is None:
+        inbound_id = await choose_inbound(host_data)
+    host_data = for_inbound(host_data, inbound_id)
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-    if not api or not inbound:
-        logger.error(f"Workflow failed: Could not log in or find inbound on host '{host_name}'.")
-        return None
-        
-    client_uuid, new_expiry_ms = update_or_create_client_on_panel(api, inbound.id, email, days_to_add)
+    client_uuid, new_expiry_ms = await update_or_create_client_on_panel(host_data, email, days_to_add)
     if not client_uuid:
         logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}'.")
         return None
-    
-    connection_string = get_connection_string(inbound, client_uuid, host_data['host_url'], remark=host_name)
-    
+
+    metadata = await get_inbound_metadata(host_data)
+    connection_string = render_connection_string(metadata, client_uuid, host_data['host_url'], remark=host_name)
+
     logger.info(f"Successfully processed key for '{email}' on host '{host_name}'.")
-    
+
     return {
         "client_uuid": client_uuid,
         "email": email,
         "expiry_timestamp_ms": new_expiry_ms,
         "connection_string": connection_string,
-        "host_name": host_name
+        "host_name": host_name,
+        "inbound_id": inbound_id
     }
 
 async def get_key_details_from_host(key_data: dict) -> dict | None:
@@ -140,50 +401,107 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         logger.error(f"Could not get key details: host_name is missing for key_id {key_data.get('key_id')}")
         return None
 
-    host_db_data = get_host(host_name)
+    host_db_data = await get_host(host_name)
     if not host_db_data:
         logger.error(f"Could not get key details: Host '{host_name}' not found in the database.")
         return None
+    host_db_data = for_inbound(host_db_data, key_data.get('inbound_id'))
 
-    api, inbound = login_to_host(
-        host_url=host_db_data['host_url'],
-        username=host_db_data['host_username'],
-        password=host_db_data['host_pass'],
-        inbound_id=host_db_data['host_inbound_id']
-    )
-    if not api or not inbound: return None
+    # Ссылка собирается локально из кэша метаданных, панель нужна только при промахе
+    metadata = await get_inbound_metadata(host_db_data)
+    if not metadata: return None
 
-    connection_string = get_connection_string(inbound, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
+    connection_string = render_connection_string(metadata, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
     return {"connection_string": connection_string}
 
-async def delete_client_on_host(host_name: str, client_email: str) -> bool:
-    host_data = get_host(host_name)
+async def delete_client_on_host(host_name: str, client_email: str, inbound_id: int | None = None) -> bool:
+    host_data = await get_host(host_name)
     if not host_data:
         logger.error(f"Cannot delete client: Host '{host_name}' not found.")
         return False
+    host_data = for_inbound(host_data, inbound_id)
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-
-    if not api or not inbound:
-        logger.error(f"Cannot delete client: Login or inbound lookup failed for host '{host_name}'.")
-        return False
-        
     try:
-        client_to_delete = api.client.get_by_email(client_email)
-        
+        client_to_delete = await find_panel_client(host_data, client_email)
+
         if client_to_delete:
-            api.client.delete(inbound.id, client_to_delete.id)
+            await _call_with_session(
+                host_data, lambda client: client.delete_client(host_data['host_inbound_id'], client_to_delete['id'])
+            )
+            _index_client(host_data, None, client_email)
             logger.info(f"Successfully deleted client '{client_email}' from host '{host_name}'.")
             return True
         else:
             logger.warning(f"Client '{client_email}' not found on host '{host_name}' for deletion (already gone).")
             return True
-            
+
     except Exception as e:
+        invalidate_client_index(host_name)
         logger.error(f"Failed to delete client '{client_email}' from host '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
+
+async def _bulk_extend_host_clients(host_name: str, inbound_id: int | None, changes: list[tuple[str, int]]) -> dict[str, dict]:
+    host_data = await get_host(host_name)
+    if not host_data:
+        return {email: {"success": False, "message": f"Хост '{host_name}' не найден"} for email, _ in changes}
+    host_data = for_inbound(host_data, inbound_id)
+
+    client, inbound = await login_to_host(host_data)
+    if not client or not inbound:
+        return {email: {"success": False, "message": "Не удалось подключиться к панели"} for email, _ in changes}
+
+    # Инбаунд читается один раз ради текущих сроков, а пишется каждый клиент
+    # отдельно: запись инбаунда целиком стерла бы клиентов, добавленных
+    # покупками между чтением и записью
+    clients_by_email = {panel_client.get('email'): panel_client for panel_client in inbound['settings']['clients']}
+    semaphore = asyncio.Semaphore(BULK_CLIENT_CONCURRENCY)
+
+    async def extend(email: str, days_to_add: int) -> tuple[str, dict]:
+        panel_client = clients_by_email.get(email)
+        async with semaphore:
+            try:
+                if panel_client is None:
+                    # Как и одиночное продление, пересоздаем пропавшего в панели клиента
+                    client_uuid, new_expiry_ms = await _add_panel_client(host_data, email, days_to_add)
+                else:
+                    new_expiry_ms = _new_expiry_ms(panel_client.get('expiryTime', 0), days_to_add)
+                    updated_client = {**panel_client, "expiryTime": new_expiry_ms, "totalGB": 0, "enable": True}
+                    client_uuid = updated_client['id']
+                    await _call_with_session(
+                        host_data, lambda xui: xui.update_client(host_data['host_inbound_id'], client_uuid, updated_client)
+                    )
+                    _index_client(host_data, updated_client, email)
+            except Exception as e:
+                logger.error(f"Failed to extend client '{email}' on inbound {host_data['host_inbound_id']} of host '{host_name}': {e}")
+                return email, {"success": False, "message": "Ошибка при обновлении клиента"}
+        return email, {"success": True, "client_uuid": client_uuid, "expiry_timestamp_ms": new_expiry_ms}
+
+    results = dict(await asyncio.gather(*(extend(email, days_to_add) for email, days_to_add in changes)))
+    failed = sum(1 for result in results.values() if not result['success'])
+    if failed:
+        invalidate_client_index(host_name)
+    logger.info(
+        f"Bulk-updated {len(changes) - failed} of {len(changes)} clients on inbound {host_data['host_inbound_id']} of host '{host_name}'."
+    )
+    return results
+
+async def bulk_extend_clients(changes: list[tuple[str, int | None, str, int]]) -> dict[str, dict]:
+    """Массово сдвигает срок клиентов: changes — (host_name, inbound_id, email, days_to_add).
+
+    Изменения группируются по инбаунду: на каждый инбаунд одно чтение и по
+    запросу updateClient/addClient на клиента (не больше BULK_CLIENT_CONCURRENCY
+    одновременно) через сессию хоста из пула, инбаунды обрабатываются параллельно.
+    Возвращает результат по каждому email: success, client_uuid,
+    expiry_timestamp_ms или message с ошибкой.
+    """
+    by_inbound: dict[tuple[str, int | None], list[tuple[str, int]]] = {}
+    for host_name, inbound_id, email, days_to_add in changes:
+        by_inbound.setdefault((host_name, inbound_id), []).append((email, days_to_add))
+
+    results = {}
+    for host_results in await asyncio.gather(*(
+        _bulk_extend_host_clients(host_name, inbound_id, inbound_changes)
+        for (host_name, inbound_id), inbound_changes in by_inbound.items()
+    )):
+        results.update(host_results)
+    return results
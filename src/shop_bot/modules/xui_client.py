@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+XUI_CONNECT_TIMEOUT_SECONDS = 5
+XUI_READ_TIMEOUT_SECONDS = 20
+# Панели обычно на одном-двух ядрах: много параллельных соединений им только вредит
+XUI_CONNECTIONS_PER_HOST = 4
+XUI_KEEPALIVE_SECONDS = 60
+
+# Поля инбаунда, которые 3x-ui отдает и принимает как JSON-строки
+_INBOUND_JSON_FIELDS = ("settings", "streamSettings", "sniffing")
+
+class XuiError(Exception):
+    """Панель ответила ошибкой или недоступна"""
+
+class XuiAuthError(XuiError):
+    """Сессия недействительна: нужен повторный логин"""
+
+class XuiConnectionError(XuiError):
+    """Панель не ответила: таймаут, сетевая ошибка или HTTP 5xx"""
+
+class XuiCircuitOpenError(XuiConnectionError):
+    """Запрос не отправлялся: цепь хоста разомкнута после череды сбоев"""
+
+def make_timeout(connect_seconds: float = XUI_CONNECT_TIMEOUT_SECONDS, read_seconds: float = XUI_READ_TIMEOUT_SECONDS) -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=connect_seconds + read_seconds, sock_connect=connect_seconds, sock_read=read_seconds)
+
+# Одна HTTP-сессия на цикл событий: aiohttp-сессию нельзя использовать из чужого цикла
+_http_sessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+def _get_http_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=XUI_CONNECTIONS_PER_HOST,
+            keepalive_timeout=XUI_KEEPALIVE_SECONDS,
+            ttl_dns_cache=300,
+        )
+        # Куки храним в XuiClient: у общего cookie jar панели на одном
+        # хосте с разными портами перезаписывали бы сессии друг друга
+        session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=make_timeout(),
+        )
+        _http_sessions[loop] = session
+    return session
+
+async def close_http_session():
+    """Закрывает HTTP-сессию текущего цикла событий"""
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session and not session.closed:
+        await session.close()
+
+def parse_inbound(raw: dict) -> dict:
+    """Инбаунд из ответа панели с раскрытыми JSON-полями. settingsDigest —
+    отпечаток исходной строки settings (в ней и список клиентов): по нему
+    планировщик понимает, что клиенты инбаунда не менялись"""
+    inbound = dict(raw)
+    settings = inbound.get("settings")
+    inbound["settingsDigest"] = hashlib.blake2b(settings.encode(), digest_size=16).hexdigest() if isinstance(settings, str) else None
+    for field in _INBOUND_JSON_FIELDS:
+        value = inbound.get(field)
+        if isinstance(value, str):
+            inbound[field] = json.loads(value) if value else {}
+    inbound.setdefault("settings", {}).setdefault("clients", [])
+    return inbound
+
+def _serialize_inbound(inbound: dict) -> dict:
+    payload = dict(inbound)
+    payload.pop("settingsDigest", None)
+    for field in _INBOUND_JSON_FIELDS:
+        if isinstance(payload.get(field), dict):
+            payload[field] = json.dumps(payload[field])
+    return payload
+
+class XuiClient:
+    """Асинхронный клиент API панели 3x-ui для одного хоста"""
+
+    def __init__(self, host_url: str, username: str, password: str, timeout: aiohttp.ClientTimeout | None = None):
+        self.host_url = host_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout or make_timeout()
+        self._cookies: dict[str, str] | None = None
+
+    @property
+    def is_logged_in(self) -> bool:
+        return self._cookies is not None
+
+    async def login(self):
+        session = _get_http_session()
+        try:
+            async with session.post(
+                f"{self.host_url}/login",
+                data={"username": self.username, "password": self.password},
+                allow_redirects=False, timeout=self.timeout,
+            ) as response:
+                if response.status >= 500:
+                    raise XuiConnectionError(f"Login to '{self.host_url}': HTTP {response.status}")
+                data = await response.json(content_type=None)
+                if response.status != 200 or not data.get("success"):
+                    raise XuiAuthError(f"Login failed: {data.get('msg') or response.status}")
+                self._cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise XuiConnectionError(f"Login request to '{self.host_url}' failed: {e!r}") from e
+        except ValueError as e:
+            raise XuiError(f"Login to '{self.host_url}': unexpected response: {e}") from e
+
+    async def _request(self, method: str, path: str, **kwargs) -> Any:
+        if self._cookies is None:
+            raise XuiAuthError("Not logged in")
+        session = _get_http_session()
+        try:
+            async with session.request(
+                method, f"{self.host_url}/panel/api/inbounds/{path}",
+                cookies=self._cookies, allow_redirects=False, timeout=self.timeout, **kwargs
+            ) as response:
+                # Без сессии 3x-ui отвечает 404 или редиректом на страницу входа
+                if response.status in (401, 403, 404) or 300 <= response.status < 400:
+                    self._cookies = None
+                    raise XuiAuthError(f"{method} {path}: HTTP {response.status}")
+                if response.status >= 500:
+                    raise XuiConnectionError(f"{method} {path}: HTTP {response.status}")
+                if response.status != 200:
+                    raise XuiError(f"{method} {path}: HTTP {response.status}")
+                try:
+                    data = await response.json(content_type=None)
+                except ValueError:
+                    self._cookies = None
+                    raise XuiAuthError(f"{method} {path}: unexpected non-JSON response")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise XuiConnectionError(f"{method} {path} on '{self.host_url}' failed: {e!r}") from e
+
+        if not data.get("success"):
+            raise XuiError(f"{method} {path}: {data.get('msg')}")
+        return data.get("obj")
+
+    async def get_inbounds(self) -> list[dict]:
+        return [parse_inbound(raw) for raw in await self._request("GET", "list") or []]
+
+    async def get_inbound(self, inbound_id: int) -> dict | None:
+        raw = await self._request("GET", f"get/{inbound_id}")
+        return parse_inbound(raw) if raw else None
+
+    async def update_inbound(self, inbound_id: int, inbound: dict):
+        await self._request("POST", f"update/{inbound_id}", json=_serialize_inbound(inbound))
+
+    async def add_client(self, inbound_id: int, client: dict):
+        await self._request("POST", "addClient", json={
+            "id": inbound_id, "settings": json.dumps({"clients": [client]})
+        })
+
+    async def update_client(self, inbound_id: int, client_uuid: str, client: dict):
+        await self._request("POST", f"updateClient/{client_uuid}", json={
+            "id": inbound_id, "settings": json.dumps({"clients": [client]})
+        })
+
+    async def delete_client(self, inbound_id: int, client_uuid: str):
+        await self._request("POST", f"{inbound_id}/delClient/{client_uuid}")
+
+    async def get_client_traffics(self, email: str) -> dict | None:
+        return await self._request("GET", f"getClientTraffics/{email}")
+
+    async def get_online_clients(self) -> list[str]:
+        """Email клиентов, которые сейчас в сети, по всем инбаундам панели"""
+        return await self._request("POST", "onlines") or []
@@ -5,6 +5,8 @@ import json
 import hashlib
 import base64
 import shutil
+import tempfile
+import threading
 from hmac import compare_digest
 from datetime import datetime
 from functools import wraps
@@ -15,29 +17,113 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from shop_bot.modules import xui_api
+from shop_bot.modules import xui_api, xui_client, host_health, host_placement
 from shop_bot.bot import handlers 
 from shop_bot.data_manager.database import (
     get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
-    create_host, delete_host, create_plan, delete_plan, get_user_count,
-    get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
+    create_host, update_host_inbounds, delete_host, create_plan, delete_plan, get_user_count,
+    get_total_keys_count, get_total_spent_sum, get_hosts_count, get_daily_stats_for_charts,
     get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
     ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction,
-    export_all_users, import_users_from_data, extend_user_key_time, extend_user_all_keys_time,
+    iter_export_users_json, import_users_from_stream, extend_user_key_time, extend_user_all_keys_time,
     extend_all_users_keys_time
 )
 
 _bot_controller = None
 
+# Импорт идет в фоновом потоке, страница пользователей опрашивает его состояние
+_import_lock = threading.Lock()
+_import_status = {"running": False}
+
 ALL_SETTINGS_KEYS = [
     "panel_login", "panel_password", "about_text", "terms_url", "privacy_url",
     "support_user", "support_text", "channel_url", "telegram_bot_token",
     "telegram_bot_username", "admin_telegram_id", "yookassa_shop_id",
     "yookassa_secret_key", "sbp_enabled", "receipt_email", "cryptobot_token",
     "heleket_merchant_id", "heleket_api_key", "domain", "referral_percentage", 
-    "referral_discount", "flask_secret_key", "ton_wallet_address", "tonapi_key", "force_subscription"
+    "referral_discount", "flask_secret_key", "ton_wallet_address", "tonapi_key", "force_subscription",
+    "xui_connect_timeout", "xui_read_timeout", "auto_host_placement",
+    "scheduler_host_concurrency", "scheduler_host_timeout", "scheduler_max_deletions"
 ]
 
+async def _run_and_close_http_session(coro):
+    try:
+        return await coro
+    finally:
+        await xui_client.close_http_session()
+
+def run_async(coro):
+    """Выполняет корутину в основном цикле событий, где живет общая HTTP-сессия
+    к панелям. Без запущенного цикла — во временном, с закрытием сессии"""
+    loop = current_app.config.get('EVENT_LOOP')
+    if loop and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return asyncio.run(_run_and_close_http_session(coro))
+
+def _import_summary(results: dict) -> tuple[str, str]:
+    """Сообщения об итогах импорта: (успех, ошибки)"""
+    success_msg = []
+    if results['imported'] > 0:
+        success_msg.append(f"Импортировано новых пользователей: {results['imported']}")
+    if results['updated'] > 0:
+        success_msg.append(f"Обновлено существующих: {results['updated']}")
+    if results['skipped'] > 0:
+        success_msg.append(f"Пропущено: {results['skipped']}")
+    if results['keys_imported'] > 0:
+        success_msg.append(f"Импортировано ключей: {results['keys_imported']}")
+    if results['transactions_imported'] > 0:
+        success_msg.append(f"Импортировано транзакций: {results['transactions_imported']}")
+
+    error_msg = ""
+    if results['errors']:
+        error_msg = f"Ошибки при импорте ({len(results['errors'])}): " + '; '.join(results['errors'][:3])
+        if len(results['errors']) > 3:
+            error_msg += f" и еще {len(results['errors']) - 3}..."
+    return ' | '.join(success_msg), error_msg
+
+def _update_import_status(**fields):
+    with _import_lock:
+        _import_status.update(fields)
+
+def _run_import_job(path: str, ndjson: bool, overwrite: bool):
+    def on_progress(results: dict):
+        _update_import_status(
+            processed=results['processed'], imported=results['imported'],
+            updated=results['updated'], errors_count=len(results['errors'])
+        )
+
+    try:
+        with open(path, encoding='utf-8') as stream:
+            results = import_users_from_stream(
+                stream, ndjson=ndjson, overwrite_existing=overwrite, progress_callback=on_progress
+            )
+        success_msg, error_msg = _import_summary(results)
+        on_progress(results)
+        _update_import_status(message=success_msg, error=error_msg)
+    except Exception as e:
+        logger.error(f"Import failed: {e}", exc_info=True)
+        _update_import_status(error=f"Ошибка при импорте: {str(e)}")
+    finally:
+        os.remove(path)
+        _update_import_status(running=False, finished_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+def _parse_host_pool(form) -> tuple[list[int], int | None]:
+    """Пул инбаундов и лимит клиентов из формы хоста; пустой пул — ошибка ввода"""
+    try:
+        inbounds = [int(inbound_id) for inbound_id in form['host_inbound_ids'].replace(' ', '').split(',') if inbound_id]
+    except ValueError:
+        inbounds = []
+    max_clients = form.get('max_clients_per_inbound', '').strip()
+    return (
+        list(dict.fromkeys(inbounds)),
+        int(max_clients) if max_clients.isdigit() and int(max_clients) > 0 else None
+    )
+
+def _forget_host_caches(host_name: str):
+    xui_api.invalidate_host_session(host_name)
+    xui_api.invalidate_inbound_metadata(host_name)
+    xui_api.invalidate_client_index(host_name)
+
 def create_webhook_app(bot_controller_instance):
     global _bot_controller
     _bot_controller = bot_controller_instance
@@ -245,7 +331,7 @@ def create_webhook_app(bot_controller_instance):
             "user_count": get_user_count(),
             "total_keys": get_total_keys_count(),
             "total_spent": get_total_spent_sum(),
-            "host_count": len(get_all_hosts())
+            "host_count": get_hosts_count()
         }
         
         # Получаем информацию о системных ресурсах
@@ -303,7 +389,7 @@ def create_webhook_app(bot_controller_instance):
             for key in ALL_SETTINGS_KEYS:
                 if key == 'panel_password': continue
 
-                if key in ['sbp_enabled', 'force_subscription']:
+                if key in ['sbp_enabled', 'force_subscription', 'auto_host_placement']:
                     value = 'true' if key in request.form else 'false'
                     update_setting(key, value)
                 else:
@@ -324,6 +410,7 @@ def create_webhook_app(bot_controller_instance):
         hosts = get_all_hosts()
         for host in hosts:
             host['plans'] = get_plans_for_host(host['host_name'])
+            host['health'] = host_health.get_host_health(host['host_name'])
         
         common_data = get_common_template_data()
         return render_template('settings.html', settings=current_settings, hosts=hosts, **common_data)
@@ -363,7 +450,7 @@ def create_webhook_app(bot_controller_instance):
         success_count = 0
         
         for key in keys_to_revoke:
-            result = asyncio.run(xui_api.delete_client_on_host(key['host_name'], key['key_email']))
+            result = run_async(xui_api.delete_client_on_host(key['host_name'], key['key_email'], key['inbound_id']))
             if result:
                 success_count += 1
         
@@ -379,20 +466,44 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/add-host', methods=['POST'])
     @login_required
     def add_host_route():
+        inbounds, max_clients = _parse_host_pool(request.form)
+        if not inbounds:
+            flash('Укажите ID входящих подключений числами через запятую.', 'danger')
+            return redirect(url_for('settings_page'))
         create_host(
             name=request.form['host_name'],
             url=request.form['host_url'],
             user=request.form['host_username'],
             passwd=request.form['host_pass'],
-            inbound=int(request.form['host_inbound_id'])
+            inbounds=inbounds,
+            max_clients_per_inbound=max_clients
         )
+        _forget_host_caches(request.form['host_name'])
+        host_health.forget_host(request.form['host_name'])
         flash(f"Хост '{request.form['host_name']}' успешно добавлен.", 'success')
         return redirect(url_for('settings_page'))
 
+    @flask_app.route('/edit-host/<host_name>', methods=['POST'])
+    @login_required
+    def edit_host_route(host_name):
+        inbounds, max_clients = _parse_host_pool(request.form)
+        if not inbounds:
+            flash('Укажите ID входящих подключений числами через запятую.', 'danger')
+            return redirect(url_for('settings_page'))
+        if update_host_inbounds(host_name, inbounds, max_clients):
+            _forget_host_caches(host_name)
+            flash(f"Входящие подключения хоста '{host_name}' обновлены.", 'success')
+        else:
+            flash(f"Не удалось обновить хост '{host_name}'.", 'danger')
+        return redirect(url_for('settings_page'))
+
     @flask_app.route('/delete-host/<host_name>', methods=['POST'])
     @login_required
     def delete_host_route(host_name):
         delete_host(host_name)
+        _forget_host_caches(host_name)
+        host_health.forget_host(host_name)
+        host_placement.forget_host(host_name)
         flash(f"Хост '{host_name}' и все его тарифы были удалены.", 'success')
         return redirect(url_for('settings_page'))
 
@@ -594,24 +705,23 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/export-users')
     @login_required
     def export_users():
-        """Экспорт всех пользователей в JSON файл"""
+        """Потоковый экспорт всех пользователей в JSON (или NDJSON) файл"""
         try:
-            export_data = export_all_users()
+            ndjson = request.args.get('format') == 'ndjson'
             
             # Создаем имя файла с датой
-            from datetime import datetime
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"users_export_{timestamp}.json"
+            filename = f"users_export_{timestamp}.{'ndjson' if ndjson else 'json'}"
             
-            # Создаем JSON response для скачивания
+            # Отдаем файл кусками по мере чтения из базы
             response = flask_app.response_class(
-                response=json.dumps(export_data, indent=2, ensure_ascii=False),
+                response=iter_export_users_json(ndjson=ndjson),
                 status=200,
-                mimetype='application/json'
+                mimetype='application/x-ndjson' if ndjson else 'application/json'
             )
             response.headers['Content-Disposition'] = f'attachment; filename={filename}'
             
-            logger.info(f"Users export completed: {export_data['total_users']} users")
+            logger.info("Users export stream started")
             return response
             
         except Exception as e:
@@ -633,47 +743,39 @@ def create_webhook_app(bot_controller_instance):
                 flash('Файл не выбран', 'danger')
                 return redirect(url_for('users_page'))
             
-            if not file.filename.endswith('.json'):
-                flash('Можно загружать только JSON файлы', 'danger')
-                return redirect(url_for('users_page'))
-            
-            # Читаем содержимое файла
-            try:
-                import_data = json.loads(file.read().decode('utf-8'))
-            except json.JSONDecodeError as e:
-                flash(f'Ошибка чтения JSON файла: {str(e)}', 'danger')
+            if not file.filename.endswith(('.json', '.ndjson')):
+                flash('Можно загружать только JSON или NDJSON файлы', 'danger')
                 return redirect(url_for('users_page'))
             
             # Проверяем наличие параметра перезаписи
             overwrite = request.form.get('overwrite_existing', 'off') == 'on'
             
-            # Выполняем импорт
-            results = import_users_from_data(import_data, overwrite_existing=overwrite)
-            
-            # Формируем сообщение о результатах
-            success_msg = []
-            if results['imported'] > 0:
-                success_msg.append(f"Импортировано новых пользователей: {results['imported']}")
-            if results['updated'] > 0:
-                success_msg.append(f"Обновлено существующих: {results['updated']}")
-            if results['skipped'] > 0:
-                success_msg.append(f"Пропущено: {results['skipped']}")
-            if results['keys_imported'] > 0:
-                success_msg.append(f"Импортировано ключей: {results['keys_imported']}")
-            if results['transactions_imported'] > 0:
-                success_msg.append(f"Импортировано транзакций: {results['transactions_imported']}")
-            
-            if success_msg:
-                flash(' | '.join(success_msg), 'success')
-            
-            # Показываем ошибки если есть
-            if results['errors']:
-                error_msg = f"Ошибки при импорте ({len(results['errors'])}): " + '; '.join(results['errors'][:3])
-                if len(results['errors']) > 3:
-                    error_msg += f" и еще {len(results['errors']) - 3}..."
-                flash(error_msg, 'warning')
-            
-            logger.info(f"Import completed: {results}")
+            with _import_lock:
+                if _import_status['running']:
+                    flash('Импорт уже выполняется, дождитесь его окончания', 'warning')
+                    return redirect(url_for('users_page'))
+                _import_status.clear()
+                _import_status.update(
+                    running=True, filename=file.filename, processed=0, imported=0,
+                    updated=0, errors_count=0, message="", error="", finished_at=None
+                )
+
+            # Запрос закончится раньше импорта, поэтому файл сохраняем во временный,
+            # а импортируем его в фоне; прогресс страница берет из /import-users/status
+            try:
+                with tempfile.NamedTemporaryFile(suffix='.import', delete=False) as tmp:
+                    shutil.copyfileobj(file.stream, tmp)
+                threading.Thread(
+                    target=_run_import_job,
+                    args=(tmp.name, file.filename.endswith('.ndjson'), overwrite),
+                    name="users-import", daemon=True
+                ).start()
+            except Exception:
+                _update_import_status(running=False)
+                raise
+
+            flash(f'Импорт файла {file.filename} запущен, прогресс отображается ниже', 'success')
+            logger.info(f"Import of {file.filename} started in background")
             return redirect(url_for('users_page'))
             
         except Exception as e:
@@ -681,6 +783,13 @@ def create_webhook_app(bot_controller_instance):
             flash(f'Ошибка при импорте: {str(e)}', 'danger')
             return redirect(url_for('users_page'))
 
+    @flask_app.route('/import-users/status')
+    @login_required
+    def import_users_status():
+        """Состояние последнего импорта пользователей"""
+        with _import_lock:
+            return dict(_import_status)
+
     @flask_app.route('/extend-user-key-time', methods=['POST'])
     @login_required
     def extend_user_key_time_route():
@@ -697,8 +806,7 @@ def create_webhook_app(bot_controller_instance):
                 return {'success': False, 'message': 'Слишком большое количество дней'}, 400
             
             # Выполняем операцию
-            import asyncio
-            result = asyncio.run(extend_user_key_time(key_id, days_to_add))
+            result = run_async(extend_user_key_time(key_id, days_to_add))
             
             status_code = 200 if result['success'] else 400
             return result, status_code
@@ -721,8 +829,7 @@ def create_webhook_app(bot_controller_instance):
             if abs(days_to_add) > 3650:
                 return {'success': False, 'message': 'Слишком большое количество дней'}, 400
             
-            import asyncio
-            result = asyncio.run(extend_user_all_keys_time(user_id, days_to_add))
+            result = run_async(extend_user_all_keys_time(user_id, days_to_add))
             
             status_code = 200 if result['success'] else 400
             return result, status_code
@@ -749,8 +856,7 @@ def create_webhook_app(bot_controller_instance):
             # Получаем имя админа из сессии
             admin_user = get_all_settings().get('panel_login', 'admin')
             
-            import asyncio
-            result = asyncio.run(extend_all_users_keys_time(days_to_add, admin_user))
+            result = run_async(extend_all_users_keys_time(days_to_add, admin_user))
             
             if result['success']:
                 flash(result['message'], 'success')
@@ -119,6 +119,23 @@ document.addEventListener('DOMContentLoaded', function () {
 				responsive: true,
 			},
 		})
+		const revenueChartCanvas = document.getElementById('revenueChart')
+		if (!revenueChartCanvas || !CHART_DATA.revenue) return
+
+		const revenueCtx = revenueChartCanvas.getContext('2d')
+		const revenueChartData = prepareChartData(
+			CHART_DATA.revenue,
+			'Выручка в день, RUB',
+			'#fd7e14'
+		)
+		new Chart(revenueCtx, {
+			type: 'line',
+			data: revenueChartData,
+			options: {
+				scales: { y: { beginAtZero: true } },
+				responsive: true,
+			},
+		})
 	}
 	initializePasswordToggles()
 	setupBotControlForms()